@@ -0,0 +1,335 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Benchmark Tools
+'''
+import os
+import json
+import signal
+import socket
+import platform
+import datetime
+import multiprocessing
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import utilities as ut
+import pacing as pc
+import sockio as so
+import stats as st
+import delaylog as dl
+import console as co
+import transmit as tx
+import receive as rx
+
+# Results format version, bump whenever the layout of the JSON changes
+VERSION = 1
+
+# A rate is only sustainable if nearly every packet arrives and the pacer keeps up with it
+MIN_PDR = 99.9
+MAX_RATE_ERROR = 5.0
+
+# Compared against the baseline by Compare(), with whether a higher value is worse
+METRICS = [('tx_cpu', True), ('rx_cpu', True), ('rate', False), ('pdr', False), ('p99', True)]
+
+class FixedLabels:
+    """
+    Stands in for a LabelSource with labels that never change.
+
+    Args:
+        labels (dict): The labels to send.
+    """
+
+    def __init__(self, labels: dict) -> None:
+        self.labels = labels
+        self.version = 0
+
+    def Get(self) -> dict:
+        return self.labels
+
+def MakeLabels(size: int) -> dict:
+    """
+    Makes labels that encode to a packet body of about [size] bytes.
+
+    Args:
+        size (int): The payload size in bytes.
+
+    Returns:
+        labels (dict): The labels.
+    """
+
+    if size <= 0:
+        return {}
+
+    # 'payload' and its separators take 9 bytes of the body
+    return {'payload': 'x' * max(0, size - 9)}
+
+def ReceiveWorker(rxsock: socket.socket, pkt_tot: int, batch: int, path: str, results) -> None:
+    """
+    Runs the receive loop on [rxsock] with stage timing and sends back the results (runs in its own process so the
+    receiver and transmitter do not share a GIL).
+
+    Args:
+        rxsock (socket.socket): The bound UDP socket.
+        pkt_tot (int): The number of packets to receive.
+        batch (int): The most datagrams drained from the socket with a single recvmmsg() call.
+        path (str): Where to write the delay log.
+        results (multiprocessing.Queue): Where 'ready' and the results are sent.
+
+    Returns:
+        None
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    receiver = so.BatchReceiver(rxsock, batch, 65536)
+
+    # Never started, so receive times are plain PC times like the transmitter's
+    calibrator = ut.ClockCalibrator('log.txt', 0)
+    console = co.Console(co.QUIET)
+    log = dl.DelayLogWriter(path)
+    timer = st.StageTimer()
+
+    results.put('ready')
+    result = rx.CollectPackets(receiver, pkt_tot, calibrator, (0, 0), 0, log, console, rx_timeout=2, drain_timeout=0.5, timer=timer)
+
+    log.Close()
+    console.Close()
+    os.remove(path)
+
+    loss = result['tracker'].Finalize(pkt_tot)
+    results.put({'loss': loss, 'latency': result['histogram'].Report(1e-3), 'stages': timer.Report(loss['received'])})
+
+def RunPoint(pkt_rate: int, size: int, pkt_tot: int, pacer: str = 'hybrid', burst: int = 1, batch: int = 1) -> dict:
+    """
+    Sends [pkt_tot] packets with [size] byte payloads at [pkt_rate] pkts/s over loopback and measures both ends.
+
+    Args:
+        pkt_rate (int): The target packet rate.
+        size (int): The payload size in bytes.
+        pkt_tot (int): The number of packets to send.
+        pacer (str): The rate control to use (see pacing.py).
+        burst (int): The bucket size or packets per burst for the pacer.
+        batch (int): The batch size for sendmmsg()/recvmmsg().
+
+    Returns:
+        point (dict): Achieved rate, pacing error, loss, latency percentiles, and CPU us/pkt for each stage.
+    """
+
+    rxsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rxsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    rxsock.bind(('127.0.0.1', 0))
+    dest = rxsock.getsockname()
+
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    path = './Logging/Bench/.bench_' + str(os.getpid()) + '.dlog'
+    proc = ctx.Process(target=ReceiveWorker, args=(rxsock, pkt_tot, batch, path, results), daemon=True)
+    proc.start()
+    rxsock.close()
+    ut.GetResult(results, [proc], timeout=10)
+
+    txsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    txsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 3_000_000)
+
+    labels = FixedLabels(MakeLabels(size))
+    calibrator = ut.ClockCalibrator('log.txt', 0)
+    pacer = pc.MakePacer(pacer, pkt_rate, burst)
+    console = co.Console(co.QUIET)
+    timer = st.StageTimer()
+
+    sent = tx.SendPackets(txsock, dest, pkt_rate, pkt_tot, labels, calibrator, 0, [0, 0], pacer, console, batch, 0, timer)
+
+    console.Close()
+    txsock.close()
+
+    # Everything has been sent, the receiver only has to drain (rx_timeout=2) and summarize
+    result = ut.GetResult(results, [proc], timeout=30)
+    proc.join()
+
+    pacing = pacer.Report()
+    tx_stages = timer.Report(sent)
+    loss = result['loss']
+    latency = result['latency']
+    return {
+        'pkt_rate': pkt_rate,
+        'size': size,
+        'sent': sent,
+        'rate': pacing['rate'],
+        'error': pacing['error'],
+        'idt_std': pacing['idt_std'],
+        'pdr': loss['pdr'],
+        'lost': loss['lost'],
+        'reordered': loss['reordered'],
+        'p50': latency['p50'],
+        'p99': latency['p99'],
+        'p99.9': latency['p99.9'],
+        'max': latency['max'],
+        'tx_stages': tx_stages,
+        'rx_stages': result['stages'],
+        'tx_cpu': tx_stages['total'],
+        'rx_cpu': result['stages']['total'],
+    }
+
+def Compare(points: list, baseline: dict, tolerance: float = 20.0) -> int:
+    """
+    Compares benchmark points against a baseline run, printing every metric that got worse by more than [tolerance] %.
+
+    Args:
+        points (list): The points of this run.
+        baseline (dict): The results of an earlier run (as written by Benchmark()).
+        tolerance (float): How many percent worse a metric may get before it counts as a regression.
+
+    Returns:
+        regressions (int): The number of regressed metrics.
+    """
+
+    old_points = {(point['pkt_rate'], point['size']): point for point in baseline['points']}
+    regressions = 0
+
+    print('\nCompared to ' + baseline.get('time', 'baseline') + ' (tolerance ' + str(tolerance) + '%):\n')
+    for point in points:
+        old = old_points.get((point['pkt_rate'], point['size']))
+        if old is None:
+            continue
+
+        changes = []
+        for metric, higher_worse in METRICS:
+            if old[metric] == 0:
+                continue
+            change = 100 * (point[metric] - old[metric]) / abs(old[metric])
+            worse = change if higher_worse else -change
+            flag = ''
+            if worse > tolerance:
+                flag = ' REGRESSION'
+                regressions = regressions + 1
+            changes.append('%s %.3g -> %.3g (%+.1f%%)%s' % (metric, old[metric], point[metric], change, flag))
+
+        print('%7d pkts/s %5d B: %s' % (point['pkt_rate'], point['size'], ', '.join(changes)))
+
+    print('\n' + str(regressions) + ' regression(s)\n')
+    return regressions
+
+def Benchmark(rates: list, sizes: list, seconds: float = 2.0, pacer: str = 'hybrid', burst: int = 1, batch: int = 1, out: str = None,
+              baseline: str = None, tolerance: float = 20.0) -> int:
+    """
+    Runs the transmit and receive loops against each other over loopback for every packet rate and payload size,
+    without any prompts, and writes the results to JSON.
+
+    Args:
+        rates (list): The packet rates to try.
+        sizes (list): The payload sizes to try in bytes.
+        seconds (float): How long each point sends for.
+        pacer (str): The rate control to use (see pacing.py).
+        burst (int): The bucket size or packets per burst for the pacer.
+        batch (int): The batch size for sendmmsg()/recvmmsg().
+        out (str): Where to write the results, defaults to ./Logging/Bench/bench_[date].json.
+        baseline (str): Results of an earlier run to compare against.
+        tolerance (float): How many percent worse a metric may get before it counts as a regression.
+
+    Returns:
+        regressions (int): The number of regressed metrics (0 without a baseline).
+
+    ==============================================================
+
+    +------------------ 127.0.0.1 -----------------+
+    | +--------------+   udp pkts   +------------+ |
+    | | SendPackets  |------------->| Collect-   | |
+    | | (this proc)  | rate x size  | Packets    | |
+    | +--------------+              | (forked)   | |
+    |  label load, serialize, send  +------------+ |
+    |                    receive, decode, record   |
+    +----------------------------------------------+
+
+    1. For every payload size and packet rate, fork a receiver running the receive loop on a loopback socket.
+    2. Run the transmit loop against it for [seconds], timing the CPU spent in every stage of both loops.
+    3. Report achieved rate, pacing error, loss, latency percentiles, and CPU us/pkt per stage.
+    4. Find the highest rate for each size with PDR >= 99.9% and a pacing error within 5%.
+    5. Write everything to JSON, and compare against [baseline] if given.
+
+    ==============================================================
+    """
+
+    os.makedirs('./Logging/Bench', exist_ok=True)
+    now = datetime.datetime.now()
+    if out is None:
+        out = './Logging/Bench/bench_' + now.strftime("%Y_%m_%d_%H_%M_%S_%p") + '.json'
+
+    points = []
+    max_rate = {}
+    for size in sizes:
+        for pkt_rate in rates:
+            point = RunPoint(pkt_rate, size, max(1, int(pkt_rate * seconds)), pacer, burst, batch)
+            points.append(point)
+
+            print('%7d pkts/s %5d B: %.0f pkts/s (%+.2f%%), PDR %.2f%%, p50/p99/p99.9 %.3f/%.3f/%.3f ms'
+                  % (pkt_rate, size, point['rate'], point['error'], point['pdr'], point['p50'], point['p99'], point['p99.9']))
+            print('    TX ' + ', '.join('%s %.2f' % item for item in point['tx_stages'].items()) + ' us/pkt')
+            print('    RX ' + ', '.join('%s %.2f' % item for item in point['rx_stages'].items()) + ' us/pkt')
+
+            if (point['pdr'] >= MIN_PDR) and (abs(point['error']) <= MAX_RATE_ERROR):
+                max_rate[str(size)] = max(max_rate.get(str(size), 0), pkt_rate)
+
+    print('\nHighest sustainable rate (PDR >= %.1f%%, rate error <= %.0f%%):' % (MIN_PDR, MAX_RATE_ERROR))
+    for size in sizes:
+        print('%5d B: %s' % (size, str(max_rate.get(str(size), 'none')) + ' pkts/s'))
+
+    results = {
+        'version': VERSION,
+        'time': now.isoformat(),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'params': {'rates': rates, 'sizes': sizes, 'seconds': seconds, 'pacer': pacer, 'burst': burst, 'batch': batch},
+        'points': points,
+        'max_rate': max_rate,
+    }
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('\nResults written to ' + out)
+
+    if baseline is None:
+        return 0
+    with open(baseline) as f:
+        return Compare(points, json.load(f), tolerance)
+
+# String for help command
+bm_str = ("""
+===============
+  Benchmark()
+===============
+
+Runs the transmit and receive loops against each other over loopback for every packet rate and payload size,
+without any prompts, and writes the results to JSON.
+
+Args:
+    rates (list): The packet rates to try (comma separated).
+    sizes (list): The payload sizes to try in bytes (comma separated).
+    seconds (float): How long each point sends for.
+    pacer (str): The rate control to use (see pacing.py).
+    burst (int): The bucket size or packets per burst for the pacer.
+    batch (int): The batch size for sendmmsg()/recvmmsg().
+    out (str): Where to write the results, defaults to ./Logging/Bench/bench_[date].json.
+    baseline (str): Results of an earlier run to compare against.
+    tolerance (float): How many percent worse a metric may get before it counts as a regression.
+
+Returns:
+    regressions (int): The number of regressed metrics (0 without a baseline).
+
+==============================================================
+
++------------------ 127.0.0.1 -----------------+
+| +--------------+   udp pkts   +------------+ |
+| | SendPackets  |------------->| Collect-   | |
+| | (this proc)  | rate x size  | Packets    | |
+| +--------------+              | (forked)   | |
+|  label load, serialize, send  +------------+ |
+|                    receive, decode, record   |
++----------------------------------------------+
+
+1. For every payload size and packet rate, fork a receiver running the receive loop on a loopback socket.
+2. Run the transmit loop against it for [seconds], timing the CPU spent in every stage of both loops.
+3. Report achieved rate, pacing error, loss, latency percentiles, and CPU us/pkt per stage.
+4. Find the highest rate for each size with PDR >= 99.9% and a pacing error within 5%.
+5. Write everything to JSON, and compare against [baseline] if given.
+
+==============================================================
+""")
@@ -0,0 +1,140 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Console Tools
+'''
+import sys
+import time
+import queue
+import threading
+from operator import*
+
+# Verbosity levels: QUIET only prints final results, NORMAL adds periodic summaries, VERBOSE adds every packet
+QUIET = 0
+NORMAL = 1
+VERBOSE = 2
+
+class Console:
+    """
+    Console output that never blocks the caller: messages are queued and written out by a background thread, so a slow
+    terminal (e.g. over SSH) can not stall sending/receiving or distort the measured delays.
+
+    Args:
+        level (int): The most verbose level printed (QUIET, NORMAL, or VERBOSE).
+        period (float): Seconds between the periodic summaries signalled by Due().
+        maxsize (int): The most messages queued before new ones are dropped rather than waited on.
+    """
+
+    def __init__(self, level: int = NORMAL, period: float = 1.0, maxsize: int = 10000) -> None:
+        self.level = level
+        self.period = period
+        self.queue = queue.Queue(maxsize)
+
+        # Messages thrown away because the writer could not keep up
+        self.dropped = 0
+
+        # Time of the next summary (anchored on the first call to Due())
+        self.next_summary = None
+
+        self.thread = threading.Thread(target=self.Drain, daemon=True)
+        self.thread.start()
+
+    def Log(self, level: int, fmt: str, *args) -> None:
+        """
+        Queues a message for printing if [level] is enabled. Formatting is left to the writer thread, so arguments must
+        not be changed after they are passed in.
+
+        Args:
+            level (int): The verbosity level of the message.
+            fmt (str): The %-format string of the message.
+            *args: The values formatted into [fmt].
+
+        Returns:
+            None
+        """
+
+        if level > self.level:
+            return
+
+        try:
+            self.queue.put_nowait((fmt, args))
+        except queue.Full:
+            self.dropped = self.dropped + 1
+
+    def Due(self) -> bool:
+        """
+        Rate-limits periodic summaries to one every [period] seconds (the first is timed from the first call).
+
+        Args:
+            None
+
+        Returns:
+            due (bool): Whether a summary should be printed now.
+        """
+
+        now = time.monotonic()
+        if self.next_summary is None:
+            self.next_summary = now + self.period
+            return False
+        if now < self.next_summary:
+            return False
+
+        # Skip missed periods rather than printing a string of summaries after a stall
+        while self.next_summary <= now:
+            self.next_summary = self.next_summary + self.period
+        return True
+
+    def Drain(self) -> None:
+        """
+        Writes out queued messages until Close() is called (runs in the background thread).
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        while True:
+            messages = [self.queue.get()]
+
+            # Write everything already waiting with a single flush
+            while True:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            stop = False
+            for message in messages:
+                if message is None:
+                    stop = True
+                    continue
+                fmt, args = message
+                lines.append((fmt % args) if args else fmt)
+
+            if lines:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush()
+
+            if stop:
+                return
+
+    def Close(self) -> None:
+        """
+        Writes out everything still queued and stops the background thread.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if not self.thread.is_alive():
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.dropped > 0:
+            print('(%d console messages dropped)' % (self.dropped))
@@ -0,0 +1,279 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Rate Control Tools
+'''
+import os
+import time
+import socket
+import struct
+import datetime
+import threading
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import stats as st
+import delaylog as dl
+
+# Two bytes at the start of every feedback report so stray traffic on the port is ignored
+MAGIC = b'CF'
+
+# Feedback format version, bump whenever the report layout changes
+VERSION = 1
+
+# magic, version, window, pkt_rate (from the last header), received, expected, p50 (us), p99 (us) -- network byte order
+FEEDBACK = struct.Struct('!2sBIIIIdd')
+
+# One record per feedback window in the rate log (a binary delay log with its own fields, see delaylog.py)
+RATE_FIELDS = [('time', '<i8'), ('window', '<u4'), ('rate', '<f8'), ('received', '<u4'), ('expected', '<u4'), ('pdr', '<f8'), ('p50', '<f8'),
+               ('p99', '<f8'), ('next_rate', '<f8')]
+
+def ParseAddress(address: str) -> tuple:
+    """
+    Splits a 'host:port' string.
+
+    Args:
+        address (str): The address, e.g. '192.168.1.10:9900'.
+
+    Returns:
+        address (tuple): (host, port)
+    """
+
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+class FeedbackSender:
+    """
+    Receiver side of the feedback channel: every [period] seconds, sends the transmitter the loss and latency
+    percentiles of the packets received since the last report.
+
+    Args:
+        dest (tuple): The (address, port) the transmitter listens for feedback on.
+        period (float): The length of a feedback window in seconds.
+    """
+
+    def __init__(self, dest: tuple, period: float = 0.5) -> None:
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.dest = dest
+        self.period = period
+        self.next_time = None
+        self.window = 0
+
+        # Latency of this window only, and the counts and time at the end of the last one
+        self.histogram = st.LatencyHistogram()
+        self.last_received = 0
+        self.last_expected = 0
+        self.last_time = None
+
+    def Record(self, delay: int) -> None:
+        """
+        Adds the delay of a packet to the current window.
+
+        Args:
+            delay (int): The delay in us.
+
+        Returns:
+            None
+        """
+
+        self.histogram.Record(delay)
+
+    def Due(self, tracker: st.SequenceTracker, pkt_rate: int) -> None:
+        """
+        Sends a report if the window is over (the first call starts the first window). Called on every receive
+        timeout too, so a window in which nothing arrived is still reported.
+
+        Args:
+            tracker (SequenceTracker): The receiver's sequence tracker.
+            pkt_rate (int): The packet rate from the last header, so the transmitter can tell which rate a report is about.
+
+        Returns:
+            None
+        """
+
+        now = time.monotonic()
+        if self.next_time is None:
+            self.next_time = now + self.period
+            self.last_time = now
+            return
+        if now < self.next_time:
+            return
+        self.next_time = now + self.period
+
+        highest = 0 if tracker.highest is None else tracker.highest - tracker.base + 1
+        received = tracker.received - self.last_received
+        if received:
+            expected = max(received, highest - self.last_expected)
+            self.last_expected = highest
+        else:
+            # Nothing arriving once packets have been seen is an outage: the packets the transmitter would have sent at
+            # its last rate are reported lost (PDR 0) and counted as expected already, so the window in which packets
+            # return does not count them again (before the first packet pkt_rate is 0 and the report is ignored)
+            expected = round(pkt_rate * (now - self.last_time))
+            self.last_expected = self.last_expected + expected
+
+        report = FEEDBACK.pack(MAGIC, VERSION, self.window, pkt_rate, received, expected, self.histogram.Percentile(50), self.histogram.Percentile(99))
+        try:
+            self.sock.sendto(report, self.dest)
+        except OSError:
+            # Feedback is best effort, the transmitter holds its rate without it
+            pass
+
+        self.window = self.window + 1
+        self.last_received = tracker.received
+        self.last_time = now
+        self.histogram = st.LatencyHistogram()
+
+    def Close(self) -> None:
+        self.sock.close()
+
+class RateController(threading.Thread):
+    """
+    Transmitter side of the feedback channel: an AIMD controller that moves the packet rate toward the highest rate
+    the link sustains at [target_pdr] (and [target_p99]).
+
+    Each report whose window was sent entirely at the current rate adds [step] pkts/s if the targets were met, or
+    multiplies the rate by [decrease] if not. The first report at a new rate is skipped, since its window started
+    before the change. Every report is logged with the rate it led to.
+
+    Args:
+        port (int): The UDP port to listen for feedback on.
+        pkt_rate (int): The starting packet rate.
+        target_pdr (float): The lowest acceptable PDR in % over a window.
+        target_p99 (float): The highest acceptable p99 latency in ms over a window, None to ignore latency.
+        min_rate (int): The lowest rate the controller goes to.
+        max_rate (int): The highest rate the controller goes to.
+        step (int): The additive increase in pkts/s, defaults to 5% of the starting rate.
+        decrease (float): The multiplicative decrease.
+        path (str): The rate log, defaults to ./Logging/Rate/rate_log_[date].dlog.
+    """
+
+    def __init__(self, port: int, pkt_rate: int, target_pdr: float = 99.0, target_p99: float = None, min_rate: int = 10, max_rate: int = 100000,
+                 step: int = None, decrease: float = 0.7, path: str = None) -> None:
+        super().__init__(daemon=True)
+        self.target_pdr = target_pdr
+        self.target_p99 = target_p99
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step or max(1, round(0.05 * pkt_rate))
+        self.decrease = decrease
+
+        # Written by this thread and taken by the send loop through Poll()
+        self.rate = pkt_rate
+        self.pending = None
+        self.settled = False
+        self.lock = threading.Lock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.sock.settimeout(0.5)
+        self.stop = threading.Event()
+
+        now = datetime.datetime.now()
+        if path is None:
+            os.makedirs('./Logging/Rate', exist_ok=True)
+            path = './Logging/Rate/rate_log_' + now.strftime("%Y_%m_%d_%H_%M_%S_%p") + '.dlog'
+        self.path = path
+        meta = {'start_time': now.isoformat(), 'pkt_rate': pkt_rate, 'target_pdr': target_pdr, 'target_p99': target_p99, 'step': self.step, 'decrease': decrease}
+        self.log = dl.DelayLogWriter(path, meta, RATE_FIELDS, chunk=16)
+
+        self.reports = 0
+        self.best_rate = 0
+
+    def Next(self, pdr: float, p99: float) -> int:
+        """
+        Gives the rate after a window with [pdr] and [p99] at the current rate.
+
+        Args:
+            pdr (float): The PDR of the window in %.
+            p99 (float): The p99 latency of the window in ms.
+
+        Returns:
+            rate (int): The next rate.
+        """
+
+        met = (pdr >= self.target_pdr) and ((self.target_p99 is None) or (p99 <= self.target_p99))
+        if met:
+            self.best_rate = max(self.best_rate, self.rate)
+            rate = self.rate + self.step
+        else:
+            rate = self.rate * self.decrease
+        return int(min(self.max_rate, max(self.min_rate, round(rate))))
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            try:
+                report = self.sock.recv(FEEDBACK.size)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if (len(report) != FEEDBACK.size) or (report[:2] != MAGIC):
+                continue
+
+            _, version, window, pkt_rate, received, expected, p50, p99 = FEEDBACK.unpack(report)
+            if (version != VERSION) or (expected == 0):
+                continue
+            pdr = 100 * min(received, expected) / expected
+            self.reports = self.reports + 1
+
+            # Only a window sent entirely at the current rate says anything about it
+            next_rate = self.rate
+            if pkt_rate == self.rate:
+                if self.settled:
+                    next_rate = self.Next(pdr, p99 / 1e3)
+                self.settled = True
+
+            self.log.Write(time.time_ns(), window, self.rate, received, expected, pdr, p50 / 1e3, p99 / 1e3, next_rate)
+
+            if next_rate != self.rate:
+                with self.lock:
+                    self.rate = next_rate
+                    self.pending = next_rate
+                    self.settled = False
+
+    def Poll(self):
+        """
+        Takes the new rate if the controller has changed it since the last call (called from the send loop).
+
+        Args:
+            None
+
+        Returns:
+            rate (int): The new rate, or None if it has not changed.
+        """
+
+        if self.pending is None:
+            return None
+        with self.lock:
+            rate = self.pending
+            self.pending = None
+        return rate
+
+    def Stop(self) -> None:
+        """
+        Stops listening and closes the rate log.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.stop.set()
+        self.join()
+        self.sock.close()
+        self.log.Close({'reports': self.reports, 'final_rate': self.rate, 'best_rate': self.best_rate})
+
+    def Summary(self) -> str:
+        """
+        Gives the number of reports, the final rate, and the highest rate that met the targets.
+
+        Args:
+            None
+
+        Returns:
+            summary (str): The summary.
+        """
+
+        return ('Rate control: %d reports, final rate %d pkts/s, highest rate meeting the targets %d pkts/s (log %s)'
+                % (self.reports, self.rate, self.best_rate, self.path))
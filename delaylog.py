@@ -0,0 +1,382 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Delay Log Tools
+'''
+import os
+import glob
+import json
+import struct
+from operator import*
+
+# Every binary delay log starts with these 8 bytes
+MAGIC = b'CV2XDLOG'
+
+# Log format version, bump whenever the record layout changes
+VERSION = 2
+
+# magic, header size (bytes before the first record), JSON metadata length -- little endian
+PREAMBLE = struct.Struct('<8sII')
+
+# Space reserved for the preamble and JSON metadata, so the metadata can be rewritten in place when the run ends
+# (a multiple of 64 so the records that follow are aligned for memory mapping)
+HEADER_SIZE = 4096
+
+# One fixed-width record per received packet, in NumPy dtype notation so the file describes itself
+# rx_ts is the kernel arrival time when the receiver asked for one, user_ts is when the program had the packet
+# (the same as rx_ts otherwise), so user_ts - rx_ts is the time spent getting the packet to the application
+FIELDS = [('seq', '<u8'), ('tx_ts', '<i8'), ('rx_ts', '<i8'), ('size', '<u4'), ('source', '<u4'), ('user_ts', '<i8')]
+
+def RecordStruct(fields: list) -> struct.Struct:
+    """
+    Builds the struct for a record from its NumPy style field list.
+
+    Args:
+        fields (list): (name, dtype) pairs such as ('seq', '<u8').
+
+    Returns:
+        record (struct.Struct): The little endian struct for one record.
+    """
+
+    codes = {'u8': 'Q', 'i8': 'q', 'u4': 'I', 'i4': 'i', 'u2': 'H', 'i2': 'h', 'f8': 'd', 'f4': 'f'}
+    return struct.Struct('<' + ''.join(codes[t[1:]] for _, t in fields))
+
+RECORD = RecordStruct(FIELDS)
+
+class DelayLogWriter:
+    """
+    Writes a binary delay log: a JSON metadata header followed by fixed-width records that NumPy can memory-map.
+
+    Records are packed into a preallocated chunk and written a chunk at a time. The header is rewritten with the final
+    run metadata by Close().
+
+    Args:
+        path (str): The path of the log to create.
+        meta (dict): Run metadata known at the start (more can be added in Close()).
+        fields (list): The (name, dtype) pairs of a record.
+        chunk (int): The number of records buffered between writes.
+    """
+
+    def __init__(self, path: str, meta: dict = None, fields: list = FIELDS, chunk: int = 4096) -> None:
+        self.path = path
+        self.fields = fields
+        self.record = RecordStruct(fields)
+        self.meta = dict(meta or {})
+        self.count = 0
+
+        self.chunk = chunk
+        self.buf = bytearray(self.record.size * chunk)
+        self.pos = 0
+
+        self.fp = open(path, 'wb')
+        self.WriteHeader()
+
+    def WriteHeader(self) -> None:
+        """
+        Writes the preamble and JSON metadata into the reserved space at the start of the file.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        header = {
+            'version': VERSION,
+            'fields': self.fields,
+            'record_size': self.record.size,
+            'records': self.count,
+            'meta': self.meta,
+        }
+        text = json.dumps(header).encode()
+        if PREAMBLE.size + len(text) > HEADER_SIZE:
+            raise ValueError('Delay log metadata does not fit in ' + str(HEADER_SIZE) + ' byte header')
+
+        here = self.fp.tell()
+        self.fp.seek(0)
+        self.fp.write(PREAMBLE.pack(MAGIC, HEADER_SIZE, len(text)) + text + bytes(HEADER_SIZE - PREAMBLE.size - len(text)))
+        if here > HEADER_SIZE:
+            self.fp.seek(here)
+
+    def Write(self, *values) -> None:
+        """
+        Adds one record, e.g. Write(seq, tx_ts, rx_ts, size, source, user_ts) for the default fields.
+
+        Args:
+            values: One value per field.
+
+        Returns:
+            None
+        """
+
+        self.record.pack_into(self.buf, self.pos * self.record.size, *values)
+        self.pos = self.pos + 1
+        self.count = self.count + 1
+        if self.pos == self.chunk:
+            self.Flush()
+
+    def Flush(self) -> None:
+        """
+        Writes the buffered records to the file.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if self.pos:
+            self.fp.write(memoryview(self.buf)[:self.pos * self.record.size])
+            self.pos = 0
+
+    def WriteRecords(self, records) -> None:
+        """
+        Adds a whole NumPy array of records (with the same fields as the log) in one write.
+
+        Args:
+            records (numpy.ndarray): The records.
+
+        Returns:
+            None
+        """
+
+        self.Flush()
+        self.fp.write(records.tobytes())
+        self.count = self.count + len(records)
+
+    def Close(self, meta: dict = None) -> None:
+        """
+        Flushes the remaining records and rewrites the header with the record count and final metadata.
+
+        Args:
+            meta (dict): Run metadata to add to the header (PDR, packet rate, calibration, distance, etc.).
+
+        Returns:
+            None
+        """
+
+        self.Flush()
+        self.meta.update(meta or {})
+        self.WriteHeader()
+        self.fp.close()
+
+def ReadHeader(path: str) -> dict:
+    """
+    Reads the JSON header of a binary delay log.
+
+    Args:
+        path (str): The path of the log.
+
+    Returns:
+        header (dict): version, fields, record_size, records, meta, and header_size.
+    """
+
+    with open(path, 'rb') as fp:
+        magic, header_size, text_len = PREAMBLE.unpack(fp.read(PREAMBLE.size))
+        if magic != MAGIC:
+            raise ValueError(path + ' is not a binary delay log')
+        header = json.loads(fp.read(text_len))
+
+    header['header_size'] = header_size
+
+    # A run that was killed before Close() has a stale count, so trust the file size instead
+    header['records'] = (os.path.getsize(path) - header_size) // header['record_size']
+    return header
+
+def ReadDelayLog(path: str) -> tuple:
+    """
+    Memory-maps the records of a binary delay log as a NumPy structured array (nothing is parsed or copied).
+
+    Args:
+        path (str): The path of the log.
+
+    Returns:
+        meta (dict): The run metadata.
+        records (numpy.memmap): One record per packet, with the fields named in the header.
+    """
+
+    import numpy as np
+
+    header = ReadHeader(path)
+    dtype = np.dtype([(name, t) for name, t in header['fields']])
+    if header['records'] == 0:
+        return header['meta'], np.zeros(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode='r', offset=header['header_size'], shape=(header['records'],))
+    return header['meta'], records
+
+def MergeRecords(paths: list, key: str = 'rx_ts'):
+    """
+    Reads the records of several binary delay logs with the same fields (e.g. the shards written by receiver workers)
+    into one array ordered by [key].
+
+    Args:
+        paths (list): The paths of the logs.
+        key (str): The field to order the records by.
+
+    Returns:
+        fields (list): The (name, dtype) pairs of a record.
+        records (numpy.ndarray): Every record from every log.
+    """
+
+    import numpy as np
+
+    fields = [tuple(field) for field in ReadHeader(paths[0])['fields']]
+    parts = []
+    for path in paths:
+        if [tuple(field) for field in ReadHeader(path)['fields']] != fields:
+            raise ValueError(path + ' does not have the same record fields as ' + paths[0])
+        parts.append(ReadDelayLog(path)[1])
+
+    records = np.concatenate(parts)
+
+    # Stable so records with the same key keep the order they were written in
+    return fields, records[np.argsort(records[key], kind='stable')]
+
+def ReadTextLog(path: str) -> tuple:
+    """
+    Reads an old text delay log: one delay (s) per line, then pkt_tot, PDR, pkt_rate, calibration and distance, then
+    optional '# key: value' lines.
+
+    Args:
+        path (str): The path of the text log.
+
+    Returns:
+        meta (dict): The run metadata.
+        delays (list): The delays in seconds.
+    """
+
+    numbers = []
+    meta = {}
+    with open(path) as fp:
+        for line in fp:
+            x = line.strip()
+            if not x:
+                continue
+
+            # Loss and latency statistics are stored as '# key: value' lines
+            if x.startswith('#'):
+                key, value = x[1:].split(':', 1)
+                meta[key.strip()] = float(value)
+                continue
+
+            numbers.append(float(x))
+
+    # The five values the receiver appended after the delays
+    distance = numbers.pop()
+    meta['calibration'] = numbers.pop()
+    meta['pkt_rate'] = numbers.pop()
+    meta['pdr'] = numbers.pop()
+    meta['pkt_tot'] = numbers.pop()
+    meta['distance'] = distance
+
+    return meta, numbers
+
+def LoadDelays(path: str) -> tuple:
+    """
+    Loads the per-packet delays of a run from either a binary (.dlog) or text (.txt) delay log.
+
+    Args:
+        path (str): The path of the log.
+
+    Returns:
+        meta (dict): The run metadata.
+        delays (numpy.ndarray): The delays in seconds.
+    """
+
+    import numpy as np
+
+    if path.endswith('.txt'):
+        meta, delays = ReadTextLog(path)
+        return meta, np.array(delays)
+
+    meta, records = ReadDelayLog(path)
+
+    # Echo logs (see echo.py) hold round trips, taken as twice the one-way delay
+    if 't4' in records.dtype.names:
+        delays = ((records['t4'] - records['t1']) - (records['t3'] - records['t2'])) / 2e9
+        return meta, delays
+
+    # Delay is the time between the transmit and receive stamps less whatever offset the receiver was told to remove
+    delays = (records['rx_ts'] - records['tx_ts']) / 1e9 - meta.get('delay_offset', 0)
+    return meta, delays
+
+def ConvertTextLog(path: str) -> str:
+    """
+    Converts an old text delay log into a binary delay log next to it.
+
+    Only the delays survive in a text log, so each record holds seq = line number, tx_ts = 0, and rx_ts = the delay
+    in ns (already calibrated, so delay_offset is 0).
+
+    Args:
+        path (str): The path of the text log.
+
+    Returns:
+        out_path (str): The path of the new binary log.
+    """
+
+    meta, delays = ReadTextLog(path)
+    meta['converted_from'] = os.path.basename(path)
+    meta['delay_offset'] = 0
+
+    out_path = os.path.splitext(path)[0] + '.dlog'
+    log = DelayLogWriter(out_path, meta)
+    for i, delay in enumerate(delays):
+        log.Write(i, 0, round(delay * 1e9), 0, 0, round(delay * 1e9))
+    log.Close()
+
+    return out_path
+
+def ConvertTextLogs(name: str = None) -> None:
+    """
+    Converts ./Logging/Delay/[name].txt, or every text log without a binary version if no name is given.
+
+    Args:
+        name (str): The name of the log to convert.
+
+    Returns:
+        None
+    """
+
+    if name is not None:
+        paths = ['./Logging/Delay/' + name + '.txt']
+    else:
+        paths = [p for p in sorted(glob.glob('./Logging/Delay/delay_log_*.txt')) if not os.path.exists(os.path.splitext(p)[0] + '.dlog')]
+
+    for path in paths:
+        print('Converted ' + path + ' -> ' + ConvertTextLog(path))
+
+# String for help command
+cv_str = ("""
+====================
+  ConvertTextLogs()
+====================
+
+Converts ./Logging/Delay/[name].txt, or every text log without a binary version if no name is given.
+
+Args:
+    name (str): The name of the log to convert.
+
+Returns:
+    None
+
+==============================================================
+
+Binary delay log ([name].dlog):
+
++-------------------------------+----------------------------------------------+
+| 'CV2XDLOG' | header size | len | JSON {version, fields, records, meta}  ... |  4096 bytes
++-------------------------------+----------------------------------------------+
+| seq u8 | tx_ts i8 (ns) | rx_ts i8 (ns) | size u4 | source u4 | user_ts i8 (ns) |  40 bytes
+| ...                                                                          |  per packet
++------------------------------------------------------------------------------+
+
+delay (s) = (rx_ts - tx_ts) / 1e9 - meta['delay_offset']
+application overhead (s) = (user_ts - rx_ts) / 1e9  (0 unless the receiver used kernel timestamps)
+
+Version 1 logs have no user_ts; the fields in the header say which layout a log has.
+
+import numpy as np, delaylog as dl
+meta, records = dl.ReadDelayLog('./Logging/Delay/[name].dlog')
+
+==============================================================
+""")
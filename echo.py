@@ -0,0 +1,392 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Echo Tools
+'''
+import time
+import math
+import socket
+import struct
+import datetime
+import threading
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import utilities as ut
+import packet as pk
+import pacing as pc
+import sockio as so
+import stats as st
+import delaylog as dl
+import console as co
+import transmit as tx
+import receive as rx
+import bench as bm
+
+# flags, source, seq, tx_time from the header of an echoed packet in one unpack (starting at pk.FLAGS_OFFSET)
+ECHO_HEADER = struct.Struct('!BIIq')
+
+# One record per echo: t1 sent and t4 received on the pinger clock, t2 received and t3 sent on the reflector clock
+ECHO_FIELDS = [('seq', '<u8'), ('t1', '<i8'), ('t2', '<i8'), ('t3', '<i8'), ('t4', '<i8'), ('size', '<u4'), ('source', '<u4')]
+
+def ReflectPackets(listen_addr: str, listen_port: int, reply_addr: str = None, reply_port: int = None, batch: int = 64, kernel_ts: bool = False,
+                   verbosity: int = co.NORMAL) -> None:
+    """
+    Sends every packet received on [listen_addr]:[listen_port] back with its own receive and transmit times appended.
+
+    Args:
+        listen_addr (str): The address to receive packets on.
+        listen_port (int): The port to receive packets on.
+        reply_addr (str): Where to send the echoes (e.g. this PC's MK6), defaults to the sender of each packet.
+        reply_port (int): The port to send the echoes to, defaults to the sender's port.
+        batch (int): The most datagrams drained from the socket with a single recvmmsg() call.
+        kernel_ts (bool): Take the receive time from the kernel (SO_TIMESTAMPNS, Linux).
+        verbosity (int): 0 prints only the final count, 1 adds a summary every second.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    Pinger                                                  Reflector
+    +--------------+  t1  [acme at 5.9GHz or loopback]  t2  +-----------+
+    | ep           |------------------------------------->| er        |
+    |              |<-------------------------------------|           |
+    +--------------+  t4          pkt + (t2, t3)        t3  +-----------+
+
+    1. Bind a UDP socket to [listen_addr]:[listen_port] and drain it in batches into preallocated buffers.
+    2. Stamp the receive time t2 (from the kernel with [kernel_ts]).
+    3. Set the echo flag and append (t2, t3) to the packet in its own buffer, stamping t3 just before sending.
+    4. Send it back to the sender, or to [reply_addr]:[reply_port] when replying through an MK6.
+
+    ==============================================================
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 3_000_000)
+    sock.bind((listen_addr, listen_port))
+
+    # Room after every packet for the echo times
+    receiver = so.BatchReceiver(sock, batch, pk.MAX_PKT_SIZE, kernel_ts)
+
+    console = co.Console(verbosity)
+    echo_cnt = 0
+    bad_cnt = 0
+    drop_cnt = 0
+    last_report_cnt = 0
+
+    print('\nReflecting packets on ' + listen_addr + ':' + str(listen_port) + ' (Ctrl+C to stop)\n')
+
+    try:
+        while True:
+            pkt_n = receiver.Recv(1.0)
+            user_time = time.time_ns()
+
+            for i in range(pkt_n):
+                size = len(receiver.pkts[i])
+                buf = receiver.bufs[i]
+
+                # Only CV2X packets with room for the times are echoed (checked without slicing the packet)
+                if (size < pk.HEADER.size) or (size + pk.ECHO.size > len(buf)) or (buf[0] != pk.MAGIC[0]) or (buf[1] != pk.MAGIC[1]):
+                    bad_cnt = bad_cnt + 1
+                    continue
+
+                # Receive time from the kernel when it gave one
+                t2 = receiver.stamps[i] or user_time
+
+                buf[pk.FLAGS_OFFSET] = buf[pk.FLAGS_OFFSET] | pk.FLAG_ECHO
+                pk.ECHO.pack_into(buf, size, t2, time.time_ns())
+
+                # Back to the sender, or to the MK6 on the sender's port unless [reply_port] was given
+                if reply_addr is None:
+                    dest = receiver.Address(i)
+                else:
+                    dest = (reply_addr, reply_port or receiver.Address(i)[1])
+                try:
+                    sock.sendto(receiver.views[i][:size + pk.ECHO.size], dest)
+                    echo_cnt = echo_cnt + 1
+                except BlockingIOError:
+                    # Send buffer is full, the pinger counts this as loss
+                    drop_cnt = drop_cnt + 1
+
+            if console.Due():
+                console.Log(co.NORMAL, '[Echo] %d pkts (%.0f pkts/s), %d bad, %d dropped', echo_cnt, (echo_cnt - last_report_cnt) / console.period, bad_cnt, drop_cnt)
+                last_report_cnt = echo_cnt
+
+    except KeyboardInterrupt:
+        console.Log(co.QUIET, '\nEchoed %d packets (%d bad, %d dropped)', echo_cnt, bad_cnt, drop_cnt)
+
+    console.Close()
+    sock.close()
+
+class EchoCollector(threading.Thread):
+    """
+    Receives the echoes of a ping run and streams them into a binary log, keeping round trip and offset statistics.
+
+    For each echo, with t1/t4 on the pinger clock and t2/t3 on the reflector clock (NTP on-wire calculation):
+        delay  = (t4 - t1) - (t3 - t2)         round trip on the network, the reflector's turnaround taken out
+        offset = ((t2 - t1) + (t3 - t4)) / 2   reflector clock - pinger clock, exact if both directions take as long
+
+    Args:
+        receiver (BatchReceiver): Drains the pinger socket.
+        log (DelayLogWriter): Where every echo is logged (with ECHO_FIELDS).
+        console (Console): Where progress is printed.
+        pkt_tot (int): The number of pings sent, -1 until Ctrl+C.
+        drain_timeout (float): How long to wait for stragglers once every ping is sent.
+    """
+
+    def __init__(self, receiver: so.BatchReceiver, log: dl.DelayLogWriter, console: co.Console, pkt_tot: int, drain_timeout: float = 1.0) -> None:
+        super().__init__(daemon=True)
+        self.receiver = receiver
+        self.log = log
+        self.console = console
+        self.pkt_tot = pkt_tot
+        self.drain_timeout = drain_timeout
+        self.sent = threading.Event()
+
+        self.tracker = st.SequenceTracker(base=0)
+        self.rtt = st.LatencyHistogram()
+        self.bad = 0
+
+        # Offset of the echo with the smallest delay (the one least skewed by queueing), and running sums for the mean
+        self.best_delay = None
+        self.best_offset = 0.0
+        self.offset_sums = [0, 0.0, 0.0]
+
+    def run(self) -> None:
+        receiver = self.receiver
+        tracker = self.tracker
+        last_report_cnt = 0
+
+        while (tracker.received < self.pkt_tot) or (self.pkt_tot == -1):
+
+            # Poll briefly while pings are going out, then wait [drain_timeout] for the last echoes
+            pkt_n = receiver.Recv(self.drain_timeout if self.sent.is_set() else 0.1)
+            if pkt_n == 0:
+                if self.sent.is_set():
+                    break
+                continue
+            user_time = time.time_ns()
+
+            for i in range(pkt_n):
+                pkt = receiver.pkts[i]
+                size = len(pkt)
+                if (size < pk.HEADER.size + pk.ECHO.size) or (pkt[0] != pk.MAGIC[0]) or (pkt[1] != pk.MAGIC[1]):
+                    self.bad = self.bad + 1
+                    continue
+
+                flags, source, seq, t1 = ECHO_HEADER.unpack_from(pkt, pk.FLAGS_OFFSET)
+                if not (flags & pk.FLAG_ECHO):
+                    self.bad = self.bad + 1
+                    continue
+                t2, t3 = pk.ECHO.unpack_from(pkt, size - pk.ECHO.size)
+                t4 = receiver.stamps[i] or user_time
+
+                if tracker.Record(seq) >= st.DUPLICATE:
+                    continue
+
+                delay = (t4 - t1) - (t3 - t2)
+                offset = ((t2 - t1) + (t3 - t4)) / 2
+                self.rtt.Record(max(0, round(delay / 1e3)))
+                if (self.best_delay is None) or (delay < self.best_delay):
+                    self.best_delay = delay
+                    self.best_offset = offset
+                self.offset_sums[0] = self.offset_sums[0] + 1
+                self.offset_sums[1] = self.offset_sums[1] + offset
+                self.offset_sums[2] = self.offset_sums[2] + offset * offset
+
+                # Packed into the log's preallocated chunk, nothing is kept per echo
+                self.log.Write(seq, t1, t2, t3, t4, size, source)
+
+            if self.console.Due():
+                self.console.Log(co.NORMAL, '[Ping] %d echoes (%.0f pkts/s), rtt %s', tracker.received, (tracker.received - last_report_cnt) / self.console.period,
+                                 self.rtt.Summary())
+                last_report_cnt = tracker.received
+
+    def Offset(self) -> tuple:
+        """
+        Gives the clock offset estimates in seconds.
+
+        Args:
+            None
+
+        Returns:
+            best (float): The offset of the echo with the smallest delay.
+            mean (float): The mean offset over every echo.
+            std (float): The standard deviation of the offsets.
+        """
+
+        n, total, total_sq = self.offset_sums
+        if n == 0:
+            return 0.0, 0.0, 0.0
+        mean = total / n
+        return self.best_offset / 1e9, mean / 1e9, math.sqrt(max(0.0, total_sq / n - mean * mean)) / 1e9
+
+def PingPackets(dest_addr: str, dest_port: int, pkt_rate: int, pkt_tot: int, size: int = 0, listen_port: int = 0, pacer: str = 'hybrid', burst: int = 1,
+                batch: int = 1, kernel_ts: bool = False, verbosity: int = co.NORMAL) -> None:
+    """
+    Sends [pkt_tot] pings at [pkt_rate] pkts/s to a reflector at [dest_addr]:[dest_port] and measures the round trip and
+    clock offset of every echo, without any calibration.
+
+    Args:
+        dest_addr (str): The reflector (or this PC's MK6).
+        dest_port (int): The port to send the pings to.
+        pkt_rate (int): The number of pings per second.
+        pkt_tot (int): The number of pings to send. -1 pings until Ctrl+C.
+        size (int): The payload size in bytes.
+        listen_port (int): The port the echoes come back to, defaults to any free port.
+        pacer (str): The rate control to use (see pacing.py).
+        burst (int): The bucket size or packets per burst for the pacer.
+        batch (int): The batch size for sendmmsg()/recvmmsg().
+        kernel_ts (bool): Take the echo receive time from the kernel (SO_TIMESTAMPNS, Linux).
+        verbosity (int): 0 prints only the final results, 1 adds a summary every second.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    Pinger                                                  Reflector
+    +--------------+  t1  [acme at 5.9GHz or loopback]  t2  +-----------+
+    | ep           |------------------------------------->| er        |
+    |              |<-------------------------------------|           |
+    +--------------+  t4          pkt + (t2, t3)        t3  +-----------+
+
+    1. Bind a UDP socket to [listen_port] for both the pings and their echoes.
+    2. Send [pkt_tot] pings stamped with t1 at [pkt_rate], paced by [pacer] (the send loop of tx).
+    3. Receive the echoes on a background thread, stamping t4 (from the kernel with [kernel_ts]).
+    4. Compute the round trip (t4 - t1) - (t3 - t2) and the offset ((t2 - t1) + (t3 - t4)) / 2 of every echo.
+    5. Stream (seq, t1, t2, t3, t4) into ./Logging/Delay/echo_log_[date].dlog from a preallocated chunk.
+    6. Report loss, the round trip distribution, and the offset of the fastest echo (and the mean offset).
+
+    ==============================================================
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 3_000_000)
+    sock.bind(('', listen_port))
+
+    receiver = so.BatchReceiver(sock, max(batch, 16), pk.MAX_PKT_SIZE, kernel_ts)
+
+    # Pings are stamped with the plain PC clock, the reflector's clock is measured rather than calibrated
+    calibrator = ut.ClockCalibrator('log.txt', 0)
+    labels = bm.FixedLabels(bm.MakeLabels(size))
+    pacer = pc.MakePacer(pacer, pkt_rate, burst)
+    console = co.Console(verbosity)
+
+    now = datetime.datetime.now()
+    path = './Logging/Delay/echo_log_' + now.strftime("%Y_%m_%d_%H_%M_%S_%p") + '.dlog'
+    log = dl.DelayLogWriter(path, {'start_time': now.isoformat(), 'echo': True, 'size': size}, ECHO_FIELDS)
+
+    collector = EchoCollector(receiver, log, console, pkt_tot)
+    collector.start()
+
+    print('\nPinging ' + dest_addr + ':' + str(dest_port) + '...\n')
+
+    sent = 0
+    try:
+        sent = tx.SendPackets(sock, (dest_addr, dest_port), pkt_rate, pkt_tot, labels, calibrator, 0, [0, 0], pacer, console, batch)
+    except KeyboardInterrupt:
+        console.Log(co.QUIET, 'Interrupted')
+        sent = pacer.Report()['sent']
+
+    collector.sent.set()
+    collector.join()
+
+    loss = collector.tracker.Finalize(sent)
+    best, mean, std = collector.Offset()
+
+    console.Log(co.QUIET, '\nEchoes received: %d of %d (lost %d)\n', loss['received'], sent, loss['lost'])
+    if collector.bad > 0:
+        console.Log(co.QUIET, 'Bad Packets: %d\n', collector.bad)
+    console.Log(co.QUIET, 'Round trip: %s\n', collector.rtt.Summary())
+    console.Log(co.QUIET, 'Reflector - pinger clock offset: %.3f ms at the fastest echo, mean %.3f ms (std %.3f ms)\n', best * 1e3, mean * 1e3, std * 1e3)
+    console.Log(co.QUIET, pacer.Summary() + '\n')
+
+    # One-way delay is half the round trip, so the log plots like a receiver log
+    meta = rx.LogMeta(loss, collector.rtt.Report(0.5e-3), pkt_rate, 0, 0)
+    meta.update({'rtt_' + key: value / 1000 for key, value in collector.rtt.Report(1e-3).items() if key != 'count'})
+    meta.update({'offset': best, 'offset_mean': mean, 'offset_std': std})
+    log.Close(meta)
+
+    console.Log(co.QUIET, 'Log written to %s', path)
+    console.Close()
+    sock.close()
+
+# String for help command
+er_str = ("""
+====================
+  ReflectPackets()
+====================
+
+Sends every packet received on [listen_addr]:[listen_port] back with its own receive and transmit times appended.
+
+Args:
+    listen_addr (str): The address to receive packets on.
+    listen_port (int): The port to receive packets on.
+    reply_addr (str): Where to send the echoes (e.g. this PC's MK6), defaults to the sender of each packet.
+    reply_port (int): The port to send the echoes to, defaults to the sender's port.
+    batch (int): The most datagrams drained from the socket with a single recvmmsg() call.
+    kernel_ts (bool): Take the receive time from the kernel (SO_TIMESTAMPNS, Linux).
+    verbosity (int): 0 prints only the final count, 1 adds a summary every second.
+
+Returns:
+    None
+
+==============================================================
+
+Pinger                                                  Reflector
++--------------+  t1  [acme at 5.9GHz or loopback]  t2  +-----------+
+| ep           |------------------------------------->| er        |
+|              |<-------------------------------------|           |
++--------------+  t4          pkt + (t2, t3)        t3  +-----------+
+
+1. Bind a UDP socket to [listen_addr]:[listen_port] and drain it in batches into preallocated buffers.
+2. Stamp the receive time t2 (from the kernel with [kernel_ts]).
+3. Set the echo flag and append (t2, t3) to the packet in its own buffer, stamping t3 just before sending.
+4. Send it back to the sender, or to [reply_addr]:[reply_port] when replying through an MK6.
+
+==============================================================
+""")
+
+ep_str = ("""
+=================
+  PingPackets()
+=================
+
+Sends [pkt_tot] pings at [pkt_rate] pkts/s to a reflector at [dest_addr]:[dest_port] and measures the round trip and
+clock offset of every echo, without any calibration.
+
+Args:
+    dest_addr (str): The reflector (or this PC's MK6).
+    dest_port (int): The port to send the pings to.
+    pkt_rate (int): The number of pings per second.
+    pkt_tot (int): The number of pings to send. -1 pings until Ctrl+C.
+    size (int): The payload size in bytes.
+    listen_port (int): The port the echoes come back to, defaults to any free port.
+    pacer (str): The rate control to use (see pacing.py).
+    burst (int): The bucket size or packets per burst for the pacer.
+    batch (int): The batch size for sendmmsg()/recvmmsg().
+    kernel_ts (bool): Take the echo receive time from the kernel (SO_TIMESTAMPNS, Linux).
+    verbosity (int): 0 prints only the final results, 1 adds a summary every second.
+
+Returns:
+    None
+
+==============================================================
+
+Pinger                                                  Reflector
++--------------+  t1  [acme at 5.9GHz or loopback]  t2  +-----------+
+| ep           |------------------------------------->| er        |
+|              |<-------------------------------------|           |
++--------------+  t4          pkt + (t2, t3)        t3  +-----------+
+
+1. Bind a UDP socket to [listen_port] for both the pings and their echoes.
+2. Send [pkt_tot] pings stamped with t1 at [pkt_rate], paced by [pacer] (the send loop of tx).
+3. Receive the echoes on a background thread, stamping t4 (from the kernel with [kernel_ts]).
+4. Compute the round trip (t4 - t1) - (t3 - t2) and the offset ((t2 - t1) + (t3 - t4)) / 2 of every echo.
+5. Stream (seq, t1, t2, t3, t4) into ./Logging/Delay/echo_log_[date].dlog from a preallocated chunk.
+6. Report loss, the round trip distribution, and the offset of the fastest echo (and the mean offset).
+
+==============================================================
+""")
@@ -0,0 +1,442 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Emulation Tools
+'''
+import time
+import heapq
+import random
+import socket
+import threading
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import sockio as so
+import stats as st
+import console as co
+
+# Packets due within this many ns are waited for by spinning, poll() only wakes up to the nearest millisecond
+SPIN_NS = 1_000_000
+
+class DelayModel:
+    """
+    One-way delay added to every packet: a base [delay] plus jitter drawn from [dist].
+
+    Args:
+        delay (float): The base delay in ms.
+        jitter (float): The spread in ms (half width for 'uniform', standard deviation for 'normal', mean extra delay
+                        for 'exp' and 'pareto').
+        dist (str): 'const', 'uniform', 'normal', 'exp', or 'pareto' (heavy tailed).
+        rng (random.Random): The random number generator to draw from.
+    """
+
+    # Shape of the Pareto tail, its mean extra delay is scaled to [jitter]
+    PARETO_ALPHA = 3.0
+
+    def __init__(self, delay: float, jitter: float = 0.0, dist: str = 'normal', rng: random.Random = None) -> None:
+        self.delay = delay * 1e6
+        self.jitter = jitter * 1e6
+        self.dist = dist
+        self.rng = rng or random.Random()
+
+        samplers = {
+            'const': lambda: self.delay,
+            'uniform': lambda: self.delay + self.rng.uniform(-self.jitter, self.jitter),
+            'normal': lambda: self.rng.gauss(self.delay, self.jitter),
+            'exp': lambda: self.delay + self.rng.expovariate(1 / self.jitter) if self.jitter > 0 else self.delay,
+            'pareto': lambda: self.delay + self.jitter * (self.PARETO_ALPHA - 1) * (self.rng.paretovariate(self.PARETO_ALPHA) - 1),
+        }
+        if dist not in samplers:
+            raise ValueError('Unknown delay distribution ' + repr(dist) + ', use one of ' + ', '.join(samplers))
+        self.sampler = samplers[dist]
+
+    def Sample(self) -> int:
+        """
+        Draws the delay for one packet.
+
+        Args:
+            None
+
+        Returns:
+            delay (int): The delay in ns (never negative).
+        """
+
+        return max(0, int(self.sampler()))
+
+class GilbertElliott:
+    """
+    Two-state burst loss: packets are lost in the bad state and delivered in the good state, with the transition
+    probabilities chosen to give an average loss of [loss] in bursts of [burst] packets on average.
+
+    Args:
+        loss (float): The long run fraction of packets lost (0 to 1).
+        burst (float): The mean length of a loss burst in packets (1 gives independent losses).
+        rng (random.Random): The random number generator to draw from.
+    """
+
+    def __init__(self, loss: float, burst: float = 1.0, rng: random.Random = None) -> None:
+        if not 0 <= loss < 1:
+            raise ValueError('Loss must be at least 0 and less than 1')
+        self.rng = rng or random.Random()
+
+        # Leaving the bad state ends a burst, entering it is set so the bad state holds [loss] of the time
+        self.p_bg = 1 / max(1.0, burst)
+        self.p_gb = loss * self.p_bg / (1 - loss)
+        self.bad = False
+
+    def Lost(self) -> bool:
+        """
+        Steps the channel for one packet.
+
+        Args:
+            None
+
+        Returns:
+            lost (bool): Whether the packet is dropped.
+        """
+
+        if self.bad:
+            if self.rng.random() < self.p_bg:
+                self.bad = False
+        elif self.rng.random() < self.p_gb:
+            self.bad = True
+        return self.bad
+
+class FakeLog(threading.Thread):
+    """
+    Background thread standing in for the MK6 PuTTY log: appends '$EPOCHREALTIME' lines like the MK6 calibration
+    command, with kinematics-sample-client output in between, so calibration and GetCoords() work without hardware.
+
+    Args:
+        path (str): The log to write.
+        offset (float): The PC - GNSS offset the fake GNSS clock starts at, in seconds.
+        drift (float): How fast the offset changes, in ppm.
+        latitude (float): The latitude reported in the kinematics output.
+        longitude (float): The longitude reported in the kinematics output.
+        period (float): Seconds between time lines (the MK6 command sleeps 1 ms).
+        kinematics_every (int): Time lines between kinematics output (GetCoords() looks at the last 30 lines).
+        max_size (int): The log is started over once it grows past this many bytes.
+    """
+
+    def __init__(self, path: str = 'log.txt', offset: float = 0.0, drift: float = 0.0, latitude: float = 43.0731, longitude: float = -89.4012,
+                 period: float = 0.001, kinematics_every: int = 20, max_size: int = 64_000_000) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self.offset = offset
+        self.drift = drift * 1e-6
+        self.latitude = latitude
+        self.longitude = longitude
+        self.period = period
+        self.kinematics_every = kinematics_every
+        self.max_size = max_size
+
+        self.lines = 0
+        self.stop = threading.Event()
+
+    def Kinematics(self) -> bytes:
+        """
+        Formats a block of kinematics output.
+
+        Args:
+            None
+
+        Returns:
+            block (bytes): The lines, as the MK6 prints them.
+        """
+
+        return ('latitude               - %.7f\r\n'
+                'longitude              - %.7f\r\n'
+                'altitude               - 270.00\r\n'
+                'heading                - 0.00\r\n'
+                'speed                  - 0.00\r\n' % (self.latitude, self.longitude)).encode()
+
+    def run(self) -> None:
+        start = time.time()
+        deadline = time.monotonic()
+        f = open(self.path, 'wb', buffering=0)
+        try:
+            while not self.stop.is_set():
+                pc_time = time.time()
+                gnss_time = pc_time - self.offset - self.drift * (pc_time - start)
+
+                # The time line goes last in the same write, so a reader never sees kinematics as the last line
+                data = b''
+                if self.lines % self.kinematics_every == 0:
+                    data = self.Kinematics()
+                data = data + ('%.6f\r\n' % (gnss_time)).encode()
+                f.write(data)
+                self.lines = self.lines + 1
+
+                if f.tell() > self.max_size:
+                    f.close()
+                    f = open(self.path, 'wb', buffering=0)
+
+                deadline = deadline + self.period
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    deadline = time.monotonic()
+        finally:
+            f.close()
+
+    def Stop(self) -> None:
+        """
+        Stops writing and waits for the thread to finish.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.stop.set()
+        if self.is_alive():
+            self.join()
+
+def FakeLogDialogue(path: str = 'log.txt', offset: float = 0.0, drift: float = 0.0, latitude: float = 43.0731, longitude: float = -89.4012) -> None:
+    """
+    Writes a fake MK6 log at [path] until Ctrl+C.
+
+    Args:
+        path (str): The log to write.
+        offset (float): The PC - GNSS offset the fake GNSS clock starts at, in seconds.
+        drift (float): How fast the offset changes, in ppm.
+        latitude (float): The latitude reported in the kinematics output.
+        longitude (float): The longitude reported in the kinematics output.
+
+    Returns:
+        None
+    """
+
+    fake_log = FakeLog(path, offset, drift, latitude, longitude)
+    fake_log.start()
+    print('\nWriting fake MK6 log to ' + path + ' (Ctrl+C to stop)...\n')
+    try:
+        while fake_log.is_alive():
+            fake_log.join(1)
+    except KeyboardInterrupt:
+        pass
+    fake_log.Stop()
+    print('Wrote ' + str(fake_log.lines) + ' time lines')
+
+def RelayPackets(listen_addr: str, listen_port: int, dest_addr: str, dest_port: int, delay: float = 0.0, jitter: float = 0.0, dist: str = 'normal',
+                 loss: float = 0.0, burst: float = 1.0, dup: float = 0.0, reorder: float = 0.0, reorder_delay: float = 1.0, seed: int = None,
+                 batch: int = 64, verbosity: int = co.NORMAL) -> None:
+    """
+    Relay UDP packets arriving on [listen_addr]:[listen_port] to [dest_addr]:[dest_port], standing in for the two MK6s
+    and the radio link between them.
+
+    Args:
+        listen_addr (str): The address the transmitter sends to.
+        listen_port (int): The port the transmitter sends to.
+        dest_addr (str): The address the receiver listens on.
+        dest_port (int): The port the receiver listens on.
+        delay (float): The base one-way delay in ms.
+        jitter (float): The delay spread in ms (see DelayModel).
+        dist (str): The delay distribution: 'const', 'uniform', 'normal', 'exp', or 'pareto'.
+        loss (float): The fraction of packets lost (0 to 1).
+        burst (float): The mean number of packets lost in a row (Gilbert-Elliott, 1 is independent loss).
+        dup (float): The fraction of packets delivered twice.
+        reorder (float): The fraction of packets held back by an extra [reorder_delay] so they arrive out of order.
+        reorder_delay (float): The extra delay in ms for reordered packets.
+        seed (int): Seeds the random number generator so a run can be repeated.
+        batch (int): The most datagrams drained from the socket with a single recvmmsg() call.
+        verbosity (int): 0 prints only the final results, 1 adds a summary every second.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    TX                  Relay                           RX
+    +----+ listen_port  +----------------------------+  +----+
+    | PC |------------->| delay, jitter, loss, dup,  |->| PC |
+    +----+              | reorder (emulated MK6 link)|  +----+
+                        +----------------------------+  dest_port
+
+    1. Bind a UDP socket to [listen_addr]:[listen_port].
+    2. Drop packets with Gilbert-Elliott burst loss, then give each survivor a delay from the [dist] distribution.
+    3. Duplicate and hold back packets at random to emulate duplication and reordering.
+    4. Send every packet on to [dest_addr]:[dest_port] when its delay is up (held in a time-ordered heap).
+    5. Report what was done to the packets and how late they were released.
+
+    ==============================================================
+    """
+
+    rng = random.Random(seed)
+    delay_model = DelayModel(delay, jitter, dist, rng)
+    channel = GilbertElliott(loss, burst, rng)
+    reorder_ns = int(reorder_delay * 1e6)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    sock.bind((listen_addr, listen_port))
+    receiver = so.BatchReceiver(sock, batch, 65536)
+
+    # Sending from a second socket keeps 'port unreachable' errors (receiver not started yet) off the receive side, and
+    # non-blocking so a full send buffer shows up as an overflow rather than a stall
+    out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    out.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 3_000_000)
+    out.setblocking(False)
+    dest = (dest_addr, dest_port)
+
+    # Packets waiting for their delay as (release time ns, arrival order, data)
+    pending = []
+    order = 0
+
+    # What happened to the packets, and how late after their release time they went out (us)
+    received = 0
+    sent = 0
+    dropped = 0
+    duplicated = 0
+    reordered = 0
+    overflow = 0
+    refused = 0
+    queue_max = 0
+    lateness = st.LatencyHistogram()
+    last_report_cnt = 0
+
+    # Printing happens on a background thread so the terminal can not hold up the relay
+    console = co.Console(verbosity)
+
+    print('\nRelaying ' + listen_addr + ':' + str(listen_port) + ' -> ' + dest_addr + ':' + str(dest_port) + ' (Ctrl+C to stop)...\n')
+
+    try:
+        while True:
+
+            # Send everything that is due
+            now = time.perf_counter_ns()
+            while pending and pending[0][0] <= now:
+                release, _, data = heapq.heappop(pending)
+                try:
+                    out.sendto(data, dest)
+                    sent = sent + 1
+                except BlockingIOError:
+                    overflow = overflow + 1
+                except ConnectionRefusedError:
+                    refused = refused + 1
+                lateness.Record((now - release) // 1000)
+
+            # Wait for new packets until the next one is due, spinning when that is too soon for poll()
+            if not pending:
+                timeout = 0.1
+            elif pending[0][0] - now > SPIN_NS:
+                timeout = (pending[0][0] - now - SPIN_NS) / 1e9
+            else:
+                timeout = 0
+            pkt_n = receiver.Recv(timeout)
+
+            now = time.perf_counter_ns()
+            for i in range(pkt_n):
+                received = received + 1
+                if channel.Lost():
+                    dropped = dropped + 1
+                    continue
+
+                # The receive buffers are reused by the next Recv(), so the packet is copied out
+                data = bytes(receiver.pkts[i])
+                copies = 1
+                if (dup > 0) and (rng.random() < dup):
+                    duplicated = duplicated + 1
+                    copies = 2
+
+                for _ in range(copies):
+                    release = now + delay_model.Sample()
+                    if (reorder > 0) and (rng.random() < reorder):
+                        reordered = reordered + 1
+                        release = release + reorder_ns
+                    heapq.heappush(pending, (release, order, data))
+                    order = order + 1
+
+            if len(pending) > queue_max:
+                queue_max = len(pending)
+
+            if console.Due():
+                console.Log(co.NORMAL, '[Relay] %d pkts (%.0f pkts/s), dropped %d, duplicated %d, reordered %d, queued %d, release lateness %s',
+                            received, (received - last_report_cnt) / console.period, dropped, duplicated, reordered, len(pending), lateness.Summary(1, 'us'))
+                last_report_cnt = received
+
+    except KeyboardInterrupt:
+        console.Log(co.QUIET, 'Interrupted')
+
+    console.Log(co.QUIET, '\nReceived: %d, Sent: %d, Dropped: %d, Duplicated: %d, Reordered: %d, Send Overflows: %d, Refused: %d, Unsent: %d\n',
+                received, sent, dropped, duplicated, reordered, overflow, refused, len(pending))
+    console.Log(co.QUIET, 'Most Packets Held: %d\n', queue_max)
+    console.Log(co.QUIET, 'Release Lateness: %s\n', lateness.Summary(1, 'us'))
+    console.Close()
+    out.close()
+    sock.close()
+
+# String for help command
+em_str = ("""
+==================
+  RelayPackets()
+==================
+
+Relay UDP packets arriving on [listen_addr]:[listen_port] to [dest_addr]:[dest_port], standing in for the two MK6s
+and the radio link between them.
+
+Args:
+    listen_addr (str): The address the transmitter sends to.
+    listen_port (int): The port the transmitter sends to.
+    dest_addr (str): The address the receiver listens on.
+    dest_port (int): The port the receiver listens on.
+    delay (float): The base one-way delay in ms.
+    jitter (float): The delay spread in ms (see DelayModel).
+    dist (str): The delay distribution: 'const', 'uniform', 'normal', 'exp', or 'pareto'.
+    loss (float): The fraction of packets lost (0 to 1).
+    burst (float): The mean number of packets lost in a row (Gilbert-Elliott, 1 is independent loss).
+    dup (float): The fraction of packets delivered twice.
+    reorder (float): The fraction of packets held back by an extra [reorder_delay] so they arrive out of order.
+    reorder_delay (float): The extra delay in ms for reordered packets.
+    seed (int): Seeds the random number generator so a run can be repeated.
+    batch (int): The most datagrams drained from the socket with a single recvmmsg() call.
+    verbosity (int): 0 prints only the final results, 1 adds a summary every second.
+
+Returns:
+    None
+
+==============================================================
+
+TX                  Relay                           RX
++----+ listen_port  +----------------------------+  +----+
+| PC |------------->| delay, jitter, loss, dup,  |->| PC |
++----+              | reorder (emulated MK6 link)|  +----+
+                    +----------------------------+  dest_port
+
+1. Bind a UDP socket to [listen_addr]:[listen_port].
+2. Drop packets with Gilbert-Elliott burst loss, then give each survivor a delay from the [dist] distribution.
+3. Duplicate and hold back packets at random to emulate duplication and reordering.
+4. Send every packet on to [dest_addr]:[dest_port] when its delay is up (held in a time-ordered heap).
+5. Report what was done to the packets and how late they were released.
+
+==============================================================
+""")
+
+# String for help command
+fl_str = ("""
+=====================
+  FakeLogDialogue()
+=====================
+
+Writes a fake MK6 log at [path] until Ctrl+C.
+
+Args:
+    path (str): The log to write.
+    offset (float): The PC - GNSS offset the fake GNSS clock starts at, in seconds.
+    drift (float): How fast the offset changes, in ppm.
+    latitude (float): The latitude reported in the kinematics output.
+    longitude (float): The longitude reported in the kinematics output.
+
+Returns:
+    None
+
+==============================================================
+
+1. Append the fake GNSS time to [path] every millisecond, like the MK6 calibration command:
+   while [ 1 ] ; do echo $EPOCHREALTIME ; sleep 0.001; done
+2. Every 20 lines, append kinematics-sample-client output for [latitude], [longitude] first.
+3. Start the log over once it gets large.
+
+==============================================================
+""")
@@ -0,0 +1,228 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Live Stats Tools
+'''
+import time
+import array
+import numpy as np
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import stats as st
+
+# Four bytes at the start of the segment so a reader does not attach to something else
+MAGIC = b'CVLS'
+
+# Layout version, bump whenever STATS or the ring changes
+VERSION = 1
+
+# Rolling statistics at the start of the segment, rewritten every period (delays in us).
+# seq is a sequence lock: odd while the receiver is writing, so a reader knows to try again
+STATS = np.dtype([('magic', 'S4'), ('version', '<u4'), ('seq', '<u8'), ('time', '<i8'), ('capacity', '<u8'), ('total', '<u8'),
+                  ('received', '<u8'), ('expected', '<u8'), ('pkt_rate', '<f8'), ('rate', '<f8'), ('pdr', '<f8'), ('p50', '<f8'),
+                  ('p90', '<f8'), ('p99', '<f8'), ('max', '<f8')])
+
+# The last [capacity] delays in us follow the statistics, oldest overwritten first
+RING = np.dtype('<i4')
+
+def SegmentName(port: int) -> str:
+    """
+    Gives the shared memory name the receiver on [port] publishes to.
+
+    Args:
+        port (int): The receive port.
+
+    Returns:
+        name (str): The name of the segment (under /dev/shm on Linux).
+    """
+
+    return 'cv2x_rx_' + str(port)
+
+class LivePublisher:
+    """
+    Receiver side of the live stats: delays are only appended to a local array per packet, and every [period]
+    seconds the window's rate, PDR, and percentiles and the new delays are copied into shared memory at once, so
+    a reader never holds up the receive loop.
+
+    Args:
+        name (str): The name of the segment, see SegmentName().
+        capacity (int): The number of recent delays kept for readers.
+        period (float): Seconds between updates.
+    """
+
+    def __init__(self, name: str, capacity: int = 4096, period: float = 0.1) -> None:
+        size = STATS.itemsize + capacity * RING.itemsize
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a receiver that was killed
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self.stats = np.ndarray((1,), STATS, self.shm.buf, 0)
+        self.ring = np.ndarray((capacity,), RING, self.shm.buf, STATS.itemsize)
+        self.stats[0] = (MAGIC, VERSION, 0, 0, capacity, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+        self.capacity = capacity
+        self.period = period
+        self.next_time = None
+
+        # Delays since the last update, and the counts at the end of it
+        self.pending = array.array('i')
+        self.last_received = 0
+        self.last_expected = 0
+        self.last_time = None
+
+    def Record(self, delay: int) -> None:
+        """
+        Adds the delay of a packet to the current window.
+
+        Args:
+            delay (int): The delay in us.
+
+        Returns:
+            None
+        """
+
+        self.pending.append(delay)
+
+    def Due(self, tracker: st.SequenceTracker, pkt_rate: int) -> None:
+        """
+        Publishes the window if [period] has passed since the last update (the first call starts the first window).
+
+        Args:
+            tracker (SequenceTracker): The receiver's sequence tracker.
+            pkt_rate (int): The packet rate from the last header.
+
+        Returns:
+            None
+        """
+
+        now = time.monotonic()
+        if self.next_time is None:
+            self.next_time = now + self.period
+            self.last_time = now
+            return
+        if now < self.next_time:
+            return
+        self.next_time = now + self.period
+
+        delays = np.frombuffer(self.pending, dtype=RING) if len(self.pending) else np.zeros(0, RING)
+        expected = 0 if tracker.highest is None else tracker.highest - tracker.base + 1
+        window = expected - self.last_expected
+        stats = self.stats[0]
+
+        # Odd while writing, readers retry until it is even and unchanged around their copy
+        stats['seq'] = stats['seq'] + 1
+
+        total = int(stats['total'])
+        if len(delays) > self.capacity:
+            total = total + len(delays) - self.capacity
+            delays = delays[-self.capacity:]
+        self.ring[(total + np.arange(len(delays))) % self.capacity] = delays
+        stats['total'] = total + len(delays)
+
+        stats['time'] = time.time_ns()
+        stats['received'] = tracker.received
+        stats['expected'] = expected
+        stats['pkt_rate'] = pkt_rate
+        stats['rate'] = (tracker.received - self.last_received) / (now - self.last_time)
+        stats['pdr'] = 100 * min(1, (tracker.received - self.last_received) / window) if window > 0 else 0
+        if len(delays):
+            stats['p50'], stats['p90'], stats['p99'] = np.percentile(delays, [50, 90, 99])
+            stats['max'] = delays.max()
+
+        stats['seq'] = stats['seq'] + 1
+
+        self.pending = array.array('i')
+        self.last_received = tracker.received
+        self.last_expected = expected
+        self.last_time = now
+
+    def Close(self) -> None:
+        """
+        Removes the segment (a reader still attached keeps the last values).
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        # The arrays hold views of the buffer, which must be gone before it can be closed
+        self.stats = None
+        self.ring = None
+        self.shm.close()
+        self.shm.unlink()
+
+class LiveReader:
+    """
+    Reader side of the live stats: attaches to a receiver's segment and copies out consistent snapshots.
+
+    Args:
+        name (str): The name of the segment, see SegmentName().
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        try:
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 an attached segment is tracked too, and would be removed when the reader exits
+            self.shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.stats = np.ndarray((1,), STATS, self.shm.buf, 0)
+        if (self.stats[0]['magic'] != MAGIC) or (self.stats[0]['version'] != VERSION):
+            self.Close()
+            raise ValueError(name + ' is not a version ' + str(VERSION) + ' live stats segment')
+        self.capacity = int(self.stats[0]['capacity'])
+        self.ring = np.ndarray((self.capacity,), RING, self.shm.buf, STATS.itemsize)
+
+    def Snapshot(self, tries: int = 100) -> tuple:
+        """
+        Copies the statistics and the recent delays, retrying while the receiver is part way through an update.
+
+        Args:
+            tries (int): The most attempts before giving back whatever was copied last.
+
+        Returns:
+            stats (dict): The rolling statistics (see STATS).
+            delays (numpy.ndarray): The recent delays in us, oldest first.
+        """
+
+        for attempt in range(tries):
+            seq = int(self.stats[0]['seq'])
+            if (seq % 2) and (attempt < tries - 1):
+                time.sleep(1e-4)
+                continue
+            stats = self.stats[0].copy()
+            ring = self.ring.copy()
+            if int(self.stats[0]['seq']) == seq:
+                break
+
+        total = int(stats['total'])
+        if total < self.capacity:
+            delays = ring[:total]
+        else:
+            delays = np.roll(ring, -(total % self.capacity))
+        return {key: stats[key].item() for key in STATS.names if key != 'magic'}, delays
+
+    def Close(self) -> None:
+        """
+        Detaches from the segment (it is left for the receiver to remove).
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.stats = None
+        self.ring = None
+        self.shm.close()
@@ -8,10 +8,37 @@ from operator import*
 import transmit as tx
 import receive as rx
 import plot as pd
+import packet as pk
+import delaylog as dl
+import multireceive as mr
+import shardreceive as sr
+import emulate as em
+import bench as bm
+import runner as rn
+import echo as ec
+import runindex as ri
+
+def ParseOptions(args: list) -> dict:
+    """
+    Collects optional [key]=[value] arguments given after the positional ones.
+
+    Args:
+        args (list): The remaining command line arguments.
+
+    Returns:
+        options (dict): The options as strings, keyed by name.
+    """
+
+    options = {}
+    for arg in args:
+        key, value = arg.split('=', 1)
+        options[key] = value
+    return options
 
 if __name__ == '__main__':
     # This series of logic takes information entered into the terminal after 'python3 main.py' and uses it as the
     # arguments in this programs functions (with the function depending on the first string after ''.py)
+    status = 0
     try:
         if sys.argv[1] == "tx":
             try:
@@ -20,7 +47,20 @@ if __name__ == '__main__':
                 pkt_rate = int(sys.argv[4])
                 num_pkts = int(sys.argv[5])
                 cal_runs = int(sys.argv[6])
-                tx.TransmitPackets(mk6_addr, mk6_port, pkt_rate, num_pkts, cal_runs)
+                options = ParseOptions(sys.argv[7:])
+                pacer = options.get('pacer', 'hybrid')
+                burst = int(options.get('burst', 1))
+                batch = int(options.get('batch', 1))
+                verbosity = int(options.get('verbosity', 1))
+                source = int(options['source'], 0) if 'source' in options else None
+                mtu = int(options['mtu']) if 'mtu' in options else None
+                feedback_port = int(options['feedback_port']) if 'feedback_port' in options else None
+                target_pdr = float(options.get('target_pdr', 99))
+                target_p99 = float(options['target_p99']) if 'target_p99' in options else None
+                max_rate = int(options.get('max_rate', 100000))
+                metrics = int(options['metrics']) if 'metrics' in options else None
+                tx.TransmitPackets(mk6_addr, mk6_port, pkt_rate, num_pkts, cal_runs, pacer, burst, batch, verbosity, source, mtu,
+                                   feedback_port, target_pdr, target_p99, max_rate, metrics)
             except:
                 print(tx.tx_str)
                 sys.exit(1)
@@ -30,18 +70,188 @@ if __name__ == '__main__':
                 mk6_port = int(sys.argv[3])
                 num_pkts = int(sys.argv[4])
                 cal_runs = int(sys.argv[5])
-                rx.ReceivePackets(mk6_addr, mk6_port, num_pkts, cal_runs)
+                options = ParseOptions(sys.argv[6:])
+                batch = int(options.get('batch', 1))
+                verbosity = int(options.get('verbosity', 1))
+                kernel_ts = options.get('kernel_ts', '0') == '1'
+                feedback = options.get('feedback')
+                feedback_period = float(options.get('feedback_period', 0.5))
+                live = options.get('live', '0') == '1'
+                metrics = int(options['metrics']) if 'metrics' in options else None
+                rx.ReceivePackets(mk6_addr, mk6_port, num_pkts, cal_runs, batch, verbosity, kernel_ts, feedback, feedback_period, live, metrics)
             except:
                 print(rx.rx_str)
+        elif sys.argv[1] == "arx":
+            try:
+                mk6_addr = sys.argv[2]
+                mk6_port = int(sys.argv[3])
+                num_pkts = int(sys.argv[4])
+                cal_runs = int(sys.argv[5])
+                options = ParseOptions(sys.argv[6:])
+                src_tot = int(options.get('sources', 1))
+                verbosity = int(options.get('verbosity', 1))
+                mr.ReceiveSources(mk6_addr, mk6_port, num_pkts, cal_runs, src_tot, verbosity)
+            except:
+                print(mr.arx_str)
+                sys.exit(1)
+        elif sys.argv[1] == "mrx":
+            try:
+                mk6_addr = sys.argv[2]
+                mk6_port = int(sys.argv[3])
+                num_pkts = int(sys.argv[4])
+                cal_runs = int(sys.argv[5])
+                options = ParseOptions(sys.argv[6:])
+                workers = int(options.get('workers', 2))
+                batch = int(options.get('batch', 1))
+                verbosity = int(options.get('verbosity', 1))
+                sr.ReceiveSharded(mk6_addr, mk6_port, num_pkts, cal_runs, workers, batch, verbosity)
+            except:
+                print(sr.mrx_str)
+                sys.exit(1)
+        elif sys.argv[1] == "em":
+            try:
+                listen_addr = sys.argv[2]
+                listen_port = int(sys.argv[3])
+                dest_addr = sys.argv[4]
+                dest_port = int(sys.argv[5])
+                options = ParseOptions(sys.argv[6:])
+                em.RelayPackets(listen_addr, listen_port, dest_addr, dest_port,
+                                delay=float(options.get('delay', 0)), jitter=float(options.get('jitter', 0)), dist=options.get('dist', 'normal'),
+                                loss=float(options.get('loss', 0)), burst=float(options.get('burst', 1)), dup=float(options.get('dup', 0)),
+                                reorder=float(options.get('reorder', 0)), reorder_delay=float(options.get('reorder_delay', 1)),
+                                seed=int(options['seed']) if 'seed' in options else None,
+                                batch=int(options.get('batch', 64)), verbosity=int(options.get('verbosity', 1)))
+            except:
+                print(em.em_str)
+                sys.exit(1)
+        elif sys.argv[1] == "fl":
+            try:
+                options = ParseOptions(sys.argv[2:])
+                em.FakeLogDialogue(options.get('path', 'log.txt'), float(options.get('offset', 0)), float(options.get('drift', 0)),
+                                   float(options.get('lat', 43.0731)), float(options.get('lon', -89.4012)))
+            except:
+                print(em.fl_str)
+                sys.exit(1)
+        elif sys.argv[1] == "er":
+            try:
+                listen_addr = sys.argv[2]
+                listen_port = int(sys.argv[3])
+                options = ParseOptions(sys.argv[4:])
+                reply_port = int(options['reply_port']) if 'reply_port' in options else None
+                ec.ReflectPackets(listen_addr, listen_port, options.get('reply_addr'), reply_port, int(options.get('batch', 64)),
+                                  options.get('kernel_ts', '0') == '1', int(options.get('verbosity', 1)))
+            except:
+                print(ec.er_str)
+                sys.exit(1)
+        elif sys.argv[1] == "ep":
+            try:
+                dest_addr = sys.argv[2]
+                dest_port = int(sys.argv[3])
+                pkt_rate = int(sys.argv[4])
+                num_pkts = int(sys.argv[5])
+                options = ParseOptions(sys.argv[6:])
+                ec.PingPackets(dest_addr, dest_port, pkt_rate, num_pkts, int(options.get('size', 0)), int(options.get('listen_port', 0)),
+                               options.get('pacer', 'hybrid'), int(options.get('burst', 1)), int(options.get('batch', 1)),
+                               options.get('kernel_ts', '0') == '1', int(options.get('verbosity', 1)))
+            except:
+                print(ec.ep_str)
+                sys.exit(1)
         elif sys.argv[1] == "pd":
             try:
                 name = sys.argv[2]
-                pd.PlotData(name)
+                options = ParseOptions(sys.argv[3:])
+                pd.PlotData(name, options.get('save'), int(options.get('bins', 30)))
             except:
                 print(pd.pd_str)
                 sys.exit(1)
+        elif sys.argv[1] == "pr":
+            try:
+                name = sys.argv[2]
+                options = ParseOptions(sys.argv[3:])
+                pd.PlotRate(name, options.get('save'))
+            except:
+                print(pd.pr_str)
+                sys.exit(1)
+        elif sys.argv[1] == "pc":
+            try:
+                # Any number of log names/patterns, then the options
+                names = [arg for arg in sys.argv[2:] if '=' not in arg]
+                options = ParseOptions([arg for arg in sys.argv[2:] if '=' in arg])
+                if not names:
+                    raise ValueError('No logs given')
+                pd.PlotCompare(names, options.get('by'), options.get('save'), float(options.get('tail', 99.9)))
+            except:
+                print(pd.pc_str)
+                sys.exit(1)
+        elif sys.argv[1] == "lp":
+            try:
+                port = int(sys.argv[2])
+                options = ParseOptions(sys.argv[3:])
+                pd.LivePlot(port, float(options.get('fps', 5)), float(options.get('history', 60)), options.get('save'))
+            except:
+                print(pd.lp_str)
+                sys.exit(1)
+        elif sys.argv[1] == "pb":
+            try:
+                # Any number of log names/patterns, then the options
+                names = [arg for arg in sys.argv[2:] if '=' not in arg]
+                options = ParseOptions([arg for arg in sys.argv[2:] if '=' in arg])
+                if not names:
+                    raise ValueError('No logs given')
+                workers = int(options['workers']) if 'workers' in options else None
+                failed = pd.PlotBatch(names, options.get('out', './Results/Plots'), options.get('fmt', 'png'), workers, options.get('force', '0') == '1',
+                                      int(options.get('bins', 30)))
+            except:
+                print(pd.pb_str)
+                sys.exit(1)
+
+            # Exit code for scripts, set outside the try so it is not taken as a usage error
+            status = 1 if failed > 0 else 0
+        elif sys.argv[1] == "ix":
+            try:
+                options = ParseOptions(sys.argv[2:])
+                ri.IndexRuns(options)
+            except:
+                print(ri.ix_str)
+                sys.exit(1)
+        elif sys.argv[1] == "bp":
+            try:
+                runs = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+                pk.BenchmarkPacket(runs)
+            except:
+                print(pk.bp_str)
+                sys.exit(1)
+        elif sys.argv[1] == "bm":
+            try:
+                options = ParseOptions(sys.argv[2:])
+                rates = [int(rate) for rate in options.get('rates', '1000,10000,50000').split(',')]
+                sizes = [int(size) for size in options.get('sizes', '0,256,1024').split(',')]
+                regressions = bm.Benchmark(rates, sizes, float(options.get('seconds', 2)), options.get('pacer', 'hybrid'), int(options.get('burst', 1)),
+                                           int(options.get('batch', 1)), options.get('out'), options.get('baseline'), float(options.get('tolerance', 20)))
+            except:
+                print(bm.bm_str)
+                sys.exit(1)
+
+            # Exit code for scripts/CI, set outside the try so it is not taken as a usage error
+            status = 1 if regressions > 0 else 0
+        elif sys.argv[1] == "run":
+            try:
+                path = sys.argv[2]
+                options = ParseOptions(sys.argv[3:])
+                rn.RunSweep(path, options)
+            except:
+                print(rn.run_str)
+                sys.exit(1)
+        elif sys.argv[1] == "cv":
+            try:
+                name = sys.argv[2] if len(sys.argv) > 2 else None
+                dl.ConvertTextLogs(name)
+            except:
+                print(dl.cv_str)
+                sys.exit(1)
         else:
-            print('\nEnter valid command: tx, rx, pd\n')
+            print('\nEnter valid command: tx, rx, arx, mrx, em, fl, er, ep, pd, pr, pc, lp, pb, ix, bp, bm, run, cv\n')
     except:
-        print('\nEnter valid command: tx, rx, pd\n')
-        sys.exit(1)
\ No newline at end of file
+        print('\nEnter valid command: tx, rx, arx, mrx, em, fl, er, ep, pd, pr, pc, lp, pb, ix, bp, bm, run, cv\n')
+        sys.exit(1)
+    sys.exit(status)
\ No newline at end of file
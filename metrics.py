@@ -0,0 +1,350 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Metrics Tools
+'''
+import os
+import gc
+import time
+import socket
+import threading
+import http.server
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import stats as st
+import sockio as so
+import pacing as pc
+
+# Upper bounds of the histogram buckets in seconds (1-2.5-5 steps from 1 us to 10 s), +Inf is added after them
+BOUNDS = [m * 10.0 ** e for e in range(-6, 1) for m in (1, 2.5, 5)] + [10.0]
+
+def Family(name: str, kind: str, text: str, samples: list) -> list:
+    """
+    Formats one metric family in the Prometheus text format.
+
+    Args:
+        name (str): The metric name.
+        kind (str): 'counter' or 'gauge'.
+        text (str): The help text.
+        samples (list): (labels dict or None, value) pairs.
+
+    Returns:
+        lines (list): The lines of the family.
+    """
+
+    lines = ['# HELP ' + name + ' ' + text, '# TYPE ' + name + ' ' + kind]
+    for labels, value in samples:
+        lines.append(name + Labels(labels) + ' ' + repr(float(value)))
+    return lines
+
+def Labels(labels: dict) -> str:
+    """
+    Formats a label set, e.g. {stage="send"}.
+
+    Args:
+        labels (dict): The labels, None for none.
+
+    Returns:
+        text (str): The label set.
+    """
+
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()) + '}'
+
+def HistogramFamily(name: str, text: str, histograms: list, scale: float) -> list:
+    """
+    Formats LatencyHistograms as one Prometheus histogram family, re-bucketing their counts into BOUNDS.
+
+    Args:
+        name (str): The metric name (without _bucket/_sum/_count).
+        text (str): The help text.
+        histograms (list): (labels dict or None, LatencyHistogram) pairs.
+        scale (float): Multiplies the recorded values into seconds (1e-6 for us, 1e-9 for ns).
+
+    Returns:
+        lines (list): The lines of the family.
+    """
+
+    lines = ['# HELP ' + name + ' ' + text, '# TYPE ' + name + ' histogram']
+    for labels, histogram in histograms:
+        buckets = [0] * (len(BOUNDS) + 1)
+        count = 0
+        for index, c in enumerate(histogram.counts):
+            if c:
+                value = histogram.Value(index) * scale
+                bucket = 0
+                while (bucket < len(BOUNDS)) and (value > BOUNDS[bucket]):
+                    bucket = bucket + 1
+                buckets[bucket] = buckets[bucket] + c
+                count = count + c
+
+        cumulative = 0
+        for bound, c in zip(BOUNDS + [float('inf')], buckets):
+            cumulative = cumulative + c
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(name + '_bucket' + Labels(dict(labels or {}, le=le)) + ' ' + str(cumulative))
+        lines.append(name + '_sum' + Labels(labels) + ' ' + repr(histogram.mean * count * scale))
+        lines.append(name + '_count' + Labels(labels) + ' ' + str(count))
+    return lines
+
+def UdpSocket(sock: socket.socket) -> dict:
+    """
+    Finds [sock] in /proc/net/udp (Linux) by its inode, for the kernel's view of its queues and drops.
+
+    Args:
+        sock (socket.socket): The UDP socket.
+
+    Returns:
+        stats (dict): tx_queue and rx_queue (bytes waiting) and drops (datagrams dropped), None if not found.
+    """
+
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in ('/proc/net/udp', '/proc/net/udp6'):
+        try:
+            with open(path) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        tx_queue, rx_queue = fields[4].split(':')
+                        return {'tx_queue': int(tx_queue, 16), 'rx_queue': int(rx_queue, 16), 'drops': int(fields[-1])}
+        except OSError:
+            pass
+    return None
+
+def UdpSnmp() -> dict:
+    """
+    Reads the host-wide UDP counters from /proc/net/snmp (Linux).
+
+    Args:
+        None
+
+    Returns:
+        counters (dict): e.g. InDatagrams, InErrors, RcvbufErrors, SndbufErrors, empty if unavailable.
+    """
+
+    try:
+        with open('/proc/net/snmp') as f:
+            rows = [line.split() for line in f if line.startswith('Udp:')]
+    except OSError:
+        return {}
+    if len(rows) < 2:
+        return {}
+    return {key: int(value) for key, value in zip(rows[0][1:], rows[1][1:])}
+
+class GCMonitor:
+    """
+    Times every garbage collection through gc.callbacks, so pauses that stall the send/receive loop show up.
+    """
+
+    def __init__(self) -> None:
+        self.histogram = st.LatencyHistogram()
+        self.collections = [0, 0, 0]
+        self.start = 0
+
+    def Callback(self, phase: str, info: dict) -> None:
+        if phase == 'start':
+            self.start = time.perf_counter_ns()
+        else:
+            self.histogram.Record(time.perf_counter_ns() - self.start)
+            self.collections[info['generation']] += 1
+
+    def Start(self) -> None:
+        gc.callbacks.append(self.Callback)
+
+    def Stop(self) -> None:
+        if self.Callback in gc.callbacks:
+            gc.callbacks.remove(self.Callback)
+
+    def Collect(self) -> list:
+        lines = HistogramFamily('cv2x_gc_pause_seconds', 'Time the interpreter was paused for garbage collection.', [(None, self.histogram)], 1e-9)
+        lines += Family('cv2x_gc_collections_total', 'counter', 'Garbage collections by generation.',
+                        [({'generation': i}, c) for i, c in enumerate(self.collections)])
+        return lines
+
+def StageLines(timer: st.StageTimer) -> list:
+    """
+    Formats the CPU time of every stage of a loop (see StageTimer).
+
+    Args:
+        timer (StageTimer): The loop's timer, kept with histograms.
+
+    Returns:
+        lines (list): The lines of the stage families.
+    """
+
+    lines = Family('cv2x_stage_cpu_seconds_total', 'counter', 'CPU time spent in each stage of the send/receive loop.',
+                   [({'stage': stage}, total / 1e9) for stage, total in list(timer.totals.items())])
+    if timer.histograms is not None:
+        lines += HistogramFamily('cv2x_stage_seconds', 'CPU time of each pass through a stage of the send/receive loop.',
+                                 [({'stage': stage}, histogram) for stage, histogram in list(timer.histograms.items())], 1e-9)
+    return lines
+
+def SocketLines(sock: socket.socket) -> list:
+    """
+    Formats the kernel's queue and drop counters for [sock] and the host-wide UDP buffer errors.
+
+    Args:
+        sock (socket.socket): The UDP socket.
+
+    Returns:
+        lines (list): The lines of the socket families.
+    """
+
+    lines = []
+    udp = UdpSocket(sock)
+    if udp is not None:
+        lines += Family('cv2x_udp_socket_drops_total', 'counter', 'Datagrams the kernel dropped on this socket (/proc/net/udp).', [(None, udp['drops'])])
+        lines += Family('cv2x_udp_socket_queue_bytes', 'gauge', 'Bytes waiting in the socket queues (/proc/net/udp).',
+                        [({'queue': 'rx'}, udp['rx_queue']), ({'queue': 'tx'}, udp['tx_queue'])])
+
+    snmp = UdpSnmp()
+    for key, name in [('RcvbufErrors', 'cv2x_udp_rcvbuf_errors_total'), ('SndbufErrors', 'cv2x_udp_sndbuf_errors_total'), ('InErrors', 'cv2x_udp_in_errors_total')]:
+        if key in snmp:
+            lines += Family(name, 'counter', 'Host-wide UDP ' + key + ' (/proc/net/snmp).', [(None, snmp[key])])
+    return lines
+
+class ReceiverMetrics:
+    """
+    What the receiver reports, read from its own objects at scrape time so the receive loop does no extra work.
+
+    Args:
+        tracker (SequenceTracker): Counts received, lost, reordered, and duplicate packets.
+        histogram (LatencyHistogram): Packet delays in us.
+        overhead (LatencyHistogram): Kernel to application time in us, None without kernel timestamps.
+        receiver (BatchReceiver): Holds the SO_RXQ_OVFL drop count and the socket.
+        timer (StageTimer): The CPU time of each stage, None if not timed.
+    """
+
+    def __init__(self, tracker: st.SequenceTracker, histogram: st.LatencyHistogram, overhead: st.LatencyHistogram, receiver: so.BatchReceiver,
+                 timer: st.StageTimer = None) -> None:
+        self.tracker = tracker
+        self.histogram = histogram
+        self.overhead = overhead
+        self.receiver = receiver
+        self.timer = timer
+
+    def Collect(self) -> list:
+        tracker = self.tracker
+        expected = 0 if tracker.highest is None else tracker.highest - tracker.base + 1
+        lines = Family('cv2x_rx_packets_received_total', 'counter', 'Unique packets received.', [(None, tracker.received)])
+        lines += Family('cv2x_rx_packets_expected_total', 'counter', 'Packets sent up to the highest sequence number received.', [(None, expected)])
+        lines += Family('cv2x_rx_packets_missing', 'gauge', 'Packets not (yet) received below the highest sequence number.',
+                        [(None, max(0, expected - tracker.received))])
+        lines += Family('cv2x_rx_packets_duplicate_total', 'counter', 'Duplicate packets.', [(None, tracker.duplicates)])
+        lines += Family('cv2x_rx_packets_reordered_total', 'counter', 'Packets that arrived behind a later one.', [(None, tracker.reordered)])
+        lines += HistogramFamily('cv2x_rx_delay_seconds', 'One-way packet delay.', [(None, self.histogram)], 1e-6)
+        if self.overhead is not None:
+            lines += HistogramFamily('cv2x_rx_kernel_to_app_seconds', 'Time between the kernel receiving a packet and the program getting it.',
+                                     [(None, self.overhead)], 1e-6)
+        if self.receiver.overflow:
+            lines += Family('cv2x_rx_socket_overflow_drops_total', 'counter', 'Datagrams dropped on the socket as reported by SO_RXQ_OVFL.',
+                            [(None, self.receiver.dropped)])
+        if self.timer is not None:
+            lines += StageLines(self.timer)
+        return lines + SocketLines(self.receiver.sock)
+
+class TransmitterMetrics:
+    """
+    What the transmitter reports, read from the pacer and socket at scrape time.
+
+    Args:
+        pacer (Pacer): Counts packets sent and, with its errors histogram set, how late each packet left after it was due.
+        sock (socket.socket): The UDP socket.
+        timer (StageTimer): The CPU time of each stage, None if not timed.
+    """
+
+    def __init__(self, pacer: pc.Pacer, sock: socket.socket, timer: st.StageTimer = None) -> None:
+        self.pacer = pacer
+        self.sock = sock
+        self.timer = timer
+
+    def Collect(self) -> list:
+        report = self.pacer.Report()
+        lines = Family('cv2x_tx_packets_sent_total', 'counter', 'Packets sent.', [(None, report['sent'])])
+        lines += Family('cv2x_tx_rate_target', 'gauge', 'Target packet rate (packets/s).', [(None, self.pacer.pkt_rate)])
+        lines += Family('cv2x_tx_rate_achieved', 'gauge', 'Packet rate measured from the send times (packets/s).', [(None, report['rate'])])
+        lines += Family('cv2x_tx_rate_error_percent', 'gauge', 'Achieved rate less the target rate (averaged over the run if it adapted), in percent.', [(None, report['error'])])
+        if self.pacer.errors is not None:
+            lines += HistogramFamily('cv2x_tx_pacing_error_seconds', 'How late each packet left after its scheduled time.',
+                                     [(None, self.pacer.errors)], 1e-9)
+        if self.timer is not None:
+            lines += StageLines(self.timer)
+        return lines + SocketLines(self.sock)
+
+class MetricsServer:
+    """
+    Serves the metrics of the collectors added to it in the Prometheus text format at http://[addr]:[port]/metrics,
+    from a background thread. Nothing is computed until a scrape arrives.
+
+    Args:
+        port (int): The TCP port to listen on.
+        addr (str): The address to listen on, local only by default.
+    """
+
+    def __init__(self, port: int, addr: str = '127.0.0.1') -> None:
+        self.collectors = []
+        self.gc = GCMonitor()
+        self.scrapes = 0
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = server.Render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes are not worth a line on the console
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((addr, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def Add(self, collector) -> None:
+        """
+        Adds an object whose Collect() gives lines of metrics.
+
+        Args:
+            collector: e.g. a ReceiverMetrics or TransmitterMetrics.
+
+        Returns:
+            None
+        """
+
+        self.collectors.append(collector)
+
+    def Render(self) -> str:
+        """
+        Collects every metric.
+
+        Args:
+            None
+
+        Returns:
+            text (str): The metrics in the Prometheus text format.
+        """
+
+        self.scrapes = self.scrapes + 1
+        lines = []
+        for collector in list(self.collectors) + [self.gc]:
+            lines += collector.Collect()
+        lines += Family('cv2x_metrics_scrapes_total', 'counter', 'Scrapes of this endpoint.', [(None, self.scrapes)])
+        return '\n'.join(lines) + '\n'
+
+    def Start(self) -> None:
+        self.gc.Start()
+        self.thread.start()
+
+    def Stop(self) -> None:
+        self.gc.Stop()
+        self.httpd.shutdown()
+        self.httpd.server_close()
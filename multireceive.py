@@ -0,0 +1,407 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Multi-Source Receiver Tools
+'''
+import time
+import socket
+import signal
+import asyncio
+import datetime
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import utilities as ut
+import packet as pk
+import stats as st
+import delaylog as dl
+import console as co
+import receive as rx
+
+import geopy.distance
+
+class SourceStats:
+    """
+    Everything kept for one transmitter: sequence tracking, latency statistics, and its own delay log.
+
+    Args:
+        source (int): The source id from the packet headers.
+        address (tuple): The (address, port) the first packet came from.
+        path (str): The path of the delay log for this source.
+        rx_coord (tuple): The receiver (latitude, longitude).
+    """
+
+    def __init__(self, source: int, address: tuple, path: str, rx_coord: tuple) -> None:
+        self.source = source
+        self.address = address
+        self.rx_coord = rx_coord
+
+        # Transmitter numbers packets from 0
+        self.tracker = st.SequenceTracker(base=0)
+        self.histogram = st.LatencyHistogram()
+        self.reassembler = pk.Reassembler()
+        self.log = dl.DelayLogWriter(path, {'start_time': datetime.datetime.now().isoformat(), 'source': source,
+                                            'tx_address': address[0], 'rx_latitude': rx_coord[0], 'rx_longitude': rx_coord[1]})
+
+        # Taken from the first packet header
+        self.dist = None
+        self.pkt_rate = 0
+        self.cal_time = 0
+        self.last_report_cnt = 0
+
+    def Name(self) -> str:
+        """
+        Gives a short name for console output.
+
+        Args:
+            None
+
+        Returns:
+            name (str): The source id in hex and the address it sends from.
+        """
+
+        return '%08x %s' % (self.source, self.address[0])
+
+    def Record(self, header: pk.PacketHeader, rx_time: int, size: int, offset: float) -> bool:
+        """
+        Records a packet from this source.
+
+        Args:
+            header (PacketHeader): The decoded packet header.
+            rx_time (int): The drift-corrected receive time in ns.
+            size (int): The size of the packet (the whole frame if it was fragmented) in bytes.
+            offset (float): The current PC-GNSS offset in seconds (only kept for the log).
+
+        Returns:
+            new (bool): False if the packet was a duplicate or too late to be timed.
+        """
+
+        if self.tracker.Record(header.seq) >= st.DUPLICATE:
+            return False
+
+        if self.dist is None:
+            self.dist = geopy.distance.geodesic(self.rx_coord, (header.tx_latitude, header.tx_longitude)).m
+
+        self.pkt_rate = header.pkt_rate
+        self.cal_time = offset - header.calibration
+
+        delay = (rx_time - header.tx_time) / 1e9
+        self.log.Write(header.seq, header.tx_time, rx_time, size, header.source, rx_time)
+        self.histogram.Record(round(1e6 * abs(delay)))
+        return True
+
+    def Close(self, pkt_tot: int) -> dict:
+        """
+        Finishes the log for this source.
+
+        Args:
+            pkt_tot (int): The number of packets the source was meant to send, -1 if unknown.
+
+        Returns:
+            loss (dict): The loss statistics from SequenceTracker.Finalize().
+        """
+
+        loss = self.tracker.Finalize(pkt_tot if pkt_tot != -1 else None)
+        fragments = self.reassembler.Report(loss['expected']) if self.reassembler.fragments else None
+        self.log.Close(rx.LogMeta(loss, self.histogram.Report(1e-3), self.pkt_rate, self.cal_time, self.dist or 0, fragments=fragments))
+        return loss
+
+class SourceProtocol(asyncio.DatagramProtocol):
+    """
+    Demultiplexes datagrams by the source id in the packet header, so each transmitter gets its own statistics no
+    matter how many share the port (all on the event loop, no thread per source).
+
+    Args:
+        calibrator (ClockCalibrator): Corrects receive times onto the GNSS clock.
+        console (Console): Where bad packets and new sources are reported.
+        datestr (str): The date string the delay logs are named after.
+        rx_coord (tuple): The receiver (latitude, longitude).
+    """
+
+    def __init__(self, calibrator: ut.ClockCalibrator, console: co.Console, datestr: str, rx_coord: tuple) -> None:
+        self.calibrator = calibrator
+        self.console = console
+        self.datestr = datestr
+        self.rx_coord = rx_coord
+
+        self.sources = {}
+        self.bad_cnt = 0
+        self.warmup_cnt = 0
+        self.last_time = time.monotonic()
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        # Stamp arrival (drift-corrected onto the GNSS clock) before any decoding
+        rx_time = self.calibrator.Now()
+        self.last_time = time.monotonic()
+
+        try:
+            header, predicted_labels = pk.DecodePacket(data)
+        except ValueError as e:
+            self.bad_cnt = self.bad_cnt + 1
+            self.console.Log(co.NORMAL, 'Bad packet from %s: %s', addr, e)
+            return
+
+        # Warmup packets only settle the path ahead of the measured ones
+        if header.flags & pk.FLAG_WARMUP:
+            self.warmup_cnt = self.warmup_cnt + 1
+            return
+
+        stats = self.sources.get(header.source)
+        if stats is None:
+            path = './Logging/Delay/' + 'delay_log_' + self.datestr + '_%08x.dlog' % (header.source)
+            stats = SourceStats(header.source, addr, path, self.rx_coord)
+            self.sources[header.source] = stats
+            self.console.Log(co.NORMAL, '\nNew source %s, logging to %s\n', stats.Name(), path)
+
+        # A fragment only counts once it completes its frame, which then arrived with its last fragment
+        size = len(data)
+        if header.flags & pk.FLAG_FRAGMENT:
+            try:
+                body = stats.reassembler.Add(header, data, rx_time)
+                if body is None:
+                    return
+                predicted_labels = pk.DecodeLabels(body)
+            except ValueError as e:
+                self.bad_cnt = self.bad_cnt + 1
+                self.console.Log(co.NORMAL, 'Bad fragment from %s: %s', addr, e)
+                return
+            size = pk.HEADER.size + len(body)
+
+        if stats.Record(header, rx_time, size, self.calibrator.Offset(rx_time) / 1e9):
+            self.console.Log(co.VERBOSE, '%08x %s', header.source, predicted_labels)
+
+    def error_received(self, exc: Exception) -> None:
+        self.console.Log(co.NORMAL, 'Socket error: %s', exc)
+
+    def Done(self, pkt_tot: int, src_tot: int) -> bool:
+        """
+        Checks whether [src_tot] sources have each delivered [pkt_tot] packets.
+
+        Args:
+            pkt_tot (int): The number of packets expected from each source, -1 to never finish.
+            src_tot (int): The number of sources expected.
+
+        Returns:
+            done (bool): Whether the run is complete.
+        """
+
+        if (pkt_tot == -1) or (len(self.sources) < src_tot):
+            return False
+        return all(stats.tracker.received >= pkt_tot for stats in self.sources.values())
+
+    def Draining(self, pkt_tot: int, src_tot: int) -> bool:
+        """
+        Checks whether the last packet from every expected source has arrived (only stragglers left to wait for).
+
+        Args:
+            pkt_tot (int): The number of packets expected from each source, -1 to never finish.
+            src_tot (int): The number of sources expected.
+
+        Returns:
+            draining (bool): Whether to wait only briefly for more packets.
+        """
+
+        if (pkt_tot == -1) or (len(self.sources) < src_tot):
+            return False
+        return all((stats.tracker.highest is not None) and (stats.tracker.highest >= pkt_tot - 1) for stats in self.sources.values())
+
+async def ReceiveLoop(rxsock: socket.socket, protocol: SourceProtocol, console: co.Console, pkt_tot: int, src_tot: int) -> None:
+    """
+    Runs [protocol] on [rxsock] until every source is done, nothing arrives for a while, or Ctrl+C, printing a summary
+    for every source once a period.
+
+    Args:
+        rxsock (socket.socket): The bound UDP socket.
+        protocol (SourceProtocol): The demultiplexing protocol.
+        console (Console): Where the summaries are printed.
+        pkt_tot (int): The number of packets expected from each source, -1 to receive until Ctrl+C or timeout.
+        src_tot (int): The number of sources expected before the run can finish.
+
+    Returns:
+        None
+    """
+
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=rxsock)
+
+    # Ctrl+C ends the run but still writes out every log (the handler is not available on every platform)
+    stop = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGINT, stop.set)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    # Socket timeout, and the shorter one used to wait for stragglers once every last packet has arrived
+    rx_timeout = 10
+    drain_timeout = 1
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), console.period)
+            except asyncio.TimeoutError:
+                pass
+
+            if protocol.Done(pkt_tot, src_tot):
+                break
+
+            timeout = drain_timeout if protocol.Draining(pkt_tot, src_tot) else rx_timeout
+            if time.monotonic() - protocol.last_time > timeout:
+                break
+
+            if console.Due():
+                for stats in protocol.sources.values():
+                    tracker = stats.tracker
+                    expected = tracker.received if tracker.highest is None else tracker.highest - tracker.base + 1
+                    console.Log(co.NORMAL, '[Rx %s] %d pkts (%.0f pkts/s), lost %d, latency %s',
+                                stats.Name(), tracker.received, (tracker.received - stats.last_report_cnt) / console.period,
+                                expected - tracker.received, stats.histogram.Summary())
+                    stats.last_report_cnt = tracker.received
+
+        if stop.is_set():
+            console.Log(co.QUIET, 'Interrupted')
+    finally:
+        transport.close()
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+def ReceiveSources(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int, src_tot: int = 1, verbosity: int = co.NORMAL) -> None:
+    """
+    Receive [pkt_tot] UDP packets from each of [src_tot] transmitters sharing IPv4 IP [mk6_addr] on port [mk6_port] with
+    [cal_runs] calibration runs, keeping separate statistics and a separate delay log for each.
+
+    Args:
+        mk6_addr (str): The IP address of the MK6 radio.
+        mk6_port (int): The port of the MK6 radio.
+        pkt_tot  (int): The number of packets to receive from each source. -1 receives until the socket times out or Ctrl+C.
+        cal_runs (int): The number of calibration runs to undergo
+        src_tot  (int): The number of transmitters to wait for before the run can finish.
+        verbosity (int): 0 prints only the final results, 1 adds a summary every second, 2 adds every packet.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    TX (src_tot)           RX
+    +---+                  +-------------------------------------+
+    |   |-+ [acme 5.9GHz]  | +-----+ (mk6_addr, mk6_port) +----+ |
+    |   | |-+------------->| | MK6 |--------------------->| PC | |
+    +---+ | |              | +-----+ by header source id  +----+ |
+      +---+ |              |  bytes                 dict/source  |
+        +---+              +-------------------------------------+
+
+    1. Retrieve receiver coordinates from [log.txt], distances are taken from each transmitter's packet headers.
+    2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
+    3. Provide user with MK6 acme command to receive data.
+    4. Create a UDP socket, bind, and increase receive buffer.
+    5. Receive UDP packets on an asyncio event loop and demultiplex them by the source id in the header.
+    6. Track sequence numbers and latency for each source separately.
+    7. Log per-packet timestamps for each source to its own binary delay log (delay_log_[date]_[source].dlog).
+
+    ==============================================================
+    """
+
+    rx_coord = ut.GetCoords()
+    rx_coord = (rx_coord[0], rx_coord[1])
+
+    print('\nRx Latitude: ' + str(rx_coord[0]) + '\n')
+    print('Rx Longitude: ' + str(rx_coord[1]))
+
+    # Returns the averaged time difference between the GNSS (MK6) time and the current PC time
+    rx_cal_time = ut.CalibrationDialogue(cal_runs)
+
+    # Keep refining the offset (and drift) from the MK6 log in the background while receiving, if calibration was run
+    calibrator = ut.ClockCalibrator('log.txt', rx_cal_time)
+    if rx_cal_time != 0:
+        calibrator.start()
+
+    # Give user command to run on MK6
+    interface = 'eth0'
+    mk6_cmd = ("acme -R -P 111 -x " + interface + " -X " + mk6_addr + " -Y " + str(mk6_port) + " -d")
+    print("\nRun this MK6 Command to receive data:")
+    print(mk6_cmd)
+    input("\nPress Enter to continue... ")
+
+    # Create UDP socket with a large receive buffer (shared by every transmitter), then bind it
+    rxsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rxsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    rxsock.bind((mk6_addr, mk6_port))
+    rxsock.setblocking(False)
+
+    # Printing happens on a background thread so the terminal can not delay the receive timestamps
+    console = co.Console(verbosity)
+
+    # Every source gets its own log named after the start of the run and its source id
+    datestr = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S_%p")
+    protocol = SourceProtocol(calibrator, console, datestr, rx_coord)
+
+    print ('\nReceiving...\n')
+
+    try:
+        asyncio.run(ReceiveLoop(rxsock, protocol, console, pkt_tot, max(1, src_tot)))
+    except KeyboardInterrupt:
+        # Only reached where the signal handler is unavailable, the logs are still written below
+        console.Log(co.QUIET, 'Interrupted')
+
+    # Anything not received from a source by now is lost
+    for stats in protocol.sources.values():
+        loss = stats.Close(pkt_tot)
+        console.Log(co.QUIET, '\n[%s] received %d, lost %d in %d bursts, reordered %d, duplicate/late %d/%d\nLatency: %s\nDistance: %.1f meters',
+                    stats.Name(), loss['received'], loss['lost'], loss['bursts'], loss['reordered'], loss['duplicates'], loss['late'],
+                    stats.histogram.Summary(), stats.dist or 0)
+        if stats.reassembler.fragments:
+            fragments = stats.reassembler.Report(loss['expected'])
+            console.Log(co.QUIET, 'Fragments: %d received (%.2f%% delivered, %d duplicate), frames expired/evicted/incomplete: %d/%d/%d',
+                        fragments['fragments'], fragments['fragment_pdr'], fragments['fragment_duplicates'], fragments['frames_expired'],
+                        fragments['frames_evicted'], fragments['frames_incomplete'])
+
+    console.Log(co.QUIET, '\nSources: %d, bad packets: %d, warmup packets: %d\n', len(protocol.sources), protocol.bad_cnt, protocol.warmup_cnt)
+
+    if rx_cal_time != 0:
+        calibrator.Stop()
+        console.Log(co.QUIET, calibrator.Summary() + '\n')
+
+    console.Close()
+    rxsock.close()
+
+# String for help command
+arx_str = ("""
+====================
+  ReceiveSources()
+====================
+
+Receive [pkt_tot] UDP packets from each of [src_tot] transmitters sharing IPv4 IP [mk6_addr] on port [mk6_port] with
+[cal_runs] calibration runs, keeping separate statistics and a separate delay log for each.
+
+Args:
+    mk6_addr (str): The IP address of the MK6 radio.
+    mk6_port (int): The port of the MK6 radio.
+    pkt_tot  (int): The number of packets to receive from each source. -1 receives until the socket times out or Ctrl+C.
+    cal_runs (int): The number of calibration runs to undergo
+    src_tot  (int): The number of transmitters to wait for before the run can finish.
+    verbosity (int): 0 prints only the final results, 1 adds a summary every second, 2 adds every packet.
+
+Returns:
+    None
+
+==============================================================
+
+TX (src_tot)           RX
++---+                  +-------------------------------------+
+|   |-+ [acme 5.9GHz]  | +-----+ (mk6_addr, mk6_port) +----+ |
+|   | |-+------------->| | MK6 |--------------------->| PC | |
++---+ | |              | +-----+ by header source id  +----+ |
+  +---+ |              |  bytes                 dict/source  |
+    +---+              +-------------------------------------+
+
+1. Retrieve receiver coordinates from [log.txt], distances are taken from each transmitter's packet headers.
+2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
+3. Provide user with MK6 acme command to receive data.
+4. Create a UDP socket, bind, and increase receive buffer.
+5. Receive UDP packets on an asyncio event loop and demultiplex them by the source id in the header.
+6. Track sequence numbers and latency for each source separately.
+7. Log per-packet timestamps for each source to its own binary delay log (delay_log_[date]_[source].dlog).
+
+==============================================================
+""")
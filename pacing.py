@@ -0,0 +1,313 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Pacing Tools
+'''
+import time
+from operator import*
+
+# Sleeping is only trusted to wake up within this many ns of the deadline, the rest is spun
+SPIN_NS = 200_000
+
+# If the sender falls this many periods behind (e.g. a stall), restart the schedule instead of catching up
+MAX_LAG_PERIODS = 100
+
+def SleepUntil(deadline: int, spin_ns: int = SPIN_NS) -> None:
+    """
+    Waits until [deadline] on the perf_counter_ns clock, sleeping for most of the wait and spinning for the end of it.
+
+    Args:
+        deadline (int): The perf_counter_ns time to wait until.
+        spin_ns (int): How long before the deadline to stop sleeping and start spinning.
+
+    Returns:
+        None
+    """
+
+    remaining = deadline - time.perf_counter_ns()
+
+    # OS sleep granularity is too coarse for the last part of the wait, so leave that to the spin
+    if remaining > spin_ns:
+        time.sleep((remaining - spin_ns) / 1e9)
+
+    while time.perf_counter_ns() < deadline:
+        pass
+
+class Pacer:
+    """
+    Base pacer: schedules packets at [pkt_rate] on a monotonic clock and measures the actual departure times.
+
+    Args:
+        pkt_rate (float): The target number of packets per second.
+        spin_ns (int): How long before each deadline to stop sleeping and start spinning (unused by the base Wait()).
+
+    Its Wait() sends one packet per period by sleeping alone, which costs no CPU but wakes up late by the OS sleep
+    granularity. Subclasses override Wait(), which blocks until packets are due and returns how many can be sent.
+    """
+
+    def __init__(self, pkt_rate: float, spin_ns: int = SPIN_NS) -> None:
+        self.spin_ns = spin_ns
+
+        # Also anchors the schedule on the first call to Wait()
+        self.SetRate(pkt_rate)
+
+        # Inter-departure time statistics, kept as running sums so memory stays constant
+        self.sent = 0
+        self.first_time = 0
+        self.last_time = 0
+        self.idt_sum = 0
+        self.idt_sq_sum = 0
+        self.idt_min = 0
+        self.idt_max = 0
+
+        # Sum of the target period over the same gaps, so a rate changed by SetRate() is compared gap for gap
+        self.period_sum = 0
+
+        # Set to a LatencyHistogram (see stats.py) to also count how late each packet left after it was due, in ns.
+        # Wait() sets due_time, so packets a burst sends back to back by design are not counted as a period off
+        self.errors = None
+        self.due_time = 0
+
+    def SetRate(self, pkt_rate: float) -> None:
+        """
+        Changes the target packet rate, re-anchoring the schedule at the current slot.
+
+        Args:
+            pkt_rate (float): The new target number of packets per second.
+
+        Returns:
+            None
+        """
+
+        self.pkt_rate = pkt_rate
+        self.period = round(1e9 / pkt_rate)
+
+        # Start a fresh schedule so slots already sent are not re-timed at the new rate
+        self.start_time = None
+        self.slot = 0
+
+    def Wait(self) -> int:
+        """
+        Blocks until the next packet(s) are due.
+
+        Args:
+            None
+
+        Returns:
+            due (int): The number of packets to send now.
+        """
+
+        now = time.perf_counter_ns()
+        self.Start(now)
+
+        # Deadlines come from the start of the schedule, so a late wakeup is made up on the next packet
+        deadline = self.start_time + self.slot * self.period
+        self.due_time = deadline
+        if deadline > now:
+            time.sleep((deadline - now) / 1e9)
+
+        self.slot = self.slot + 1
+        return 1
+
+    def Start(self, now: int) -> None:
+        """
+        Anchors the schedule at [now], or re-anchors it if the sender has fallen too far behind.
+
+        Args:
+            now (int): The current perf_counter_ns time.
+
+        Returns:
+            None
+        """
+
+        if (self.start_time is None) or (now - (self.start_time + self.slot * self.period) > MAX_LAG_PERIODS * self.period):
+            self.start_time = now
+            self.slot = 0
+
+    def Sent(self) -> None:
+        """
+        Records the departure time of a packet that has just been sent.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        now = time.perf_counter_ns()
+
+        if self.sent == 0:
+            self.first_time = now
+        else:
+            idt = now - self.last_time
+            self.idt_sum = self.idt_sum + idt
+            self.idt_sq_sum = self.idt_sq_sum + idt * idt
+            self.period_sum = self.period_sum + self.period
+            if (self.sent == 1) or (idt < self.idt_min):
+                self.idt_min = idt
+            if idt > self.idt_max:
+                self.idt_max = idt
+
+        if self.errors is not None:
+            self.errors.Record(max(0, now - self.due_time))
+
+        self.last_time = now
+        self.sent = self.sent + 1
+
+    def Report(self) -> dict:
+        """
+        Summarizes the measured departures.
+
+        Args:
+            None
+
+        Returns:
+            report (dict): Achieved rate, target rate (averaged over the run the same way if SetRate() changed it), rate
+                error (%), and inter-departure mean/std/min/max in microseconds.
+        """
+
+        gaps = self.sent - 1
+        if gaps < 1:
+            return {'sent': self.sent, 'rate': 0.0, 'target': self.pkt_rate, 'error': 0.0, 'idt_mean': 0.0, 'idt_std': 0.0, 'idt_min': 0.0, 'idt_max': 0.0}
+
+        idt_mean = self.idt_sum / gaps
+        idt_var = max(self.idt_sq_sum / gaps - idt_mean * idt_mean, 0)
+        rate = 1e9 / idt_mean if idt_mean > 0 else 0.0
+        target = 1e9 * gaps / self.period_sum
+
+        return {
+            'sent': self.sent,
+            'rate': rate,
+            'target': target,
+            'error': 100 * (rate - target) / target,
+            'idt_mean': idt_mean / 1e3,
+            'idt_std': idt_var ** 0.5 / 1e3,
+            'idt_min': self.idt_min / 1e3,
+            'idt_max': self.idt_max / 1e3,
+        }
+
+    def Summary(self) -> str:
+        """
+        Formats Report() for printing.
+
+        Args:
+            None
+
+        Returns:
+            summary (str): The measured packet rate and inter-departure times.
+        """
+
+        r = self.Report()
+
+        # A rate adapted during the run is compared against the targets it had along the way
+        target = 'target' if round(r['target'], 1) == round(self.pkt_rate, 1) else 'average target'
+        return ('Average Packet Rate: %.1f pkts/s (%s %.1f, error %+.2f%%)\n'
+                'Inter-departure Time: mean %.1f us, std %.1f us, min %.1f us, max %.1f us'
+                % (r['rate'], target, r['target'], r['error'], r['idt_mean'], r['idt_std'], r['idt_min'], r['idt_max']))
+
+class HybridPacer(Pacer):
+    """
+    Sends one packet per period, sleeping until just before each deadline and spinning on perf_counter_ns for the rest.
+    """
+
+    def Wait(self) -> int:
+        now = time.perf_counter_ns()
+        self.Start(now)
+
+        # Deadlines come from the start of the schedule, so errors never accumulate
+        deadline = self.start_time + self.slot * self.period
+        self.due_time = deadline
+        if deadline > now:
+            SleepUntil(deadline, self.spin_ns)
+
+        self.slot = self.slot + 1
+        return 1
+
+class TokenBucketPacer(Pacer):
+    """
+    Token bucket: tokens accrue at [pkt_rate] up to [burst], and every whole token that is available is sent at once.
+
+    Args:
+        pkt_rate (float): The target number of packets per second.
+        burst (int): The bucket size, i.e. the most packets sent back to back after an idle spell.
+        spin_ns (int): How long before each deadline to stop sleeping and start spinning.
+    """
+
+    def __init__(self, pkt_rate: float, burst: int = 1, spin_ns: int = SPIN_NS) -> None:
+        self.burst = max(1, burst)
+        super().__init__(pkt_rate, spin_ns)
+
+    def SetRate(self, pkt_rate: float) -> None:
+        super().SetRate(pkt_rate)
+        self.tokens = 0
+        self.last_fill = None
+
+    def Wait(self) -> int:
+        now = time.perf_counter_ns()
+
+        # Tokens are kept in ns of credit so the bucket never drifts through float rounding
+        if self.last_fill is None:
+            self.last_fill = now
+            self.tokens = self.period
+        self.tokens = min(self.tokens + now - self.last_fill, self.burst * self.period)
+        self.last_fill = now
+
+        # Wait until a whole token is available
+        self.due_time = now
+        if self.tokens < self.period:
+            self.due_time = now + self.period - self.tokens
+            SleepUntil(self.due_time, self.spin_ns)
+            now = time.perf_counter_ns()
+            self.tokens = min(self.tokens + now - self.last_fill, self.burst * self.period)
+            self.last_fill = now
+
+        due = self.tokens // self.period
+        self.tokens = self.tokens - due * self.period
+        return due
+
+class BurstPacer(Pacer):
+    """
+    Sends a fixed burst of [burst] packets every [burst] periods.
+
+    Args:
+        pkt_rate (float): The target number of packets per second.
+        burst (int): The number of packets per burst.
+        spin_ns (int): How long before each deadline to stop sleeping and start spinning.
+    """
+
+    def __init__(self, pkt_rate: float, burst: int = 1, spin_ns: int = SPIN_NS) -> None:
+        self.burst = max(1, burst)
+        super().__init__(pkt_rate, spin_ns)
+
+    def Wait(self) -> int:
+        now = time.perf_counter_ns()
+        self.Start(now)
+
+        deadline = self.start_time + self.slot * self.period
+        self.due_time = deadline
+        if deadline > now:
+            SleepUntil(deadline, self.spin_ns)
+
+        self.slot = self.slot + self.burst
+        return self.burst
+
+# Pacers selectable from the command line
+PACERS = {'hybrid': HybridPacer, 'sleep': Pacer, 'token': TokenBucketPacer, 'burst': BurstPacer}
+
+def MakePacer(name: str, pkt_rate: float, burst: int = 1) -> Pacer:
+    """
+    Creates the pacer called [name] ('hybrid', 'sleep', 'token', or 'burst').
+
+    Args:
+        name (str): The pacer to use.
+        pkt_rate (float): The target number of packets per second.
+        burst (int): The bucket/burst size for the token and burst pacers.
+
+    Returns:
+        pacer (Pacer): The new pacer.
+    """
+
+    if name not in PACERS:
+        raise ValueError('Unknown pacer: ' + name + ' (use ' + ', '.join(PACERS) + ')')
+    if name in ('hybrid', 'sleep'):
+        return PACERS[name](pkt_rate)
+    return PACERS[name](pkt_rate, burst)
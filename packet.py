@@ -0,0 +1,526 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Packet Tools
+'''
+import struct
+import socket
+import zlib
+import pickle
+import timeit
+import collections
+from collections import namedtuple
+from operator import*
+
+# Two bytes at the start of every packet so stray traffic on the port is rejected before decoding
+MAGIC = b'CV'
+
+# Wire format version, bump whenever the header layout changes
+VERSION = 2
+
+# Fixed header in network byte order:
+# magic, version, flags, source, seq, tx_time (ns), calibration (s), pkt_rate, tx_latitude, tx_longitude, body_len, point
+HEADER = struct.Struct('!2sBBIIqdIddHI')
+
+# Header flags: warmup packets are sent ahead of a measured run to settle the path and are not counted by receivers
+FLAG_WARMUP = 0x01
+
+# Set by an echo reflector on the packets it sends back, which carry its receive and transmit times after the body
+FLAG_ECHO = 0x02
+
+# Set on every fragment of a frame split to fit an MTU (see FrameBuffer), the header is repeated in each fragment
+FLAG_FRAGMENT = 0x04
+
+# Byte offsets of the fields that change between packets (patched in place by the transmitter or reflector)
+FLAGS_OFFSET = 3
+SEQ_OFFSET = 8
+TIME_OFFSET = 12
+
+# The sequence number and transmit time sit next to each other so one pack_into patches both
+STAMP = struct.Struct('!Iq')
+
+# Receive and transmit time (ns) appended to a packet by an echo reflector
+ECHO = struct.Struct('!qq')
+
+# Fragment index, fragment count, and length of the whole body, between the header and the body of a fragment
+FRAGMENT = struct.Struct('!HHI')
+
+# Largest UDP payload over IPv4
+MAX_PKT_SIZE = 65507
+
+# ASCII unit/record separators for the label body: key US value RS key US value ...
+KEY_SEP = '\x1f'
+LABEL_SEP = '\x1e'
+
+# Decoded packet header
+PacketHeader = namedtuple('PacketHeader', ['version', 'flags', 'source', 'seq', 'tx_time', 'calibration', 'pkt_rate', 'tx_latitude', 'tx_longitude', 'point'])
+
+def SourceId() -> int:
+    """
+    Gives a stable 32 bit id for this PC so receivers can tell transmitters apart.
+
+    Args:
+        None
+
+    Returns:
+        source (int): CRC32 of the host name.
+    """
+
+    return zlib.crc32(socket.gethostname().encode())
+
+def EncodeLabels(labels: dict) -> bytes:
+    """
+    Encodes a dictionary of perception labels into the compact packet body.
+
+    Args:
+        labels (dict): The labels to encode, keys and values are converted to strings.
+
+    Returns:
+        body (bytes): UTF-8 keys and values joined with the ASCII unit/record separators.
+    """
+
+    items = []
+    for key, value in labels.items():
+        item = str(key) + KEY_SEP + str(value)
+
+        # The separators are control characters that never appear in detector output, but check anyway
+        if (item.count(KEY_SEP) != 1) or (LABEL_SEP in item):
+            raise ValueError('Label contains a separator character: ' + repr(item[:32]))
+
+        items.append(item)
+
+    return LABEL_SEP.join(items).encode()
+
+def DecodeLabels(body) -> dict:
+    """
+    Decodes the compact packet body back into a dictionary of perception labels.
+
+    Args:
+        body (bytes): The encoded labels from EncodeLabels().
+
+    Returns:
+        labels (dict): The decoded labels.
+    """
+
+    if len(body) == 0:
+        return {}
+
+    try:
+        # Splitting on one separator gives alternating keys and values
+        fields = str(body, 'utf-8').replace(LABEL_SEP, KEY_SEP).split(KEY_SEP)
+    except UnicodeDecodeError as e:
+        raise ValueError('Malformed label body: ' + str(e))
+
+    if len(fields) % 2 != 0:
+        raise ValueError('Malformed label body: key without value')
+
+    return dict(zip(fields[::2], fields[1::2]))
+
+def EncodePacket(labels: dict, seq: int, tx_time: int, calibration: float, pkt_rate: int, tx_latitude: float, tx_longitude: float, source: int = 0, flags: int = 0, point: int = 0) -> bytes:
+    """
+    Encodes a perception packet as the fixed header followed by the label body.
+
+    Args:
+        labels (dict): The perception labels to send.
+        seq (int): The packet sequence number (wraps at 2^32).
+        tx_time (int): The transmit time in ns since the epoch.
+        calibration (float): The transmitter calibration time in seconds.
+        pkt_rate (int): The transmitter packet rate in packets/sec.
+        tx_latitude (float): The transmitter latitude.
+        tx_longitude (float): The transmitter longitude.
+        source (int): The transmitter id from SourceId().
+        flags (int): Packet flags (FLAG_WARMUP, FLAG_ECHO, FLAG_FRAGMENT).
+        point (int): The sweep point the packet belongs to (see runner.py), 0 outside a sweep.
+
+    Returns:
+        pkt (bytes): The encoded packet.
+    """
+
+    body = EncodeLabels(labels)
+    header = HEADER.pack(MAGIC, VERSION, flags, source, seq & 0xFFFFFFFF, tx_time, calibration, pkt_rate, tx_latitude, tx_longitude, len(body), point)
+    return header + body
+
+def DecodePacket(pkt) -> tuple:
+    """
+    Decodes a perception packet into its header and labels.
+
+    Args:
+        pkt (bytes): The received packet.
+
+    Returns:
+        header (PacketHeader): The decoded header fields.
+        labels (dict): The decoded labels, None for a fragment (see Reassembler).
+    """
+
+    if len(pkt) < HEADER.size:
+        raise ValueError('Packet shorter than header (' + str(len(pkt)) + ' bytes)')
+
+    fields = HEADER.unpack_from(pkt, 0)
+    body_len = fields[10]
+
+    if fields[0] != MAGIC:
+        raise ValueError('Not a CV2X packet')
+    if fields[1] != VERSION:
+        raise ValueError('Unsupported packet version: ' + str(fields[1]))
+    if len(pkt) < HEADER.size + body_len:
+        raise ValueError('Truncated packet (' + str(len(pkt)) + ' of ' + str(HEADER.size + body_len) + ' bytes)')
+
+    # Everything but the magic and the body length is the header proper
+    header = PacketHeader._make(fields[1:10] + fields[11:])
+
+    # A fragment holds only part of the labels, they are decoded once the frame is reassembled
+    if header.flags & FLAG_FRAGMENT:
+        return header, None
+
+    labels = DecodeLabels(pkt[HEADER.size:HEADER.size + body_len])
+
+    return header, labels
+
+class PacketBuffer:
+    """
+    Holds one encoded packet in a preallocated buffer so only the sequence number and transmit time are written per send.
+
+    Args:
+        size (int): The size of the preallocated buffer in bytes.
+
+    Attributes:
+        pkt (memoryview): The encoded packet, ready to pass straight to sendto().
+    """
+
+    def __init__(self, size: int = MAX_PKT_SIZE) -> None:
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.pkt = self.view[:0]
+
+    def Load(self, labels: dict, calibration: float, pkt_rate: int, tx_latitude: float, tx_longitude: float, source: int = 0, flags: int = 0, point: int = 0) -> None:
+        """
+        Serializes the header and labels into the buffer, only needed when the labels change.
+
+        Args:
+            labels (dict): The perception labels to send.
+            calibration (float): The transmitter calibration time in seconds.
+            pkt_rate (int): The transmitter packet rate in packets/sec.
+            tx_latitude (float): The transmitter latitude.
+            tx_longitude (float): The transmitter longitude.
+            source (int): The transmitter id from SourceId().
+            flags (int): Packet flags (FLAG_WARMUP, FLAG_ECHO, FLAG_FRAGMENT).
+            point (int): The sweep point the packet belongs to, 0 outside a sweep.
+
+        Returns:
+            None
+        """
+
+        body = EncodeLabels(labels)
+        pkt_len = HEADER.size + len(body)
+        if pkt_len > len(self.buf):
+            raise ValueError('Packet of ' + str(pkt_len) + ' bytes does not fit in ' + str(len(self.buf)) + ' byte buffer')
+
+        # Sequence number and time are left at zero here and filled in by Stamp()
+        HEADER.pack_into(self.buf, 0, MAGIC, VERSION, flags, source, 0, 0, calibration, pkt_rate, tx_latitude, tx_longitude, len(body), point)
+        self.buf[HEADER.size:pkt_len] = body
+        self.pkt = self.view[:pkt_len]
+
+    def Stamp(self, seq: int, tx_time: int) -> None:
+        """
+        Patches the sequence number and transmit time of the loaded packet in place.
+
+        Args:
+            seq (int): The packet sequence number (wraps at 2^32).
+            tx_time (int): The transmit time in ns since the epoch.
+
+        Returns:
+            None
+        """
+
+        STAMP.pack_into(self.buf, SEQ_OFFSET, seq & 0xFFFFFFFF, tx_time)
+
+class FrameBuffer:
+    """
+    Holds one frame (header and labels) split into fragments of at most [mtu] bytes, each a complete datagram in its
+    own buffer with a copy of the header, so only the sequence number and transmit time are written per send.
+
+    Args:
+        mtu (int): The largest datagram to send in bytes.
+
+    Attributes:
+        bufs (list): One bytearray per fragment, each exactly as long as the fragment.
+    """
+
+    def __init__(self, mtu: int) -> None:
+        self.mtu = mtu
+        self.bufs = []
+
+    def Load(self, labels: dict, calibration: float, pkt_rate: int, tx_latitude: float, tx_longitude: float, source: int = 0, flags: int = 0, point: int = 0) -> None:
+        """
+        Serializes the labels and splits them into fragments, only needed when the labels change.
+
+        Args:
+            labels (dict): The perception labels to send.
+            calibration (float): The transmitter calibration time in seconds.
+            pkt_rate (int): The transmitter packet rate in frames/sec.
+            tx_latitude (float): The transmitter latitude.
+            tx_longitude (float): The transmitter longitude.
+            source (int): The transmitter id from SourceId().
+            flags (int): Packet flags (FLAG_FRAGMENT is always added).
+            point (int): The sweep point the frame belongs to, 0 outside a sweep.
+
+        Returns:
+            None
+        """
+
+        body = EncodeLabels(labels)
+        chunk = self.mtu - HEADER.size - FRAGMENT.size
+        if chunk <= 0:
+            raise ValueError('MTU of ' + str(self.mtu) + ' bytes leaves no room after the ' + str(HEADER.size + FRAGMENT.size) + ' byte fragment header')
+
+        # Every fragment but the last is full, which is how the receiver places them
+        count = max(1, -(-len(body) // chunk))
+        if count > 0xFFFF:
+            raise ValueError('Labels of ' + str(len(body)) + ' bytes need more than 65535 fragments')
+
+        self.bufs = []
+        for index in range(count):
+            part = body[index * chunk:(index + 1) * chunk]
+            buf = bytearray(HEADER.size + FRAGMENT.size + len(part))
+            HEADER.pack_into(buf, 0, MAGIC, VERSION, flags | FLAG_FRAGMENT, source, 0, 0, calibration, pkt_rate, tx_latitude, tx_longitude, FRAGMENT.size + len(part), point)
+            FRAGMENT.pack_into(buf, HEADER.size, index, count, len(body))
+            buf[HEADER.size + FRAGMENT.size:] = part
+            self.bufs.append(buf)
+
+    def Stamp(self, seq: int, tx_time: int) -> None:
+        """
+        Patches the sequence number and transmit time of every fragment in place (all fragments of a frame share them).
+
+        Args:
+            seq (int): The frame sequence number (wraps at 2^32).
+            tx_time (int): The transmit time in ns since the epoch.
+
+        Returns:
+            None
+        """
+
+        for buf in self.bufs:
+            STAMP.pack_into(buf, SEQ_OFFSET, seq & 0xFFFFFFFF, tx_time)
+
+class Reassembler:
+    """
+    Puts fragmented frames back together in bounded memory.
+
+    Frames are kept in the order their first fragment arrived. A frame still incomplete [timeout] seconds after its
+    first fragment is dropped as expired, and the oldest frame is evicted whenever a new one would take more than
+    [max_frames] frames or [max_bytes] bytes.
+
+    Args:
+        max_frames (int): The most frames being reassembled at once.
+        max_bytes (int): The most bytes held for frames being reassembled.
+        timeout (float): How long a frame may take to complete in seconds.
+    """
+
+    def __init__(self, max_frames: int = 256, max_bytes: int = 16_000_000, timeout: float = 1.0) -> None:
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.timeout = int(timeout * 1e9)
+
+        # (source, seq) -> [first fragment time, body, fragments seen (one byte each), fragments left]
+        self.pending = collections.OrderedDict()
+        self.pending_bytes = 0
+
+        # Recently completed frames, so a late duplicate fragment does not start its frame again
+        self.done = collections.OrderedDict()
+
+        self.fragments = 0
+        self.duplicates = 0
+        self.frames = 0
+        self.expired = 0
+        self.evicted = 0
+
+        # Fragments making up every frame completed, expired, or evicted so far (frames need not all have as many)
+        self.expected = 0
+
+    def Drop(self) -> None:
+        """
+        Drops the oldest pending frame.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        _, frame = self.pending.popitem(last=False)
+        self.pending_bytes = self.pending_bytes - len(frame[1])
+        self.expected = self.expected + len(frame[2])
+
+    def Add(self, header: PacketHeader, pkt, now: int):
+        """
+        Adds a fragment, giving back the whole body once the last fragment of its frame is in.
+
+        Args:
+            header (PacketHeader): The decoded header of the fragment.
+            pkt (memoryview): The fragment as received.
+            now (int): The receive time in ns, for timing out frames.
+
+        Returns:
+            body (bytearray): The complete label body, or None while the frame is incomplete.
+        """
+
+        if len(pkt) < HEADER.size + FRAGMENT.size:
+            raise ValueError('Fragment shorter than fragment header (' + str(len(pkt)) + ' bytes)')
+        index, count, total = FRAGMENT.unpack_from(pkt, HEADER.size)
+        part = pkt[HEADER.size + FRAGMENT.size:]
+        if (index >= count) or (len(part) > total) or (total > self.max_bytes):
+            raise ValueError('Malformed fragment ' + str(index) + ' of ' + str(count) + ' (' + str(total) + ' byte frame)')
+
+        self.fragments = self.fragments + 1
+
+        # Frames are in arrival order, so only the oldest ones need checking
+        while self.pending and (next(iter(self.pending.values()))[0] + self.timeout < now):
+            self.Drop()
+            self.expired = self.expired + 1
+
+        key = (header.source, header.seq)
+        if key in self.done:
+            self.duplicates = self.duplicates + 1
+            return None
+
+        frame = self.pending.get(key)
+        if frame is None:
+            while self.pending and ((len(self.pending) >= self.max_frames) or (self.pending_bytes + total > self.max_bytes)):
+                self.Drop()
+                self.evicted = self.evicted + 1
+            frame = [now, bytearray(total), bytearray(count), count]
+            self.pending[key] = frame
+            self.pending_bytes = self.pending_bytes + total
+
+        if frame[2][index]:
+            self.duplicates = self.duplicates + 1
+            return None
+
+        # The last fragment ends the body and the others start at a multiple of their (full) size
+        start = total - len(part) if index == count - 1 else index * len(part)
+        if (start < 0) or (start + len(part) > total):
+            raise ValueError('Fragment ' + str(index) + ' of ' + str(count) + ' does not fit its frame')
+        frame[1][start:start + len(part)] = part
+        frame[2][index] = 1
+        frame[3] = frame[3] - 1
+        if frame[3] > 0:
+            return None
+
+        del self.pending[key]
+        self.pending_bytes = self.pending_bytes - total
+        self.done[key] = True
+        if len(self.done) > 4 * self.max_frames:
+            self.done.popitem(last=False)
+        self.frames = self.frames + 1
+        self.expected = self.expected + count
+        return frame[1]
+
+    def Report(self, frames_expected: int) -> dict:
+        """
+        Gives datagram-level delivery next to the frame counts.
+
+        Args:
+            frames_expected (int): The number of frames sent.
+
+        Returns:
+            report (dict): Fragments received, fragment delivery rate (%), duplicate fragments, and frames completed,
+                expired, evicted, and still incomplete.
+        """
+
+        # Every frame seen knows its own fragment count, frames none of whose fragments arrived are taken at the average
+        seen = self.frames + self.expired + self.evicted + len(self.pending)
+        expected = self.expected + sum(len(frame[2]) for frame in self.pending.values())
+        if seen and (frames_expected > seen):
+            expected = expected + (frames_expected - seen) * expected / seen
+        return {
+            'fragments': self.fragments,
+            'fragment_pdr': 100 * (self.fragments - self.duplicates) / expected if expected else 0.0,
+            'fragment_duplicates': self.duplicates,
+            'frames': self.frames,
+            'frames_expired': self.expired,
+            'frames_evicted': self.evicted,
+            'frames_incomplete': len(self.pending),
+        }
+
+def BenchmarkPacket(runs: int) -> None:
+    """
+    Compares bytes per packet and encode/decode cost of the binary format against the old pickle format.
+
+    Args:
+        runs (int): The number of encodes/decodes to time for each format.
+
+    Returns:
+        None
+    """
+
+    # Use the real labels if they are there so the numbers match what goes on air
+    try:
+        with open('./Results/predicted_labels.txt') as f:
+            labels = dict(x.rstrip().split(None, 1) for x in f if x.strip())
+    except (OSError, ValueError):
+        labels = {'20240228_194429': 'person_0 20240228_194429 chair_56 20240228_194429 bed_59'}
+
+    tx_time = 1716151214123456789
+    cal_time = 0.0123
+    pkt_rate = 1000
+
+    # Old path: labels dict plus metadata, pickled
+    def pickle_encode():
+        predicted_labels = dict(labels)
+        predicted_labels.update({"time": tx_time / 1e9, "calibration": cal_time, "pkt_rate": pkt_rate})
+        return pickle.dumps(predicted_labels)
+
+    # New path: fixed header plus compact label body
+    def binary_encode():
+        return EncodePacket(labels, 12345, tx_time, cal_time, pkt_rate, 43.0731, -89.4012)
+
+    # Zero-allocation path: labels serialized once, only seq/time patched per packet
+    buffer = PacketBuffer()
+    buffer.Load(labels, cal_time, pkt_rate, 43.0731, -89.4012)
+    def buffer_stamp():
+        buffer.Stamp(12345, tx_time)
+        return buffer.pkt
+
+    pickled = pickle_encode()
+    binary = binary_encode()
+
+    results = [
+        ('pickle', len(pickled), timeit.timeit(pickle_encode, number=runs), timeit.timeit(lambda: pickle.loads(pickled), number=runs)),
+        ('binary', len(binary), timeit.timeit(binary_encode, number=runs), timeit.timeit(lambda: DecodePacket(binary), number=runs)),
+        ('stamped', len(buffer.pkt), timeit.timeit(buffer_stamp, number=runs), timeit.timeit(lambda: DecodePacket(buffer.pkt), number=runs)),
+    ]
+
+    print('\nPacket format benchmark over ' + str(runs) + ' runs (' + str(len(labels)) + ' labels)\n')
+    print('%-8s %14s %14s %14s' % ('format', 'bytes/pkt', 'encode (us)', 'decode (us)'))
+    for name, size, enc, dec in results:
+        print('%-8s %14d %14.2f %14.2f' % (name, size, 1e6 * enc / runs, 1e6 * dec / runs))
+    print('')
+
+# String for help command
+bp_str = ("""
+===================
+  BenchmarkPacket()
+===================
+
+Compares bytes per packet and encode/decode cost of the binary format against the old pickle format.
+
+Args:
+    runs (int): The number of encodes/decodes to time for each format.
+
+Returns:
+    None
+
+==============================================================
+
+Binary packet layout (network byte order, 54 byte header):
+
++-------+---------+-------+--------+-----+---------+-------------+----------+--------+--------+----------+-------+
+| magic | version | flags | source | seq | tx_time | calibration | pkt_rate | tx_lat | tx_lon | body_len | point |
+|  2s   |    B    |   B   |   I    |  I  |  q (ns) |   d (s)     |    I     |   d    |   d    |    H     |   I   |
++-------+---------+-------+--------+-----+---------+-------------+----------+--------+--------+----------+-------+
+
+The transmitter serializes the packet once into a PacketBuffer and patches only seq and tx_time per send.
+
+Label body: UTF-8 [key] 0x1F [value] 0x1E [key] 0x1F [value] ...
+
+==============================================================
+""")
@@ -1,16 +1,206 @@
 '''
 Jonah Duncan, 04/11/24 - 05/30/24, CV2X Plot Tools
 '''
+import os
+import io
+import glob
+import time
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
 import matplotlib.pyplot as plt
-import seaborn as sns
+import matplotlib.animation as animation
 from operator import*
 
-def PlotData(name: str) -> None:
+# Ignore warnings here -- importing self-made packages
+import delaylog as dl
+import livestats as ls
+
+# Number of fine bins the density estimate is computed on, plenty for a smooth curve at any sample count
+KDE_GRID = 512
+
+def LogPath(name: str) -> str:
+    """
+    Finds the log of a run: ./Logging/Delay/[name].dlog (or [name].txt for older runs), or [name] itself if it is a
+    path to a log (e.g. a sweep point, ./Logging/Runs/sweep_001/point_000.dlog).
+
+    Args:
+        name (str): The name or path of the log.
+
+    Returns:
+        path (str): The path of the log.
+    """
+
+    if name.endswith('.dlog') or name.endswith('.txt'):
+        if not os.path.exists(name):
+            raise FileNotFoundError('No log at ' + name)
+        return name
+
+    # Use the start of the file name to find the file path
+    prefix = name.split('_')[0]
+    if prefix not in ('delay', 'echo'):
+        raise ValueError('Please enter a valid path/name (delay_log_[date] or echo_log_[date]): ' + name)
+
+    path = './Logging/Delay/' + name + '.dlog'
+
+    # Older runs only have a text log
+    if not os.path.exists(path):
+        path = './Logging/Delay/' + name + '.txt'
+    if not os.path.exists(path):
+        raise FileNotFoundError('No log named ' + name + ' in ./Logging/Delay')
+    return path
+
+def ExpandNames(names: list) -> list:
+    """
+    Expands shell-style patterns (e.g. delay_log_2024_05_*, ./Logging/Runs/sweep_001/point_*.dlog) into log names,
+    sorted, so many runs can be given at once.
+
+    Args:
+        names (list): The names, paths, or patterns.
+
+    Returns:
+        names (list): The names and paths of the logs.
+    """
+
+    expanded = []
+    for name in names:
+        if not glob.has_magic(name):
+            expanded.append(name)
+            continue
+        if name.endswith('.dlog') or name.endswith('.txt'):
+            matches = sorted(glob.glob(name))
+        else:
+            # Older runs only have a text log, and a run with both is one name (LogPath() picks the binary log)
+            paths = glob.glob('./Logging/Delay/' + name + '.dlog') + glob.glob('./Logging/Delay/' + name + '.txt')
+            matches = sorted(set(os.path.splitext(os.path.basename(path))[0] for path in paths))
+        if not matches:
+            raise FileNotFoundError('No logs match ' + name)
+        expanded.extend(matches)
+    return expanded
+
+def LoadRun(name: str) -> tuple:
+    """
+    Loads the delays of a run as one array, in ms.
+
+    Args:
+        name (str): The name or path of the log (see LogPath()).
+
+    Returns:
+        meta (dict): The run metadata.
+        delays (numpy.ndarray): The absolute delays in ms.
+    """
+
+    meta, delays = dl.LoadDelays(LogPath(name))
+    return meta, np.abs(np.asarray(delays, dtype=np.float64)) * 1000
+
+def Histogram(data: np.ndarray, bins: int = 30, limits: tuple = None) -> tuple:
+    """
+    Bins the data once with NumPy, as a percentage of all samples per bin.
+
+    Args:
+        data (numpy.ndarray): The samples.
+        bins (int): The number of bins.
+        limits (tuple): The (low, high) range of the bins, defaults to the range of the data.
+
+    Returns:
+        percent (numpy.ndarray): The percentage of samples in each bin.
+        edges (numpy.ndarray): The bin edges, one more than the bins.
+    """
+
+    counts, edges = np.histogram(data, bins=bins, range=limits)
+    return 100 * counts / max(1, len(data)), edges
+
+def BinnedKDE(data: np.ndarray, limits: tuple = None, grid: int = KDE_GRID, bandwidth: float = None) -> tuple:
+    """
+    Gaussian kernel density estimate computed on a fine histogram of the data instead of on every sample, so it costs
+    one pass over the data and a [grid] sized convolution however many samples there are.
+
+    Args:
+        data (numpy.ndarray): The samples.
+        limits (tuple): The (low, high) range of the estimate, defaults to the range of the data.
+        grid (int): The number of points the estimate is computed at.
+        bandwidth (float): The kernel width, in the units of the data. Defaults to Silverman's rule.
+
+    Returns:
+        x (numpy.ndarray): The points the estimate is computed at.
+        density (numpy.ndarray): The density at each point (integrates to 1 over [limits]).
+    """
+
+    if limits is None:
+        limits = (float(np.min(data)), float(np.max(data)))
+    low, high = limits
+    if high <= low:
+        high = low + 1e-3
+    counts, edges = np.histogram(data, bins=grid, range=(low, high))
+    width = edges[1] - edges[0]
+    x = (edges[:-1] + edges[1:]) / 2
+
+    # Silverman's rule, using the interquartile range so a long tail does not widen the kernel
+    if bandwidth is None:
+        spread = np.std(data)
+        iqr = np.subtract(*np.percentile(data, [75, 25])) / 1.349
+        if iqr > 0:
+            spread = min(spread, iqr)
+        bandwidth = 0.9 * spread * len(data) ** -0.2
+    bandwidth = max(bandwidth, width)
+
+    # Kernel out to 4 sigma, cut to the grid; the full convolution is trimmed back to the grid points
+    half = int(min(grid - 1, np.ceil(4 * bandwidth / width)))
+    kernel = np.exp(-0.5 * (np.arange(-half, half + 1) * width / bandwidth) ** 2)
+    density = np.convolve(counts, kernel)[half:half + grid]
+
+    total = density.sum() * width
+    return x, density / total if total > 0 else density
+
+def Show(fig, save: str = None) -> None:
+    """
+    Shows the figure, or writes it to [save] (the format follows the extension, e.g. .png or .svg) without opening a
+    window.
+
+    Args:
+        fig (Figure): The figure.
+        save (str): The image path, None to show the figure.
+
+    Returns:
+        None
+    """
+
+    if save is None:
+        plt.show()
+        return
+    if os.path.dirname(save):
+        os.makedirs(os.path.dirname(save), exist_ok=True)
+    fig.savefig(save, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    print('Saved ' + save)
+
+def Headless(save: str) -> None:
+    """
+    Switches to a non-interactive backend when the figure is only saved, so plotting works without a display (must
+    run before the figure is created).
+
+    Args:
+        save (str): The image path, None when the figure is shown.
+
+    Returns:
+        None
+    """
+
+    if save is not None:
+        plt.switch_backend('Agg')
+
+def PlotData(name: str, save: str = None, bins: int = 30) -> None:
     """
-    Plots named data from ./Logging/Delay/[name].txt. 
+    Plots named data from ./Logging/Delay/[name].dlog (or [name].txt for older runs).
+
+    The histogram and density are computed on binned data (see BinnedKDE()), so logs of millions of packets plot in
+    about the time it takes to read them.
 
     Args:
-        name (str): The name of the data to be plotted.
+        name (str): The name of the data to be plotted (or the path of a log).
+        save (str): Write the plot to this image (.png, .svg) instead of showing it.
+        bins (int): The number of histogram bins.
 
     Returns:
         None
@@ -39,46 +229,33 @@ def PlotData(name: str) -> None:
     ==============================================================
     """
 
-    # Use the start of the file name to find the file path
-    path = name.split('_')[0]
-    if(path == "delay"):
-        full_path = './Logging/Delay/'+ name + ".txt"
-    else:
-        full_path = './Logging/'+ 'handling' + '.txt'
-        print("Please enter a valid path/name")
-
-    # Open file and read the contents as a list
-    data_arr = []
-    with open(full_path, 'r') as fp:
-        for line in fp:
+    Headless(save)
 
-            # Remove the linebreak character from the current line
-            x = line[:-1]
+    # Load the delays (ms) and the run metadata the receiver stored with them
+    meta, data_arr = LoadRun(name)
+    if len(data_arr) == 0:
+        raise ValueError('No packets in ' + name)
 
-            # Scale/Absolute the delay time at the current line and add to the data_arr list
-            if (path == "delay"):
-                data_arr.append(abs(1000*float(x)))
+    # Experiment information stored by the receiver
+    distance = meta['distance']
+    cal_time = round(1000 * abs(meta['calibration']), 1)
+    pkt_rate = int(meta['pkt_rate'])
+    pdr = meta['pdr']
+    sent_pkts = meta['pkt_tot']
 
-    # Store data added onto delay_list by receiver and remove from data_arr list
-    distance = data_arr.pop() / 1000
-    cal_time = round(data_arr.pop(),1)
-    pkt_rate = int(data_arr.pop() / 1000)
-    pdr = data_arr.pop() / 1000
-    sent_pkts = data_arr.pop() / 1000
-
-    avg_delay = abs(sum(data_arr) / len(data_arr))
+    avg_delay = float(np.mean(data_arr))
 
     # String logic for x-axis
-    if(path == "delay"):
-        plt_str = "Packet Delay"
-    else:
-        plt_str = "Please enter a valid path/name"
+    plt_str = "Packet Delay"
 
-    # Arbitrarily set histogram bin length for sample sizes up to 1000
-    bin_len = 30
+    # Bin once, then draw the bars and the density (scaled to the bars) from the bins
+    percent, edges = Histogram(data_arr, bins)
+    x, density = BinnedKDE(data_arr, (edges[0], edges[-1]))
 
     # Create a customized histogram with a density plot
-    ax = sns.histplot(data_arr, bins=bin_len, kde=True, color='lightgreen', edgecolor='red', stat='percent')
+    fig, ax = plt.subplots()
+    ax.bar(edges[:-1], percent, width=np.diff(edges), align='edge', color='lightgreen', edgecolor='red')
+    ax.plot(x, density * (edges[1] - edges[0]) * 100, color='lightgreen')
 
     # Create second y-axis with invisible ticks to hold experiment information
     ax2 = ax.twinx()
@@ -88,21 +265,423 @@ def PlotData(name: str) -> None:
     # Add labels and title to histogram
     ax.set_xlabel(plt_str + ' (ms)\n' + '[Average: ' + str(round(avg_delay,1)) + ']')
     ax.set_ylabel('Density Percentage')
-    plt.title('Histogram of ' + plt_str + ' with Density Plot\n[Delivered ' + str(pdr) + '%' ' of ' + str(round(sent_pkts)) + ' perception packets over ' + str(round(distance,1)) + ' meters at 5.9GHz]') 
+    title = 'Histogram of ' + plt_str + ' with Density Plot\n[Delivered ' + str(pdr) + '%' ' of ' + str(round(sent_pkts)) + ' perception packets over ' + str(round(distance,1)) + ' meters at 5.9GHz]'
+
+    # Older logs have no loss statistics
+    if 'lost' in meta:
+        title = title + ('\n[Lost ' + str(round(meta['lost'])) + ' in ' + str(round(meta['bursts'])) + ' bursts (longest ' + str(round(meta['burst_max'])) + '), '
+                         + str(round(meta['reordered'])) + ' reordered, ' + str(round(meta['duplicates'])) + ' duplicates]')
+    plt.title(title)
 
     # Display the plot
-    plt.show()
+    Show(fig, save)
+
+def PlotRate(name: str, save: str = None) -> None:
+    """
+    Plots the packet rate chosen by the rate controller against the PDR reported in each feedback window, from
+    ./Logging/Rate/[name].dlog.
+
+    Args:
+        name (str): The name of the rate log.
+        save (str): Write the plot to this image (.png, .svg) instead of showing it.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    [1] Packet Rate (packets/sec)
+    [2] PDR (%)
+    [3] Time (s)
+
+        +---------+
+        |   ___   |
+    [1] |  /   \\_ | [2]
+        |         |
+        +---------+
+            [3]
+
+    ==============================================================
+    """
+
+    Headless(save)
+    meta, records = dl.ReadDelayLog('./Logging/Rate/' + name + '.dlog')
+    if len(records) == 0:
+        raise ValueError('No feedback windows in ' + name)
+
+    # Seconds from the first report
+    t = (records['time'] - records['time'][0]) / 1e9
+
+    fig, ax = plt.subplots()
+    ax.step(t, records['rate'], where='post', color='tab:blue')
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Packet Rate (packets/sec)', color='tab:blue')
+
+    ax2 = ax.twinx()
+    ax2.plot(t, records['pdr'], '.', color='tab:red')
+    ax2.axhline(meta['target_pdr'], color='tab:red', linestyle='--', linewidth=0.8)
+    ax2.set_ylabel('PDR (%)', color='tab:red')
+
+    plt.title('Packet Rate vs. PDR per Feedback Window\n[Highest rate meeting ' + str(meta['target_pdr']) + '% PDR: ' + str(meta.get('best_rate', 'n/a')) + ' packets/sec]')
+    Show(fig, save)
+
+def PlotCompare(names: list, by: str = None, save: str = None, tail: float = 99.9) -> None:
+    """
+    Overlays the delay densities of several runs and, with [by], plots their delay percentiles against a parameter
+    of the runs stored in their logs (e.g. pkt_rate or distance), so a sweep can be read from one figure.
+
+    Every run is binned over the same range, from the smallest delay up to the largest [tail] percentile, so one
+    outlier does not squash the other curves (the percentiles are always over all samples).
+
+    Args:
+        names (list): The names or paths of the logs, patterns allowed (see ExpandNames()).
+        by (str): The metadata key to label and order the runs by, None to keep the given order.
+        save (str): Write the plot to this image (.png, .svg) instead of showing it.
+        tail (float): The percentile the shared x-axis ends at.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    [1] Density
+    [2] Packet Delay (ms)
+    [3] Delay percentiles (ms), p50 with p90/p99 above it
+    [4] [by]
+
+        +---------+   +---------+
+        |  /\\  _  |   |       ' |
+    [1] | /  \\/ \\ |   |   ' ' | | [3]
+        |/      \\_|   | ' | o o |
+        +---------+   +---------+
+            [2]           [4]
+
+    ==============================================================
+    """
+
+    Headless(save)
+
+    # Load every run once, keeping only what is plotted
+    runs = []
+    for name in ExpandNames(names):
+        meta, delays = LoadRun(name)
+        if len(delays) == 0:
+            print('Skipping ' + name + ' (no packets)')
+            continue
+        p50, p90, p99, high = np.percentile(delays, [50, 90, 99, tail])
+        runs.append({'name': os.path.splitext(os.path.basename(name))[0], 'meta': meta, 'delays': delays, 'p50': p50, 'p90': p90, 'p99': p99,
+                     'high': high, 'value': meta.get(by) if by is not None else None})
+    if not runs:
+        raise ValueError('No runs with packets to compare')
+    if by is not None:
+        missing = [run['name'] for run in runs if run['value'] is None]
+        if missing:
+            raise KeyError('No ' + by + ' in the metadata of ' + ', '.join(missing))
+        runs.sort(key=lambda run: run['value'])
+
+    limits = (min(float(np.min(run['delays'])) for run in runs), max(run['high'] for run in runs))
+
+    if by is None:
+        fig, ax = plt.subplots()
+    else:
+        fig, (ax, ax2) = plt.subplots(1, 2, figsize=(12, 5))
+
+    for run in runs:
+        x, density = BinnedKDE(run['delays'], limits)
+        label = run['name'] if by is None else by + ' = ' + str(run['value'])
+        ax.plot(x, density, label=label + ' (p50 ' + str(round(run['p50'], 2)) + ' ms)')
+    ax.set_xlabel('Packet Delay (ms)')
+    ax.set_ylabel('Density')
+    ax.set_title('Packet Delay of ' + str(len(runs)) + ' Runs')
+    ax.legend(fontsize='small')
+
+    if by is not None:
+        values = np.array([run['value'] for run in runs], dtype=float)
+        ax2.plot(values, [run['p50'] for run in runs], 'o-', label='p50')
+        ax2.plot(values, [run['p90'] for run in runs], '^--', label='p90')
+        ax2.plot(values, [run['p99'] for run in runs], 'v:', label='p99')
+        ax2.set_xlabel(by)
+        ax2.set_ylabel('Packet Delay (ms)')
+        ax2.set_title('Packet Delay vs. ' + by)
+        ax2.legend(fontsize='small')
+
+    fig.tight_layout()
+    Show(fig, save)
+
+def LivePlot(port: int, fps: float = 5, history: float = 60, save: str = None) -> None:
+    """
+    Attaches to the live statistics of the receiver on [port] (started with live=1) and redraws them [fps] times a
+    second. Only copies of the shared memory are drawn, so the receiver is never made to wait.
+
+    Args:
+        port (int): The receive port of the receiver.
+        fps (float): Redraws per second.
+        history (float): Seconds of packet rate and PDR kept on screen.
+        save (str): Write one frame to this image (.png, .svg) instead of showing the plot.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    [1] Recent Packet Delay (ms), with p50/p99 of the last window
+    [2] Delay Distribution of the recent packets
+    [3] Packet Rate (packets/sec)
+    [4] PDR of each window (%)
+
+        +---------+   +---------+
+    [1] | ~~^~~~~ |   |  _|_    | [2]
+        +---------+   +---------+
+    [3] | ___/--- |   | ------- | [4]
+        +---------+   +---------+
+
+    ==============================================================
+    """
+
+    Headless(save)
+    name = ls.SegmentName(port)
+
+    # Wait for the receiver to start
+    print('Waiting for the receiver on port ' + str(port) + ' (rx ... live=1)...')
+    reader = None
+    while reader is None:
+        try:
+            reader = ls.LiveReader(name)
+        except (FileNotFoundError, ValueError):
+            # Not created yet, or created but the header is not written yet
+            time.sleep(0.5)
+
+    fig, ((ax_delay, ax_hist), (ax_rate, ax_pdr)) = plt.subplots(2, 2, figsize=(12, 7))
+    times = []
+    rates = []
+    pdrs = []
+    state = {'reader': reader, 'time': None}
+
+    def Update(frame):
+        stats, delays = state['reader'].Snapshot()
+
+        # The receiver has stopped (or restarted under the same name), so try the newest segment
+        if stats['time'] and (time.time_ns() - stats['time'] > 2e9):
+            try:
+                newer = ls.LiveReader(name)
+                state['reader'].Close()
+                state['reader'] = newer
+            except (FileNotFoundError, ValueError):
+                pass
+
+        # Only add a point when the receiver has published a new window
+        if stats['time'] and (stats['time'] != state['time']):
+            state['time'] = stats['time']
+            times.append(stats['time'] / 1e9)
+            rates.append(stats['rate'])
+            pdrs.append(stats['pdr'])
+            while times and (times[-1] - times[0] > history):
+                times.pop(0)
+                rates.pop(0)
+                pdrs.pop(0)
+
+        delays = delays / 1000
+        for ax in (ax_delay, ax_hist, ax_rate, ax_pdr):
+            ax.clear()
+
+        ax_delay.plot(delays, color='tab:green', linewidth=0.6)
+        ax_delay.axhline(stats['p50'] / 1000, color='tab:blue', linestyle='--', linewidth=0.8, label='p50 ' + str(round(stats['p50'] / 1000, 3)) + ' ms')
+        ax_delay.axhline(stats['p99'] / 1000, color='tab:red', linestyle='--', linewidth=0.8, label='p99 ' + str(round(stats['p99'] / 1000, 3)) + ' ms')
+        ax_delay.set_xlabel('Last ' + str(len(delays)) + ' Packets')
+        ax_delay.set_ylabel('Packet Delay (ms)')
+        ax_delay.legend(loc='upper left', fontsize='small')
+
+        if len(delays):
+            percent, edges = Histogram(delays, 30)
+            ax_hist.bar(edges[:-1], percent, width=np.diff(edges), align='edge', color='lightgreen', edgecolor='red')
+        ax_hist.set_xlabel('Packet Delay (ms)')
+        ax_hist.set_ylabel('Density Percentage')
+
+        t = [x - times[-1] for x in times]
+        ax_rate.plot(t, rates, '.-', color='tab:blue')
+        ax_rate.set_xlabel('Time (s)')
+        ax_rate.set_ylabel('Packet Rate (packets/sec)')
+        ax_pdr.plot(t, pdrs, '.-', color='tab:red')
+        ax_pdr.set_ylim(min([90] + pdrs) - 1, 101)
+        ax_pdr.set_xlabel('Time (s)')
+        ax_pdr.set_ylabel('PDR (%)')
+
+        age = (time.time_ns() - stats['time']) / 1e9 if stats['time'] else 0
+        fig.suptitle('Receiver on port ' + str(port) + ': ' + str(stats['received']) + ' of ' + str(stats['expected']) + ' packets at '
+                     + str(round(stats['pkt_rate'])) + ' packets/sec' + (' [stopped ' + str(round(age)) + ' s ago]' if age > 2 else ''))
+
+    if save is not None:
+        # Wait for a first window so the frame is not empty
+        while reader.Snapshot()[0]['time'] == 0:
+            time.sleep(0.1)
+        Update(0)
+        Show(fig, save)
+    else:
+        # Held in state, or the animation is garbage collected before it runs
+        state['animation'] = animation.FuncAnimation(fig, Update, interval=1000 / fps, cache_frame_data=False)
+        plt.show()
+    state['reader'].Close()
+
+def ImagePath(name: str, out: str, fmt: str) -> str:
+    """
+    Gives the image a log is rendered to: [out]/[name].[fmt], with the directory of a log given by path in front of
+    its name so sweep points (point_000 in every sweep) do not overwrite each other.
+
+    Args:
+        name (str): The name or path of the log.
+        out (str): The image directory.
+        fmt (str): The image format, e.g. png or svg.
+
+    Returns:
+        path (str): The path of the image.
+    """
+
+    stem = os.path.splitext(os.path.basename(name))[0]
+    if name.endswith('.dlog') or name.endswith('.txt'):
+        stem = os.path.basename(os.path.dirname(os.path.abspath(name))) + '_' + stem
+    return os.path.join(out, stem + '.' + fmt)
+
+def RenderLog(name: str, save: str, bins: int) -> tuple:
+    """
+    Renders one log in a worker of PlotBatch(), catching any error so one bad log does not stop the batch.
+
+    Args:
+        name (str): The name or path of the log.
+        save (str): The image path.
+        bins (int): The number of histogram bins.
+
+    Returns:
+        name (str): The name or path of the log.
+        elapsed (float): The time taken in seconds.
+        error (str): What went wrong, None if the image was written.
+    """
+
+    # The parent prints the progress, so the 'Saved' line of each plot is dropped
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            PlotData(name, save, bins)
+    except Exception as e:
+        return name, time.perf_counter() - start, type(e).__name__ + ': ' + str(e)
+    finally:
+        # A plot that failed part way still has its figure open
+        plt.close('all')
+    return name, time.perf_counter() - start, None
+
+def PlotBatch(names: list, out: str = './Results/Plots', fmt: str = 'png', workers: int = None, force: bool = False, bins: int = 30) -> int:
+    """
+    Renders the delay plot (see PlotData()) of every log matching [names] to an image, across a pool of processes.
+
+    Logs whose image is already newer than the log are skipped, so rerunning after a field day only renders the
+    new runs. Workers are forked after matplotlib is imported and switched to the Agg backend, so neither the import
+    nor a display is needed per log.
+
+    Args:
+        names (list): The names or paths of the logs, patterns allowed (see ExpandNames()).
+        out (str): The image directory.
+        fmt (str): The image format, e.g. png or svg.
+        workers (int): The number of processes, defaults to the number of CPUs.
+        force (bool): Render every log even if its image is up to date.
+        bins (int): The number of histogram bins.
+
+    Returns:
+        failed (int): The number of logs that could not be rendered.
+
+    ==============================================================
+
+                       +----------+
+                   +-->| worker 1 |--> [out]/[name].[fmt]
+    +-----------+  |   +----------+
+    | logs      |--+        ...
+    | (pattern) |  |   +----------+
+    +-----------+  +-->| worker N |--> [out]/[name].[fmt]
+                       +----------+
+
+    1. Expand [names] into logs and skip those whose image is newer than the log (unless [force]).
+    2. Fork [workers] processes on the Agg backend.
+    3. Render each log to [out]/[name].[fmt] in whichever worker is free, printing each as it finishes.
+    4. Print how many were rendered, skipped, and failed.
+
+    ==============================================================
+    """
+
+    plt.switch_backend('Agg')
+    os.makedirs(out, exist_ok=True)
+
+    jobs = []
+    skipped = 0
+    for name in ExpandNames(names):
+        save = ImagePath(name, out, fmt)
+        if (not force) and os.path.exists(save) and (os.path.getmtime(save) >= os.path.getmtime(LogPath(name))):
+            skipped = skipped + 1
+            continue
+        jobs.append((name, save))
+    workers = max(1, min(workers or os.cpu_count() or 1, len(jobs) or 1))
+    print('Rendering %d logs with %d workers (%d up to date)...' % (len(jobs), workers, skipped))
+
+    start = time.perf_counter()
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+        futures = [pool.submit(RenderLog, name, save, bins) for name, save in jobs]
+        for future in concurrent.futures.as_completed(futures):
+            name, elapsed, error = future.result()
+            if error is None:
+                print('[%.2f s] %s' % (elapsed, name))
+            else:
+                failed = failed + 1
+                print('[failed] %s: %s' % (name, error))
+
+    print('\nRendered %d, skipped %d, failed %d in %.1f s' % (len(jobs) - failed, skipped, failed, time.perf_counter() - start))
+    return failed
 
 # String for help command
+lp_str = ("""
+==============
+  LivePlot()
+==============
+
+Attaches to the live statistics of the receiver on [port] (started with live=1) and redraws them [fps] times a
+second. Only copies of the shared memory are drawn, so the receiver is never made to wait.
+
+Args:
+    port (int): The receive port of the receiver.
+    fps (float): Redraws per second.
+    history (float): Seconds of packet rate and PDR kept on screen.
+    save (str): Write one frame to this image (.png, .svg) instead of showing the plot.
+
+Returns:
+    None
+
+==============================================================
+
+[1] Recent Packet Delay (ms), with p50/p99 of the last window
+[2] Delay Distribution of the recent packets
+[3] Packet Rate (packets/sec)
+[4] PDR of each window (%)
+
+    +---------+   +---------+
+[1] | ~~^~~~~ |   |  _|_    | [2]
+    +---------+   +---------+
+[3] | ___/--- |   | ------- | [4]
+    +---------+   +---------+
+
+==============================================================
+""")
+
 pd_str = ("""
 ==============
   PlotData()
 ==============
 
-Plots named data from ./Logging/Delay/[name].txt.
+Plots named data from ./Logging/Delay/[name].dlog (or [name].txt for older runs).
+
+The histogram and density are computed on binned data (see BinnedKDE()), so logs of millions of packets plot in
+about the time it takes to read them.
 
 Args:
-    name (str): The name of the data to be plotted.
+    name (str): The name of the data to be plotted (or the path of a log).
+    save (str): Write the plot to this image (.png, .svg) instead of showing it.
+    bins (int): The number of histogram bins.
 
 Returns:
     None
@@ -128,4 +707,112 @@ Returns:
         [7]
 
 ==============================================================
-""")
\ No newline at end of file
+""")
+
+pr_str = ("""
+==============
+  PlotRate()
+==============
+
+Plots the packet rate chosen by the rate controller against the PDR reported in each feedback window, from
+./Logging/Rate/[name].dlog.
+
+Args:
+    name (str): The name of the rate log.
+    save (str): Write the plot to this image (.png, .svg) instead of showing it.
+
+Returns:
+    None
+
+==============================================================
+
+[1] Packet Rate (packets/sec)
+[2] PDR (%)
+[3] Time (s)
+
+    +---------+
+    |   ___   |
+[1] |  /   \\_ | [2]
+    |         |
+    +---------+
+        [3]
+
+==============================================================
+""")
+
+pc_str = ("""
+=================
+  PlotCompare()
+=================
+
+Overlays the delay densities of several runs and, with [by], plots their delay percentiles against a parameter
+of the runs stored in their logs (e.g. pkt_rate or distance), so a sweep can be read from one figure.
+
+Every run is binned over the same range, from the smallest delay up to the largest [tail] percentile, so one
+outlier does not squash the other curves (the percentiles are always over all samples).
+
+Args:
+    names (list): The names or paths of the logs, patterns allowed (e.g. './Logging/Runs/sweep_001/point_*.dlog').
+    by (str): The metadata key to label and order the runs by, None to keep the given order.
+    save (str): Write the plot to this image (.png, .svg) instead of showing it.
+    tail (float): The percentile the shared x-axis ends at.
+
+Returns:
+    None
+
+==============================================================
+
+[1] Density
+[2] Packet Delay (ms)
+[3] Delay percentiles (ms), p50 with p90/p99 above it
+[4] [by]
+
+    +---------+   +---------+
+    |  /\\  _  |   |       ' |
+[1] | /  \\/ \\ |   |   ' ' | | [3]
+    |/      \\_|   | ' | o o |
+    +---------+   +---------+
+        [2]           [4]
+
+==============================================================
+""")
+
+pb_str = ("""
+===============
+  PlotBatch()
+===============
+
+Renders the delay plot (see PlotData()) of every log matching [names] to an image, across a pool of processes.
+
+Logs whose image is already newer than the log are skipped, so rerunning after a field day only renders the
+new runs. Workers are forked after matplotlib is imported and switched to the Agg backend, so neither the import
+nor a display is needed per log.
+
+Args:
+    names (list): The names or paths of the logs, patterns allowed (see ExpandNames()).
+    out (str): The image directory.
+    fmt (str): The image format, e.g. png or svg.
+    workers (int): The number of processes, defaults to the number of CPUs.
+    force (bool): Render every log even if its image is up to date.
+    bins (int): The number of histogram bins.
+
+Returns:
+    failed (int): The number of logs that could not be rendered.
+
+==============================================================
+
+                   +----------+
+               +-->| worker 1 |--> [out]/[name].[fmt]
++-----------+  |   +----------+
+| logs      |--+        ...
+| (pattern) |  |   +----------+
++-----------+  +-->| worker N |--> [out]/[name].[fmt]
+                   +----------+
+
+1. Expand [names] into logs and skip those whose image is newer than the log (unless [force]).
+2. Fork [workers] processes on the Agg backend.
+3. Render each log to [out]/[name].[fmt] in whichever worker is free, printing each as it finishes.
+4. Print how many were rendered, skipped, and failed.
+
+==============================================================
+""")
@@ -4,24 +4,274 @@ Jonah Duncan, 04/11/24 - 05/30/24, CV2X Receiver Tools
 import time
 import socket
 import sys
-import pickle
 import datetime
 from operator import*
 
 # Ignore warnings here -- importing self-made packages
 import utilities as ut
+import packet as pk
+import sockio as so
+import stats as st
+import delaylog as dl
+import console as co
+import control as ct
+import livestats as ls
+import metrics as mt
 
 import geopy.distance
 
-def ReceivePackets(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int) -> None:
+def LogMeta(loss: dict, latency: dict, pkt_rate: int, cal_time: float, dist: float, overhead: dict = None, fragments: dict = None) -> dict:
+    """
+    Builds the metadata written into the header of a delay log at the end of a run.
+
+    Args:
+        loss (dict): The loss statistics from SequenceTracker.Finalize().
+        latency (dict): The latency statistics from LatencyHistogram.Report() in ms.
+        pkt_rate (int): The packet rate given by the transmitter.
+        cal_time (float): The total calibration time (already taken out of every timestamp).
+        dist (float): The distance between the MK6s in meters.
+        overhead (dict): The kernel to application time statistics in ms, when kernel timestamps were used.
+        fragments (dict): The datagram-level statistics from Reassembler.Report(), when packets were fragmented.
+
+    Returns:
+        meta (dict): The metadata for DelayLogWriter.Close().
+    """
+
+    # Add number of packets expected, PDR (unique packets received over packets sent), pkt_rate, total calibration
+    # time (already taken out of every timestamp), and distance for plotting
+    meta = {'pkt_tot': loss['expected'], 'pdr': loss['pdr'], 'pkt_rate': pkt_rate, 'calibration': cal_time, 'delay_offset': 0, 'distance': dist}
+
+    # Loss, reordering, and duplicate statistics
+    meta.update(loss)
+
+    # Latency statistics from the histogram (in seconds like the delays)
+    meta.update({key: value / 1000 for key, value in latency.items() if key != 'count'})
+
+    # Time between the kernel receiving each packet and the program getting it (already left out of the delays)
+    if overhead is not None:
+        meta.update({'overhead_' + key: value / 1000 for key, value in overhead.items() if key != 'count'})
+
+    # Loss and latency above are per frame, fragments give the delivery of the datagrams themselves
+    if fragments is not None:
+        meta.update(fragments)
+
+    return meta
+
+def CollectPackets(receiver: so.BatchReceiver, pkt_tot: int, calibrator: ut.ClockCalibrator, rx_coord: tuple, dist: float, log: dl.DelayLogWriter,
+                   console: co.Console, rx_timeout: float = 10, drain_timeout: float = 1, timer: st.StageTimer = None, start_timeout: float = None,
+                   feedback: ct.FeedbackSender = None, live: ls.LivePublisher = None, metrics: mt.MetricsServer = None, point: int = None) -> dict:
+    """
+    Receives [pkt_tot] packets (the receive loop of ReceivePackets() without any prompts), logging each one.
+
+    Args:
+        receiver (BatchReceiver): Drains the bound UDP socket.
+        pkt_tot (int): The number of packets to receive. -1 receives until the socket times out or Ctrl+C.
+        calibrator (ClockCalibrator): Corrects receive times onto the GNSS clock.
+        rx_coord (tuple): The receiver (latitude, longitude).
+        dist (float): The distance between the MK6s in meters, None to take it from the first packet.
+        log (DelayLogWriter): Where every packet is logged.
+        console (Console): Where progress is printed.
+        rx_timeout (float): The run ends if nothing arrives for this many seconds.
+        drain_timeout (float): The shorter wait for stragglers once the last packet has arrived.
+        timer (StageTimer): Charges the CPU time of each stage of the loop, if given.
+        start_timeout (float): How long to wait for the first packet (warmup included), defaults to [rx_timeout].
+        feedback (FeedbackSender): Reports loss and latency back to the transmitter every window, if given.
+        live (LivePublisher): Publishes rolling statistics and recent delays to shared memory, if given.
+        metrics (MetricsServer): Serves the loss and latency statistics on a local HTTP endpoint, if given.
+        point (int): Only count packets of this sweep point, ending when a later point starts, None for every packet.
+
+    Returns:
+        result (dict): The SequenceTracker, LatencyHistogram, bad, warmup, and stray packet counts, packet rate, calibration time,
+            distance, whether the run was interrupted, (with kernel timestamps) a LatencyHistogram of the kernel to
+            application time, and the Reassembler for fragmented frames.
+    """
+
+    # Sequence numbers tell loss apart from reordering and duplicates (transmitter numbers packets from 0)
+    tracker = st.SequenceTracker(base=0)
+
+    # Latency statistics in fixed memory (delays recorded in us), summarized every second while receiving
+    histogram = st.LatencyHistogram()
+    last_report_cnt = 0
+
+    # With kernel timestamps the delay is measured from the kernel arrival time and the rest is kept separately
+    kernel_ts = receiver.timestamps
+    overhead = st.LatencyHistogram() if kernel_ts else None
+
+    # Fragmented frames are counted and timed once their last fragment is in
+    reassembler = pk.Reassembler()
+
+    # The metrics endpoint reads these objects when it is scraped, the loop itself does nothing extra
+    if metrics is not None:
+        metrics.Add(mt.ReceiverMetrics(tracker, histogram, overhead, receiver, timer))
+
+    # Set up some variables for later use
+    bad_cnt = 0
+    warmup_cnt = 0
+    stray_cnt = 0
+    started = False
+    next_point = False
+    interrupted = False
+    pkt_rate = 0
+    cal_time = 0
+    delay = 0
+
+    # CPU time per stage is only measured when benchmarking
+    timer = timer or st.NULL_TIMER
+
+    # A scripted run may have to wait a long time for the transmitter to start, but not between packets
+    if start_timeout is None:
+        start_timeout = rx_timeout
+
+    try:
+        # Receive until every packet has arrived once (or forever if pkt_tot is -1) or the socket times out
+        while (tracker.received < pkt_tot) or (pkt_tot == -1):
+
+            # Receive up to [batch] packets from socket, stopping if nothing arrives for rx_timeout
+            timeout = rx_timeout if started else start_timeout
+            if feedback is None:
+                pkt_n = receiver.Recv(timeout)
+            else:
+                # Wake up every feedback window while waiting, so the transmitter hears about an outage and slows down
+                deadline = time.monotonic() + timeout
+                pkt_n = 0
+                while (pkt_n == 0) and (time.monotonic() < deadline):
+                    pkt_n = receiver.Recv(min(feedback.period, deadline - time.monotonic()))
+                    if pkt_n == 0:
+                        feedback.Due(tracker, pkt_rate)
+            if pkt_n == 0:
+                break
+            timer.Lap('receive')
+
+            # Stamp arrival (drift-corrected onto the GNSS clock) as soon as the batch is in, before any decoding
+            user_time = calibrator.Now()
+
+            for i in range(pkt_n):
+
+                # Decode the header and labels from the transmitter, anything that is not a valid packet is skipped
+                try:
+                    header, predicted_labels = pk.DecodePacket(receiver.pkts[i])
+                    timer.Lap('decode')
+                except ValueError as e:
+                    bad_cnt = bad_cnt + 1
+                    console.Log(co.NORMAL, 'Bad packet from %s: %s', receiver.Address(i), e)
+                    continue
+
+                # A straggler from an earlier point is not counted, and the next point starting ends this one (the rest
+                # of the batch is lost to it, but that is its warmup)
+                if (point is not None) and (header.point != point):
+                    stray_cnt = stray_cnt + 1
+                    if header.point > point:
+                        next_point = True
+                        break
+                    continue
+
+                # The transmitter has started, from here on the run ends once it goes quiet
+                started = True
+
+                # Warmup packets only settle the path ahead of the measured ones
+                if header.flags & pk.FLAG_WARMUP:
+                    warmup_cnt = warmup_cnt + 1
+                    continue
+
+                # Kernel arrival time of this packet, moved onto the GNSS clock the same way (the batch time without one)
+                rx_time = user_time
+                if kernel_ts and receiver.stamps[i]:
+                    rx_time = calibrator.Correct(receiver.stamps[i])
+                    overhead.Record(max(0, round((user_time - rx_time) / 1e3)))
+
+                # A fragment only counts once it completes its frame, which then arrived with its last fragment
+                if header.flags & pk.FLAG_FRAGMENT:
+                    try:
+                        body = reassembler.Add(header, receiver.pkts[i], rx_time)
+                        if body is None:
+                            continue
+                        predicted_labels = pk.DecodeLabels(body)
+                    except ValueError as e:
+                        bad_cnt = bad_cnt + 1
+                        console.Log(co.NORMAL, 'Bad fragment from %s: %s', receiver.Address(i), e)
+                        continue
+
+                # Keep track of packets received, duplicates and packets older than the window are not timed again
+                result = tracker.Record(header.seq)
+                if result >= st.DUPLICATE:
+                    continue
+
+                # Once the last packet is in only wait briefly for any that were reordered behind it
+                if (pkt_tot != -1) and (tracker.highest >= pkt_tot - 1):
+                    rx_timeout = drain_timeout
+
+                # Get packet rate from the header
+                pkt_rate = header.pkt_rate
+
+                # Calculate the overall calibration time of the system (time added by interfaces, ssh, etc.)
+                # Both timestamps are already corrected onto the GNSS clock, so this is only kept for the log
+                cal_time = calibrator.Offset(rx_time) / 1e9 - header.calibration
+
+                # Take the distance from the transmitter coordinates if they were not entered
+                if dist is None:
+                    tx_coord = (header.tx_latitude, header.tx_longitude)
+                    dist = geopy.distance.geodesic(rx_coord, tx_coord).m
+                    console.Log(co.NORMAL, '\nDistance between MK6s: %s meters\n', dist)
+
+                # Compute/store the time between the transmitter/receiver (calibration already applied to both)
+                delay = (rx_time - header.tx_time) / 1e9
+                # A frame is logged with the size it would have had unfragmented
+                size = pk.HEADER.size + len(body) if header.flags & pk.FLAG_FRAGMENT else len(receiver.pkts[i])
+                log.Write(header.seq, header.tx_time, rx_time, size, header.source, user_time)
+                histogram.Record(round(1e6 * abs(delay)))
+                if feedback is not None:
+                    feedback.Record(round(1e6 * abs(delay)))
+                if live is not None:
+                    live.Record(round(1e6 * abs(delay)))
+                timer.Lap('record')
+
+                console.Log(co.VERBOSE, '%s', predicted_labels)
+
+            # Let the transmitter know how the last window went so it can adapt its rate
+            if feedback is not None:
+                feedback.Due(tracker, pkt_rate)
+
+            # Hand the live plot (see livestats.py) this window, a copy into shared memory a few times a second
+            if live is not None:
+                live.Due(tracker, pkt_rate)
+
+            # Print a rolling summary so a long run can be watched while it is still going (timed from the first packet)
+            if console.Due():
+                expected = tracker.received if tracker.highest is None else tracker.highest - tracker.base + 1
+                console.Log(co.NORMAL, '\n[Rx] %d pkts (%.0f pkts/s), lost %d, latency %s\n',
+                            tracker.received, (tracker.received - last_report_cnt) / console.period, expected - tracker.received, histogram.Summary())
+                last_report_cnt = tracker.received
+
+            timer.Lap('other')
+
+            if next_point:
+                break
+
+    except KeyboardInterrupt:
+        # Stop receiving but still write out what has been received (how an endless run is ended)
+        console.Log(co.QUIET, 'Interrupted')
+        interrupted = True
+
+    return {'tracker': tracker, 'histogram': histogram, 'bad': bad_cnt, 'warmup': warmup_cnt, 'stray': stray_cnt, 'pkt_rate': pkt_rate, 'cal_time': cal_time, 'dist': dist,
+            'interrupted': interrupted, 'overhead': overhead, 'reassembler': reassembler}
+
+def ReceivePackets(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int, batch: int = 1, verbosity: int = co.NORMAL, kernel_ts: bool = False,
+                   feedback: str = None, feedback_period: float = 0.5, live: bool = False, metrics: int = None) -> None:
     """
     Receive [pkt_tot] UDP packets from IPv4 IP [mk6_addr] on port [mk6_port] with [cal_runs] calibration runs.
 
     Args:
         mk6_addr (str): The IP address of the MK6 radio.
         mk6_port (int): The port of the MK6 radio.
-        pkt_tot  (int): The number of packets to receive.
+        pkt_tot  (int): The number of packets to receive. -1 receives until the socket times out or Ctrl+C.
         cal_runs (int): The number of calibration runs to undergo
+        batch    (int): The most datagrams drained from the socket with a single recvmmsg() call.
+        verbosity (int): 0 prints only the final results, 1 adds a summary every second, 2 adds every packet.
+        kernel_ts (bool): Measure delays from the kernel arrival time of each packet (SO_TIMESTAMPNS, Linux).
+        feedback (str): The 'host:port' of a transmitter adapting its rate (see control.py), None for no feedback.
+        feedback_period (float): How often feedback is sent in seconds.
+        live (bool): Publish rolling statistics to shared memory for the live plot (python3 main.py lp [mk6_port]).
+        metrics (int): Serve Prometheus metrics on this local TCP port, None for no endpoint.
     
     Returns:
         None
@@ -37,12 +287,19 @@ def ReceivePackets(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int) ->
     +---+                  +-------------------------------------+
 
     1. Retrieve receiver coordinates from [log.txt] and calculate distance between MK6s.
-    2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC.
+    2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
     3. Provide user with MK6 acme command to receive data.
     4. Create a UDP socket, bind, and increase receive buffer.
     5. Receive UDP packets, extract data, calculate delay, and store relevant information for analysis.
-    6. Convert byte stream to dictionary data, unpickle it.
-    7. Log the delay information along with other metrics like packet delivery rate, packet rate, and calibration time.
+    6. Decode the packet header and dictionary data (see packet.py).
+    7. Track sequence numbers for exact PDR, loss bursts, reordering, and duplicates.
+    8. Log per-packet timestamps to a binary delay log with metrics like packet delivery rate, packet rate, and calibration time.
+    9. Print a rolling summary every second (every packet at [verbosity] 2) from a background thread.
+    10. With [kernel_ts], take arrival times from the kernel and log the time the program got each packet next to them.
+    11. Reassemble fragmented packets in bounded memory, reporting frame and fragment delivery separately.
+    12. With [feedback], report the loss and latency of every [feedback_period] window back to the transmitter.
+    13. With [live], publish rolling rate, PDR, percentiles, and the last delays to shared memory for the live plot.
+    14. With [metrics], serve counters, delay, stage, and GC pause histograms, and kernel socket drops at http://127.0.0.1:[metrics]/metrics.
 
     ==============================================================
     """
@@ -54,19 +311,28 @@ def ReceivePackets(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int) ->
     print('\nRx Latitude: ' + str(rx_latitude) + '\n')
     print('Rx Longitude: ' + str(rx_longitude))
 
-    tx_latitude = input("\nPlease enter Tx Latitude\n")
-    tx_longitude = input("\nPlease enter Tx Longitude\n")
+    tx_latitude = input("\nPlease enter Tx Latitude (or press Enter to use the coordinates sent by the transmitter)\n")
+    tx_longitude = input("\nPlease enter Tx Longitude (or press Enter to use the coordinates sent by the transmitter)\n")
 
     rx_coord = (rx_latitude, rx_longitude)
-    tx_coord = (tx_latitude, tx_longitude)
 
-    dist = geopy.distance.geodesic(rx_coord, tx_coord).m
-
-    print('\nDistance between MK6s: ' + str(dist) + ' meters')
+    # Every packet header carries the transmitter coordinates, so the distance can wait for the first packet
+    if (tx_latitude == "") or (tx_longitude == ""):
+        dist = None
+        print('\nDistance between MK6s will be taken from the first packet')
+    else:
+        tx_coord = (tx_latitude, tx_longitude)
+        dist = geopy.distance.geodesic(rx_coord, tx_coord).m
+        print('\nDistance between MK6s: ' + str(dist) + ' meters')
 
     # Returns the averaged time difference between the GNSS (MK6) time and the current PC time
     rx_cal_time = ut.CalibrationDialogue(cal_runs)
 
+    # Keep refining the offset (and drift) from the MK6 log in the background while receiving, if calibration was run
+    calibrator = ut.ClockCalibrator('log.txt', rx_cal_time)
+    if rx_cal_time != 0:
+        calibrator.start()
+
     # Give user command to run on MK6
     interface = 'eth0'
     mk6_cmd = ("acme -R -P 111 -x " + interface + " -X " + mk6_addr + " -Y " + str(mk6_port) + " -d")
@@ -84,89 +350,106 @@ def ReceivePackets(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int) ->
     # Bind UDP socket to host and port
     rxsock.bind((mk6_addr, mk6_port))
 
-    # set socket timeout
-    rxsock.settimeout(10)
-    
-    # Set up some variables for later use
-    pkt_cnt = pkt_tot
-    delay = 0
-    delay_arr = []
+    # Drain the socket in bulk into preallocated buffers (a recvfrom_into() loop if recvmmsg() is unavailable)
+    # 1024 works for now but may need to be modified in the future
+    # Kernel timestamps keep scheduling, Python, and decoding out of the measured delay
+    # With metrics the kernel also reports what it dropped on the socket (SO_RXQ_OVFL)
+    receiver = so.BatchReceiver(rxsock, batch, 1024, kernel_ts, overflow=metrics is not None)
+
+    # Printing happens on a background thread so the terminal can not delay the receive timestamps
+    console = co.Console(verbosity)
+
+    # Loss and latency reports for a transmitter adapting its rate
+    sender = ct.FeedbackSender(ct.ParseAddress(feedback), feedback_period) if feedback is not None else None
+
+    # Rolling statistics for a live plot, which reads them without ever blocking this process
+    publisher = ls.LivePublisher(ls.SegmentName(mk6_port)) if live else None
+
+    # Counters and histograms (including the CPU time of every stage of the loop) for a scraper, see metrics.py
+    exporter = None
+    timer = None
+    if metrics is not None:
+        exporter = mt.MetricsServer(metrics)
+        exporter.Start()
+        timer = st.StageTimer(histograms=True)
+
+    # Get the current time and convert it to a string for later file naming
+    now = datetime.datetime.now()
+    datestr = now.strftime("%Y_%m_%d_%H_%M_%S_%p") + ".dlog"
+
+    # Packets are written to a binary log (see delaylog.py) as they arrive rather than held in memory until the end
+    log = dl.DelayLogWriter('./Logging/Delay/' + "delay_log_" + datestr, {'start_time': now.isoformat(), 'rx_latitude': rx_latitude, 'rx_longitude': rx_longitude})
 
     print ('\nReceiving...\n')
         
     try:
-        # Unlike the sender we count down the packets received from the packet number specified
-        while pkt_cnt > 0:
-                
-            # Keep track of packets received
-            pkt_cnt = pkt_cnt - 1
-
-            # Receive pickled_predicted_labels from socket (address still unused)
-            # 1024 works for now but may need to be modified in the future
-            try:
-                pickled_predicted_labels, address = rxsock.recvfrom(1024)
-            except:
-                break
+        # Receive until every packet has arrived once, the socket times out, or Ctrl+C
+        result = CollectPackets(receiver, pkt_tot, calibrator, rx_coord, dist, log, console, timer=timer, feedback=sender, live=publisher, metrics=exporter)
+        tracker = result['tracker']
+        histogram = result['histogram']
+        bad_cnt = result['bad']
+        pkt_rate = result['pkt_rate']
+        cal_time = result['cal_time'] if tracker.received else rx_cal_time
+        dist = result['dist']
+        overhead = result['overhead']
+        reassembler = result['reassembler']
 
-            # Depickle the data from the transmitter
-            predicted_labels = pickle.loads(pickled_predicted_labels)
-
-            # Get packet rate from received data and remove data (as it is stored now)
-            pkt_rate = predicted_labels["pkt_rate"]
-            predicted_labels.popitem()
-
-            # Get transmitter calibration from received data and remove data (as it is stored now)
-            tx_cal_time = predicted_labels["calibration"]
-            predicted_labels.popitem()
-            
-            # Calculate the overall calibration time of the system (time added by interfaces, ssh, etc.)
-            cal_time = rx_cal_time + tx_cal_time 
-
-            # Get transmitter time from received data and remove data (as it is stored now)
-            tx_time = predicted_labels["time"]
-            predicted_labels.popitem()
-
-            # Compute/store the time between the transmitter/receiver omitting calibibration time
-            rx_time = time.time()
-            delay = rx_time - tx_time - cal_time
-            delay_arr.append(abs(delay))
-            
-            print(predicted_labels)
-
-        if(pkt_cnt == 0):
-            print ('\nTotal packets received: %d\n' % (pkt_tot))
-        else:
-            # Example: 1000 pkts sent, 800 left in pkt_cnt => 1000 - 800 = 200 received  
-            print ('\nTotal packets received: %d\n' % (pkt_tot - pkt_cnt))
-
-        if(pkt_cnt > 0):
-            print('Packets Dropped: '+ str(pkt_cnt) + '\n')
-
-        # Add PDR for plotting
-        # If pkt_cnt == 0 that means all packets were received -- so packet delivery rate is 100%
-        if(pkt_cnt == 0):
-            pdr = 100
-        else:
-            pdr = 100 * ((pkt_tot - pkt_cnt) / pkt_tot)
-
-        # Add number of packets expected, pdr, pkt_rate, and total calibration time for plotting
-        delay_arr.append(pkt_tot)
-        delay_arr.append(abs(pdr))
-        delay_arr.append(round(pkt_rate))
-        delay_arr.append(abs(cal_time))
-        delay_arr.append(dist)
-
-        # Get the current time and convert it to a string for later file naming
-        now = datetime.datetime.now()
-        datestr = now.strftime("%Y_%m_%d_%H_%M_%S_%p") + ".txt"
-
-        # Create a text log that contains pkt_cnt of packets, and prior delay_arr additions
-        with open('./Logging/Delay/' + "delay_log_" + datestr, 'w') as fp:
-            fp.write("\n".join(str(item) for item in delay_arr))
-        
+        # Anything not received by now is lost
+        loss = tracker.Finalize(pkt_tot if pkt_tot != -1 else None)
+        latency = histogram.Report(1e-3)
+
+        console.Log(co.QUIET, '\nTotal packets received: %d\n', loss['received'])
+
+        if(loss['lost'] > 0):
+            console.Log(co.QUIET, 'Packets Dropped: %d in %d bursts (longest %d)\n', loss['lost'], loss['bursts'], loss['burst_max'])
+
+        if(loss['reordered'] > 0):
+            console.Log(co.QUIET, 'Packets Reordered: %d (furthest %d packets)\n', loss['reordered'], loss['reorder_max'])
+
+        if(loss['duplicates'] + loss['late'] > 0):
+            console.Log(co.QUIET, 'Duplicate/Late Packets: %d/%d\n', loss['duplicates'], loss['late'])
+
+        if(bad_cnt > 0):
+            console.Log(co.QUIET, 'Bad Packets: %d\n', bad_cnt)
+
+        console.Log(co.QUIET, 'Latency: %s\n', histogram.Summary())
+
+        if overhead is not None:
+            console.Log(co.QUIET, 'Kernel to application: %s\n', overhead.Summary())
+
+        # Delivery and latency above count whole frames, these are the datagrams they were split into
+        fragments = None
+        if reassembler.fragments > 0:
+            fragments = reassembler.Report(loss['expected'])
+            console.Log(co.QUIET, 'Fragments: %d received (%.2f%% delivered, %d duplicate), frames expired/evicted/incomplete: %d/%d/%d\n',
+                        fragments['fragments'], fragments['fragment_pdr'], fragments['fragment_duplicates'], fragments['frames_expired'],
+                        fragments['frames_evicted'], fragments['frames_incomplete'])
+
+        # No packets arrived to take the distance from
+        if dist is None:
+            dist = 0
+
+        # Finish the log by writing the metadata (PDR, loss, latency, calibration, distance) into its header
+        log.Close(LogMeta(loss, latency, pkt_rate, cal_time, dist, overhead.Report(1e-3) if overhead is not None else None, fragments))
+
+        if rx_cal_time != 0:
+            calibrator.Stop()
+            console.Log(co.QUIET, calibrator.Summary() + '\n')
+
+        if sender is not None:
+            sender.Close()
+
+        if publisher is not None:
+            publisher.Close()
+
+        if exporter is not None:
+            exporter.Stop()
+
+        console.Close()
         rxsock.close()
     
     except KeyboardInterrupt:
+        console.Close()
         print('Interrupted')
         sys.exit(1)
     except Exception as e:
@@ -184,8 +467,15 @@ Receive [pkt_tot] UDP packets from IPv4 IP [mk6_addr] on port [mk6_port] with [c
 Args:
     mk6_addr (str): The IP address of the MK6 radio.
     mk6_port (int): The port of the MK6 radio.
-    pkt_tot  (int): The number of packets to receive.
+    pkt_tot  (int): The number of packets to receive. -1 receives until the socket times out or Ctrl+C.
     cal_runs (int): The number of calibration runs to undergo
+    batch    (int): The most datagrams drained from the socket with a single recvmmsg() call.
+    verbosity (int): 0 prints only the final results, 1 adds a summary every second, 2 adds every packet.
+    kernel_ts (bool): Measure delays from the kernel arrival time of each packet (SO_TIMESTAMPNS, Linux).
+    feedback (str): The 'host:port' of a transmitter adapting its rate (see control.py), None for no feedback.
+    feedback_period (float): How often feedback is sent in seconds.
+    live (bool): Publish rolling statistics to shared memory for the live plot (python3 main.py lp [mk6_port]).
+    metrics (int): Serve Prometheus metrics on this local TCP port, None for no endpoint.
 
 Returns:
     None
@@ -201,12 +491,19 @@ TX                     RX
 +---+                  +-------------------------------------+
 
 1. Retrieve receiver coordinates from [log.txt] and calculate distance between MK6s.
-2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC.
+2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
 3. Provide user with MK6 acme command to receive data.
 4. Create a UDP socket, bind, and increase receive buffer.
 5. Receive UDP packets, extract data, calculate delay, and store relevant information for analysis.
-6. Convert byte stream to dictionary data, unpickle it.
-7. Log the delay information along with other metrics like packet delivery rate, packet rate, and calibration time.
+6. Decode the packet header and dictionary data (see packet.py).
+7. Track sequence numbers for exact PDR, loss bursts, reordering, and duplicates.
+8. Log per-packet timestamps to a binary delay log with metrics like packet delivery rate, packet rate, and calibration time.
+9. Print a rolling summary every second (every packet at [verbosity] 2) from a background thread.
+10. With [kernel_ts], take arrival times from the kernel and log the time the program got each packet next to them.
+11. Reassemble fragmented packets in bounded memory, reporting frame and fragment delivery separately.
+12. With [feedback], report the loss and latency of every [feedback_period] window back to the transmitter.
+13. With [live], publish rolling rate, PDR, percentiles, and the last delays to shared memory for the live plot.
+14. With [metrics], serve counters, delay, stage, and GC pause histograms, and kernel socket drops at http://127.0.0.1:[metrics]/metrics.
 
 ==============================================================
 """)
@@ -0,0 +1,308 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Run Index Tools
+'''
+import os
+import json
+import time
+import sqlite3
+import datetime
+import numpy as np
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import delaylog as dl
+
+# Index format version, an index of another version is rebuilt from the logs
+VERSION = 1
+
+# Columns of the runs table (delays in ms), the only names that filters, sorting, and output may use
+COLUMNS = [('name', 'TEXT PRIMARY KEY'), ('path', 'TEXT'), ('mtime', 'INTEGER'), ('size', 'INTEGER'), ('kind', 'TEXT'), ('start_time', 'TEXT'),
+           ('packets', 'INTEGER'), ('pkt_tot', 'INTEGER'), ('pdr', 'REAL'), ('pkt_rate', 'REAL'), ('calibration', 'REAL'), ('distance', 'REAL'),
+           ('lost', 'INTEGER'), ('mean', 'REAL'), ('p50', 'REAL'), ('p90', 'REAL'), ('p99', 'REAL'), ('p999', 'REAL'), ('max', 'REAL'),
+           ('meta', 'TEXT')]
+NAMES = [name for name, _ in COLUMNS]
+
+# Columns worth an SQL index, the ones runs are usually picked by
+INDEXED = ['pkt_rate', 'distance', 'start_time']
+
+# Columns printed when none are asked for
+DEFAULT_FIELDS = ['name', 'start_time', 'packets', 'pdr', 'pkt_rate', 'distance', 'p50', 'p99']
+
+def OpenIndex(path: str) -> sqlite3.Connection:
+    """
+    Opens (or creates) the index database, starting it again if it was made by another version.
+
+    Args:
+        path (str): The path of the database.
+
+    Returns:
+        conn (Connection): The open database.
+    """
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+
+    if conn.execute('PRAGMA user_version').fetchone()[0] != VERSION:
+        conn.execute('DROP TABLE IF EXISTS runs')
+        conn.execute('PRAGMA user_version = ' + str(VERSION))
+    conn.execute('CREATE TABLE IF NOT EXISTS runs (' + ', '.join(name + ' ' + kind for name, kind in COLUMNS) + ')')
+    for name in INDEXED:
+        conn.execute('CREATE INDEX IF NOT EXISTS runs_' + name + ' ON runs (' + name + ')')
+    conn.commit()
+    return conn
+
+def StartTime(name: str, mtime: float) -> str:
+    """
+    Gives the start of a run from the date in its log name ([kind]_log_[date]...), or the time the log was last
+    written if the name has no date.
+
+    Args:
+        name (str): The name of the log.
+        mtime (float): The modification time of the log in seconds since the epoch.
+
+    Returns:
+        start_time (str): The start time in ISO format.
+    """
+
+    parts = name.split('_')[2:8]
+    try:
+        return datetime.datetime(*[int(part) for part in parts]).isoformat()
+    except (TypeError, ValueError):
+        return datetime.datetime.fromtimestamp(mtime).isoformat(timespec='seconds')
+
+def Summarize(path: str, name: str, stat: os.stat_result) -> dict:
+    """
+    Reads a log once and reduces it to one row of the index: its metadata and its delay percentiles.
+
+    Args:
+        path (str): The path of the log.
+        name (str): The name of the log (the file name without the extension).
+        stat (stat_result): The os.stat() of the log, to tell later if it changed.
+
+    Returns:
+        row (dict): The values of every column.
+    """
+
+    meta, delays = dl.LoadDelays(path)
+    delays = np.abs(np.asarray(delays, dtype=np.float64)) * 1000
+
+    row = {'name': name, 'path': path, 'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'kind': name.split('_')[0],
+           'start_time': StartTime(name, stat.st_mtime), 'packets': len(delays), 'meta': json.dumps(meta)}
+    for key in ['pkt_tot', 'pdr', 'pkt_rate', 'calibration', 'distance', 'lost']:
+        row[key] = meta.get(key)
+    for key in ['pkt_tot', 'lost']:
+        if row[key] is not None:
+            row[key] = int(row[key])
+
+    if len(delays):
+        p50, p90, p99, p999 = np.percentile(delays, [50, 90, 99, 99.9])
+        row.update({'mean': float(np.mean(delays)), 'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'p999': float(p999),
+                    'max': float(np.max(delays))})
+    else:
+        row.update({'mean': None, 'p50': None, 'p90': None, 'p99': None, 'p999': None, 'max': None})
+    return row
+
+def UpdateIndex(conn: sqlite3.Connection, directory: str = './Logging/Delay') -> tuple:
+    """
+    Brings the index up to date with [directory]: only logs that are new or whose modification time or size changed
+    are read again, and runs whose log is gone are removed. A run with both a text and a binary log is indexed from
+    the binary one.
+
+    Args:
+        conn (Connection): The open index.
+        directory (str): The directory of delay logs.
+
+    Returns:
+        added (int): The number of runs (re)indexed.
+        removed (int): The number of runs removed.
+    """
+
+    # Name -> path, binary logs over the text logs they were converted from
+    logs = {}
+    for entry in os.scandir(directory):
+        name, ext = os.path.splitext(entry.name)
+        if (ext == '.dlog') or ((ext == '.txt') and (name not in logs)):
+            logs[name] = entry.path
+
+    known = {row['name']: (row['path'], row['mtime'], row['size']) for row in conn.execute('SELECT name, path, mtime, size FROM runs')}
+
+    added = 0
+    insert = 'INSERT OR REPLACE INTO runs (' + ', '.join(NAMES) + ') VALUES (' + ', '.join('?' * len(NAMES)) + ')'
+    for name, path in sorted(logs.items()):
+        stat = os.stat(path)
+        if known.get(name) == (path, stat.st_mtime_ns, stat.st_size):
+            continue
+        try:
+            row = Summarize(path, name, stat)
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            # Left out of the index (and tried again next time) rather than stopping the scan
+            print('Skipping ' + path + ': ' + str(e))
+            continue
+        conn.execute(insert, [row[key] for key in NAMES])
+        added = added + 1
+
+    gone = [(name,) for name in known if name not in logs]
+    conn.executemany('DELETE FROM runs WHERE name = ?', gone)
+    conn.commit()
+    return added, len(gone)
+
+def QueryIndex(conn: sqlite3.Connection, filters: dict = None, fields: list = None, sort: str = 'start_time', limit: int = None) -> list:
+    """
+    Selects runs from the index. Filters are min_[column], max_[column] (inclusive), or [column] (equal), and every
+    column name is checked against COLUMNS before it goes into the query; values are always passed as parameters.
+
+    Args:
+        conn (Connection): The open index.
+        filters (dict): The filters, e.g. {'min_pkt_rate': '500', 'min_distance': '200'}.
+        fields (list): The columns to give back, defaults to DEFAULT_FIELDS.
+        sort (str): The column to order by, '-[column]' for descending.
+        limit (int): The most runs to give back, None for all.
+
+    Returns:
+        rows (list): The matching runs as sqlite3.Row objects.
+    """
+
+    fields = fields or DEFAULT_FIELDS
+    for field in fields:
+        if field not in NAMES:
+            raise KeyError('Unknown column ' + field + ', choose from: ' + ', '.join(NAMES))
+
+    where = []
+    params = []
+    for key, value in (filters or {}).items():
+        if key.startswith('min_') and (key[4:] in NAMES):
+            where.append(key[4:] + ' >= ?')
+        elif key.startswith('max_') and (key[4:] in NAMES):
+            where.append(key[4:] + ' <= ?')
+        elif key in NAMES:
+            where.append(key + ' = ?')
+        else:
+            raise KeyError('Unknown filter ' + key + ', use min_[column], max_[column], or [column] with: ' + ', '.join(NAMES))
+
+        # Numbers compare as numbers, anything else (names, dates) as text
+        try:
+            params.append(float(value))
+        except ValueError:
+            params.append(value)
+
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    if sort not in NAMES:
+        raise KeyError('Unknown sort column ' + sort)
+
+    query = 'SELECT ' + ', '.join(fields) + ' FROM runs'
+    if where:
+        query = query + ' WHERE ' + ' AND '.join(where)
+    query = query + ' ORDER BY ' + sort + (' DESC' if descending else '')
+    if limit is not None:
+        query = query + ' LIMIT ' + str(int(limit))
+    return conn.execute(query, params).fetchall()
+
+def FormatValue(value) -> str:
+    """
+    Formats one value of a result table.
+
+    Args:
+        value: The value.
+
+    Returns:
+        text (str): The value as text, floats rounded to 3 places.
+    """
+
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return str(round(value, 3))
+    return str(value)
+
+def IndexRuns(options: dict) -> None:
+    """
+    Updates the run index over ./Logging/Delay and prints the runs matching the filters.
+
+    Args:
+        options (dict): dir, db, fields, sort, limit, and filters (min_[column], max_[column], [column]), all strings.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    +----------------+ new/changed +-------------------------+ SQL +-------+
+    | Logging/Delay  |------------>| run_index.sqlite        |---->| table |
+    | *.dlog, *.txt  |   logs only | metadata + percentiles  |     |       |
+    +----------------+             +-------------------------+     +-------+
+
+    1. Open ./Logging/run_index.sqlite (or [db]), starting it again if it is from another version.
+    2. Scan [dir] and read only the logs that are new or whose modification time or size changed.
+    3. Store each run's metadata (pkt_tot, PDR, pkt_rate, calibration, distance, start time) and its delay percentiles.
+    4. Remove runs whose log is gone.
+    5. Select runs with the whitelisted filters and print [fields] ordered by [sort].
+
+    ==============================================================
+    """
+
+    options = dict(options)
+    directory = options.pop('dir', './Logging/Delay')
+    db = options.pop('db', './Logging/run_index.sqlite')
+    fields = options.pop('fields', None)
+    fields = fields.split(',') if fields else None
+    sort = options.pop('sort', 'start_time')
+    limit = options.pop('limit', None)
+
+    conn = OpenIndex(db)
+    try:
+        start = time.perf_counter()
+        added, removed = UpdateIndex(conn, directory)
+        total = conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+        print('Indexed %d runs (%d new or changed, %d removed) in %.2f s' % (total, added, removed, time.perf_counter() - start))
+
+        start = time.perf_counter()
+        rows = QueryIndex(conn, options, fields, sort, limit)
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.close()
+
+    fields = fields or DEFAULT_FIELDS
+    table = [fields] + [[FormatValue(row[field]) for field in fields] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(fields))]
+    print()
+    for line in table:
+        print('  '.join(text.ljust(width) for text, width in zip(line, widths)))
+    print('\n%d runs matched in %.1f ms' % (len(rows), 1000 * elapsed))
+
+# String for help command
+ix_str = ("""
+===============
+  IndexRuns()
+===============
+
+Updates the run index over ./Logging/Delay and prints the runs matching the filters.
+
+Args:
+    options (dict): dir, db, fields, sort, limit, and filters (min_[column], max_[column], [column]), all strings.
+
+Returns:
+    None
+
+==============================================================
+
++----------------+ new/changed +-------------------------+ SQL +-------+
+| Logging/Delay  |------------>| run_index.sqlite        |---->| table |
+| *.dlog, *.txt  |   logs only | metadata + percentiles  |     |       |
++----------------+             +-------------------------+     +-------+
+
+1. Open ./Logging/run_index.sqlite (or [db]), starting it again if it is from another version.
+2. Scan [dir] and read only the logs that are new or whose modification time or size changed.
+3. Store each run's metadata (pkt_tot, PDR, pkt_rate, calibration, distance, start time) and its delay percentiles.
+4. Remove runs whose log is gone.
+5. Select runs with the whitelisted filters and print [fields] ordered by [sort].
+
+Columns: name, path, mtime, size, kind, start_time, packets, pkt_tot, pdr, pkt_rate, calibration, distance, lost,
+         mean, p50, p90, p99, p999, max (delays in ms)
+
+e.g. python3 main.py ix min_pkt_rate=500 min_distance=200 fields=name,pkt_rate,distance,p99 sort=-p99
+
+==============================================================
+""")
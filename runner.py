@@ -0,0 +1,457 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Experiment Runner Tools
+'''
+import os
+import json
+import time
+import socket
+import platform
+import datetime
+import itertools
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import utilities as ut
+import packet as pk
+import pacing as pc
+import sockio as so
+import delaylog as dl
+import console as co
+import transmit as tx
+import receive as rx
+import bench as bm
+
+import geopy.distance
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+# Index format version, bump whenever the layout of index.json changes
+VERSION = 1
+
+# Every value the interactive modes prompt for (or take as arguments), with the default used when a config leaves it out
+DEFAULTS = {
+    'role': None,               # 'tx' or 'rx', the same config can be used on both PCs with role= on the command line
+    'mk6_addr': None,
+    'mk6_port': None,
+    'rates': None,              # Packet rates to sweep (pkts/s)
+    'counts': None,             # Packets per point to sweep
+    'sizes': [None],            # Payload sizes to sweep in bytes, left out to send the labels file
+    'warmup': 1.0,              # Seconds of warmup packets (not counted by the receiver) ahead of every point
+    'cooldown': 5.0,            # Seconds between points, must be longer than rx_timeout so the receiver can tell them apart
+    'start_delay': 0.0,         # Seconds to wait before the first point, to start the acme commands on the MK6s
+    'cal_runs': 0,              # Calibration runs against log.txt (0 skips calibration)
+    'calibration': None,        # A known calibration time in seconds instead of cal_runs
+    'latitude': None,           # Coordinates of this PC's MK6, taken from log.txt when left out
+    'longitude': None,
+    'tx_latitude': None,        # Receiver only: transmitter coordinates, taken from the first packet when left out
+    'tx_longitude': None,
+    'pacer': 'hybrid',
+    'burst': 1,
+    'batch': 1,
+    'source': None,
+    'mtu': None,                # Transmitter only: split packets into fragments of at most this many bytes
+    'labels': './Results/predicted_labels.txt',
+    'rx_timeout': 2.0,          # Receiver only: a point ends once nothing arrives for this long
+    'drain_timeout': 1.0,       # Receiver only: wait for stragglers once the last packet of a point is in
+    'kernel_ts': False,         # Receiver only: measure delays from kernel arrival times (SO_TIMESTAMPNS, Linux)
+    'start_timeout': 600.0,     # Receiver only: how long each point waits for the transmitter to start
+    'verbosity': co.NORMAL,
+    'out': './Logging/Runs',
+}
+
+REQUIRED = ['role', 'mk6_addr', 'mk6_port', 'rates', 'counts']
+
+def LoadConfig(path: str, overrides: dict = None) -> dict:
+    """
+    Reads a sweep config from a TOML (Python 3.11+) or JSON file and fills in the defaults.
+
+    Args:
+        path (str): The config file, .toml or .json.
+        overrides (dict): Values that replace those in the file, command line strings are read as JSON where they parse.
+
+    Returns:
+        config (dict): Every key of DEFAULTS.
+    """
+
+    if path.endswith('.toml'):
+        if tomllib is None:
+            raise ValueError('TOML configs need Python 3.11+ (tomllib), use a JSON config instead')
+        with open(path, 'rb') as f:
+            values = tomllib.load(f)
+    else:
+        with open(path) as f:
+            values = json.load(f)
+    for key, value in (overrides or {}).items():
+        try:
+            values[key] = json.loads(value)
+        except ValueError:
+            values[key] = value
+
+    unknown = set(values) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown config keys: ' + ', '.join(sorted(unknown)))
+
+    config = dict(DEFAULTS)
+    config.update(values)
+
+    missing = [key for key in REQUIRED if config[key] is None]
+    if missing:
+        raise ValueError('Missing config keys: ' + ', '.join(missing))
+    if config['role'] not in ('tx', 'rx'):
+        raise ValueError("role must be 'tx' or 'rx'")
+    if config['cooldown'] <= config['rx_timeout']:
+        raise ValueError('cooldown must be longer than rx_timeout or the receiver runs points together')
+
+    return config
+
+def Points(config: dict) -> list:
+    """
+    Lists every point of the sweep, in the order both ends run them.
+
+    Args:
+        config (dict): The sweep config.
+
+    Returns:
+        points (list): A dict of index, pkt_rate, pkt_tot, and size for every combination.
+    """
+
+    combos = itertools.product(config['rates'], config['counts'], config['sizes'])
+    return [{'index': i, 'pkt_rate': pkt_rate, 'pkt_tot': pkt_tot, 'size': size} for i, (pkt_rate, pkt_tot, size) in enumerate(combos)]
+
+def SweepDir(root: str) -> str:
+    """
+    Creates the next free results directory [root]/sweep_NNN.
+
+    Args:
+        root (str): Where the sweeps are kept.
+
+    Returns:
+        path (str): The new directory.
+    """
+
+    os.makedirs(root, exist_ok=True)
+    taken = [int(name[6:]) for name in os.listdir(root) if name.startswith('sweep_') and name[6:].isdigit()]
+    index = max(taken, default=0) + 1
+    while True:
+        path = os.path.join(root, 'sweep_%03d' % index)
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            index = index + 1
+
+def Calibrate(config: dict) -> float:
+    """
+    Gets the calibration time without prompting: the configured value, or the average of [cal_runs] runs.
+
+    Args:
+        config (dict): The sweep config.
+
+    Returns:
+        cal_time (float): The calibration time in seconds (0 without calibration).
+    """
+
+    if config['calibration'] is not None:
+        return float(config['calibration'])
+    if config['cal_runs'] == 0:
+        return 0.0
+
+    cal_time = ut.CalibrateTime(config['cal_runs'])
+    if cal_time == 0:
+        raise RuntimeError('Calibration failed, is the MK6 printing its time into log.txt?')
+    return cal_time
+
+def Coordinates(config: dict) -> list:
+    """
+    Gets the coordinates of this PC's MK6 without prompting: the configured ones, the latest fix in log.txt, or [0, 0].
+
+    Args:
+        config (dict): The sweep config.
+
+    Returns:
+        coord (list): [latitude, longitude]
+    """
+
+    if (config['latitude'] is not None) and (config['longitude'] is not None):
+        return [config['latitude'], config['longitude']]
+
+    fix = ut.GetKinematics()
+    if fix is None:
+        print('\nNo coordinates in log.txt, using [0, 0]')
+        return [0, 0]
+    return [fix['latitude'], fix['longitude']]
+
+def WriteIndex(out: str, index: dict) -> None:
+    """
+    Rewrites [out]/index.json, replacing it atomically so an interrupted sweep still leaves a readable index.
+
+    Args:
+        out (str): The results directory.
+        index (dict): The sweep description and the points run so far.
+
+    Returns:
+        None
+    """
+
+    path = os.path.join(out, 'index.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+def TransmitSweep(config: dict, points: list, out: str, index: dict, calibrator: ut.ClockCalibrator, cal_time: float, coord: list, console: co.Console) -> None:
+    """
+    Sends every point of the sweep, each after [warmup] seconds of warmup packets and followed by [cooldown] seconds of quiet.
+
+    Args:
+        config (dict): The sweep config.
+        points (list): The points from Points().
+        out (str): The results directory.
+        index (dict): The index, each point's results are added as it finishes.
+        calibrator (ClockCalibrator): Corrects send times onto the GNSS clock.
+        cal_time (float): The calibration time written into every header.
+        coord (list): The transmitter [latitude, longitude].
+        console (Console): Where progress is printed.
+
+    Returns:
+        None
+    """
+
+    txsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        txsock.bind(('', 50000))
+    except OSError:
+        txsock.bind(('', 0))
+    txsock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    txsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 3_000_000)
+    dest = (config['mk6_addr'], config['mk6_port'])
+
+    for point in points:
+        pkt_rate = point['pkt_rate']
+        if point['size'] is None:
+            labels = ut.LabelSource(config['labels'])
+        else:
+            labels = bm.FixedLabels(bm.MakeLabels(point['size']))
+
+        console.Log(co.QUIET, '\n[%d/%d] %d pkts at %d pkts/s, %s B payload', point['index'] + 1, len(points), point['pkt_tot'], pkt_rate, point['size'])
+
+        # Warmup packets are flagged so the receiver drops them, with their own pacer so they do not count toward the rate
+        warmup_tot = int(pkt_rate * config['warmup'])
+        if warmup_tot > 0:
+            pacer = pc.MakePacer(config['pacer'], pkt_rate, config['burst'])
+            tx.SendPackets(txsock, dest, pkt_rate, warmup_tot, labels, calibrator, cal_time, coord, pacer, console, config['batch'], config['source'],
+                           flags=pk.FLAG_WARMUP, mtu=config['mtu'], point=point['index'])
+
+        pacer = pc.MakePacer(config['pacer'], pkt_rate, config['burst'])
+        sent = tx.SendPackets(txsock, dest, pkt_rate, point['pkt_tot'], labels, calibrator, cal_time, coord, pacer, console, config['batch'], config['source'],
+                              mtu=config['mtu'], point=point['index'])
+
+        pacing = pacer.Report()
+        point = dict(point, sent=sent, warmup=warmup_tot, rate=pacing['rate'], error=pacing['error'], idt_std=pacing['idt_std'])
+        index['points'].append(point)
+        WriteIndex(out, index)
+
+        console.Log(co.QUIET, '%s', pacer.Summary())
+
+        # Quiet gap so the receiver times out and closes this point before the next one starts
+        time.sleep(config['cooldown'])
+
+    txsock.close()
+
+def ReceiveSweep(config: dict, points: list, out: str, index: dict, calibrator: ut.ClockCalibrator, cal_time: float, coord: list, console: co.Console) -> None:
+    """
+    Receives every point of the sweep into its own delay log, [out]/point_NNN.dlog.
+
+    Args:
+        config (dict): The sweep config.
+        points (list): The points from Points().
+        out (str): The results directory.
+        index (dict): The index, each point's results are added as it finishes.
+        calibrator (ClockCalibrator): Corrects receive times onto the GNSS clock.
+        cal_time (float): The calibration time from Calibrate().
+        coord (list): The receiver [latitude, longitude].
+        console (Console): Where progress is printed.
+
+    Returns:
+        None
+    """
+
+    rx_coord = (coord[0], coord[1])
+    if (config['tx_latitude'] is not None) and (config['tx_longitude'] is not None):
+        dist = geopy.distance.geodesic(rx_coord, (config['tx_latitude'], config['tx_longitude'])).m
+    else:
+        dist = None
+
+    rxsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rxsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    rxsock.bind((config['mk6_addr'], config['mk6_port']))
+    receiver = so.BatchReceiver(rxsock, config['batch'], 65536, config['kernel_ts'])
+
+    for point in points:
+        pkt_tot = point['pkt_tot']
+        name = 'point_%03d.dlog' % point['index']
+
+        console.Log(co.QUIET, '\n[%d/%d] waiting for %d pkts at %d pkts/s, %s B payload', point['index'] + 1, len(points), pkt_tot, point['pkt_rate'], point['size'])
+
+        meta = {'start_time': datetime.datetime.now().isoformat(), 'rx_latitude': rx_coord[0], 'rx_longitude': rx_coord[1],
+                'sweep': os.path.basename(out), 'point': point['index'], 'size': point['size']}
+        log = dl.DelayLogWriter(os.path.join(out, name), meta)
+
+        result = rx.CollectPackets(receiver, pkt_tot, calibrator, rx_coord, dist, log, console, config['rx_timeout'], config['drain_timeout'],
+                                   start_timeout=config['start_timeout'], point=point['index'])
+        dist = result['dist']
+
+        loss = result['tracker'].Finalize(pkt_tot)
+        latency = result['histogram'].Report(1e-3)
+        overhead = result['overhead'].Report(1e-3) if result['overhead'] is not None else None
+        fragments = result['reassembler'].Report(loss['expected']) if result['reassembler'].fragments else None
+        pkt_rate = result['pkt_rate'] or point['pkt_rate']
+        log.Close(rx.LogMeta(loss, latency, pkt_rate, result['cal_time'] if loss['received'] else cal_time, dist or 0, overhead, fragments))
+
+        point = dict(point, log=name, received=loss['received'], warmup=result['warmup'], bad=result['bad'], pdr=loss['pdr'], lost=loss['lost'],
+                     reordered=loss['reordered'], duplicates=loss['duplicates'], stray=result['stray'], p50=latency['p50'], p99=latency['p99'],
+                     max=latency['max'])
+        if overhead is not None:
+            point.update(overhead_p50=overhead['p50'], overhead_p99=overhead['p99'])
+        if fragments is not None:
+            point.update(fragments)
+        index['points'].append(point)
+        WriteIndex(out, index)
+
+        console.Log(co.QUIET, 'PDR %.2f%%, lost %d, latency %s', loss['pdr'], loss['lost'], result['histogram'].Summary())
+
+        if result['interrupted']:
+            raise KeyboardInterrupt
+
+    rxsock.close()
+
+def RunSweep(path: str, overrides: dict = None) -> str:
+    """
+    Runs a sweep of (pkt_rate, pkt_tot, payload size) points from the config at [path] without any prompts.
+
+    Args:
+        path (str): The TOML or JSON config (see DEFAULTS for the keys).
+        overrides (dict): Values that replace those in the file (e.g. the role given on the command line).
+
+    Returns:
+        out (str): The results directory.
+
+    ==============================================================
+
+    TX (role = "tx")                            RX (role = "rx")
+    +----------------+                          +----------------+
+    | point 0        |  warmup | pkt_tot pkts   | point_000.dlog |
+    |   cooldown     |------------------------->|   rx_timeout   |
+    | point 1        |  warmup | pkt_tot pkts   | point_001.dlog |
+    |   ...          |------------------------->|   ...          |
+    +----------------+                          +----------------+
+    sweep_NNN/index.json                        sweep_NNN/index.json
+
+    1. Read the config and fill in the defaults, so every prompt of tx/rx is answered up front.
+    2. Calibrate [cal_runs] times (or take [calibration]) and keep tracking the offset in the background.
+    3. Take the coordinates from the config or the latest fix in [log.txt].
+    4. Create the next free results directory ./Logging/Runs/sweep_NNN and copy the config into it.
+    5. For every combination of [rates], [counts], and [sizes] (the same order on both ends):
+       TX sends [warmup] seconds of flagged packets, then [pkt_tot] measured packets, then waits [cooldown].
+       RX drops the warmup packets and logs the measured ones to point_NNN.dlog until it hears nothing for [rx_timeout]
+       or a packet of the next point arrives (every header carries its point).
+    6. Add every point's results (rate and pacing error, or PDR, loss, and latency) to index.json as it finishes.
+
+    ==============================================================
+    """
+
+    config = LoadConfig(path, overrides)
+    points = Points(config)
+
+    print('\n' + str(len(points)) + ' points: rates ' + str(config['rates']) + ', counts ' + str(config['counts']) + ', sizes ' + str(config['sizes']))
+
+    cal_time = Calibrate(config)
+    calibrator = ut.ClockCalibrator('log.txt', cal_time)
+    if cal_time != 0:
+        calibrator.start()
+        print('\nCalibration Time: ' + str(cal_time))
+
+    coord = Coordinates(config)
+    print('\nLatitude: ' + str(coord[0]) + ', Longitude: ' + str(coord[1]))
+
+    out = SweepDir(config['out'])
+    with open(os.path.join(out, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=1)
+
+    index = {
+        'version': VERSION,
+        'role': config['role'],
+        'time': datetime.datetime.now().isoformat(),
+        'host': platform.node(),
+        'calibration': cal_time,
+        'latitude': coord[0],
+        'longitude': coord[1],
+        'points': [],
+    }
+    WriteIndex(out, index)
+
+    # The commands are printed for reference, the sweep does not wait for Enter
+    interface = 'eth0'
+    if config['role'] == 'tx':
+        print('\nMK6 Command to transmit data: acme -L ' + str(config['mk6_port']) + ' -E -P 111 -x ' + interface + ' -d')
+    else:
+        print('\nMK6 Command to receive data: acme -R -P 111 -x ' + interface + ' -X ' + config['mk6_addr'] + ' -Y ' + str(config['mk6_port']) + ' -d')
+    time.sleep(config['start_delay'])
+
+    console = co.Console(config['verbosity'])
+    try:
+        if config['role'] == 'tx':
+            TransmitSweep(config, points, out, index, calibrator, cal_time, coord, console)
+        else:
+            ReceiveSweep(config, points, out, index, calibrator, cal_time, coord, console)
+    except KeyboardInterrupt:
+        console.Log(co.QUIET, '\nInterrupted after %d of %d points', len(index['points']), len(points))
+    finally:
+        if cal_time != 0:
+            calibrator.Stop()
+            console.Log(co.QUIET, calibrator.Summary())
+        console.Close()
+
+    print('\nResults written to ' + out)
+    return out
+
+# String for help command
+run_str = ("""
+==============
+  RunSweep()
+==============
+
+Runs a sweep of (pkt_rate, pkt_tot, payload size) points from the config at [path] without any prompts.
+
+Args:
+    path (str): The TOML or JSON config (see DEFAULTS in runner.py for the keys).
+    overrides (dict): Values that replace those in the file (e.g. role=rx given on the command line).
+
+Returns:
+    out (str): The results directory.
+
+==============================================================
+
+TX (role = "tx")                            RX (role = "rx")
++----------------+                          +----------------+
+| point 0        |  warmup | pkt_tot pkts   | point_000.dlog |
+|   cooldown     |------------------------->|   rx_timeout   |
+| point 1        |  warmup | pkt_tot pkts   | point_001.dlog |
+|   ...          |------------------------->|   ...          |
++----------------+                          +----------------+
+sweep_NNN/index.json                        sweep_NNN/index.json
+
+1. Read the config and fill in the defaults, so every prompt of tx/rx is answered up front.
+2. Calibrate [cal_runs] times (or take [calibration]) and keep tracking the offset in the background.
+3. Take the coordinates from the config or the latest fix in [log.txt].
+4. Create the next free results directory ./Logging/Runs/sweep_NNN and copy the config into it.
+5. For every combination of [rates], [counts], and [sizes] (the same order on both ends):
+   TX sends [warmup] seconds of flagged packets, then [pkt_tot] measured packets, then waits [cooldown].
+   RX drops the warmup packets and logs the measured ones to point_NNN.dlog until it hears nothing for [rx_timeout]
+   or a packet of the next point arrives (every header carries its point).
+6. Add every point's results (rate and pacing error, or PDR, loss, and latency) to index.json as it finishes.
+
+==============================================================
+""")
@@ -0,0 +1,441 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Sharded Receiver Tools
+'''
+import os
+import time
+import socket
+import signal
+import datetime
+import multiprocessing
+from operator import*
+
+# Ignore warnings here -- importing self-made packages
+import utilities as ut
+import packet as pk
+import sockio as so
+import stats as st
+import delaylog as dl
+import console as co
+import receive as rx
+
+import geopy.distance
+
+def SharedNow(fit) -> int:
+    """
+    Gives the current drift-corrected time from a clock fit shared by the parent's ClockCalibrator.
+
+    Args:
+        fit (multiprocessing.Array): The (t0 ns, offset ns, skew) fit.
+
+    Returns:
+        gnss_time (int): The PC time corrected onto the GNSS clock, in ns since the epoch.
+    """
+
+    pc_time = time.time_ns()
+    with fit.get_lock():
+        t0, offset, skew = fit[:]
+    return pc_time - int(offset + skew * (pc_time - t0))
+
+def ReceiveWorker(index: int, mk6_addr: str, mk6_port: int, batch: int, path: str, fit, counts, highest, busy, stop, results) -> None:
+    """
+    Receives on its own SO_REUSEPORT socket until told to stop, writing a shard of the delay log and keeping local
+    statistics (runs in a worker process).
+
+    Args:
+        index (int): The number of this worker.
+        mk6_addr (str): The IP address to bind to.
+        mk6_port (int): The port to bind to.
+        batch (int): The most datagrams drained from the socket with a single recvmmsg() call.
+        path (str): The path of this worker's delay log shard.
+        fit (multiprocessing.Array): The clock fit kept up to date by the parent.
+        counts (multiprocessing.Array): Packets received by each worker (this one writes counts[index]).
+        highest (multiprocessing.Array): The highest sequence number seen by each worker.
+        busy (multiprocessing.Array): Seconds each worker has spent handling packets rather than waiting.
+        stop (multiprocessing.Event): Set by the parent to end the run.
+        results (multiprocessing.Queue): Where 'ready' and the final statistics are sent.
+
+    Returns:
+        None
+    """
+
+    # Ctrl+C goes to the whole process group, the parent decides when to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # The kernel spreads datagrams over every socket bound to the address with SO_REUSEPORT (by sender address/port)
+    rxsock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    rxsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    rxsock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 3_000_000)
+    rxsock.bind((mk6_addr, mk6_port))
+    receiver = so.BatchReceiver(rxsock, batch, 1024)
+
+    # Each source numbers its packets from 0
+    trackers = {}
+    histogram = st.LatencyHistogram()
+    log = dl.DelayLogWriter(path, {'worker': index})
+
+    # A transmitter always hashes to the same worker, so each worker can put its fragments back together alone
+    reassembler = pk.Reassembler()
+
+    bad_cnt = 0
+    warmup_cnt = 0
+    first_header = None
+    start = time.monotonic()
+    cpu_start = time.process_time()
+
+    results.put(('ready', index))
+
+    while not stop.is_set():
+
+        # Wake up regularly to check whether the parent has ended the run
+        pkt_n = receiver.Recv(0.1)
+        if pkt_n == 0:
+            continue
+
+        rx_time = SharedNow(fit)
+        t = time.perf_counter()
+
+        for i in range(pkt_n):
+            try:
+                header, _ = pk.DecodePacket(receiver.pkts[i])
+            except ValueError:
+                bad_cnt = bad_cnt + 1
+                continue
+
+            # Warmup packets only settle the path ahead of the measured ones
+            if header.flags & pk.FLAG_WARMUP:
+                warmup_cnt = warmup_cnt + 1
+                continue
+
+            # A fragment only counts once it completes its frame, which then arrived with its last fragment
+            size = len(receiver.pkts[i])
+            if header.flags & pk.FLAG_FRAGMENT:
+                try:
+                    body = reassembler.Add(header, receiver.pkts[i], rx_time)
+                except ValueError:
+                    bad_cnt = bad_cnt + 1
+                    continue
+                if body is None:
+                    continue
+                size = pk.HEADER.size + len(body)
+
+            tracker = trackers.get(header.source)
+            if tracker is None:
+                tracker = st.SequenceTracker(base=0)
+                trackers[header.source] = tracker
+            if tracker.Record(header.seq) >= st.DUPLICATE:
+                continue
+
+            if first_header is None:
+                first_header = header
+
+            delay = (rx_time - header.tx_time) / 1e9
+            log.Write(header.seq, header.tx_time, rx_time, size, header.source, rx_time)
+            histogram.Record(round(1e6 * abs(delay)))
+
+            counts[index] = counts[index] + 1
+            if header.seq > highest[index]:
+                highest[index] = header.seq
+
+        busy[index] = busy[index] + time.perf_counter() - t
+
+    log.Close()
+    rxsock.close()
+
+    results.put(('done', {
+        'worker': index,
+        'received': counts[index],
+        'bad': bad_cnt,
+        'warmup': warmup_cnt,
+        'fragments': reassembler.Report(0) if reassembler.fragments else None,
+        'histogram': histogram.ToDict(),
+        'first_header': tuple(first_header) if first_header is not None else None,
+        'wall': time.monotonic() - start,
+        'cpu': time.process_time() - cpu_start,
+        'busy': busy[index],
+    }))
+
+def ReceiveSharded(mk6_addr: str, mk6_port: int, pkt_tot: int, cal_runs: int, workers: int = 2, batch: int = 1, verbosity: int = co.NORMAL) -> None:
+    """
+    Receive [pkt_tot] UDP packets from IPv4 IP [mk6_addr] on port [mk6_port] with [cal_runs] calibration runs, spread
+    over [workers] processes that each bind the port with SO_REUSEPORT.
+
+    Args:
+        mk6_addr (str): The IP address of the MK6 radio.
+        mk6_port (int): The port of the MK6 radio.
+        pkt_tot  (int): The number of packets to receive. -1 receives until the socket times out or Ctrl+C.
+        cal_runs (int): The number of calibration runs to undergo
+        workers  (int): The number of receiver processes.
+        batch    (int): The most datagrams drained from the socket with a single recvmmsg() call.
+        verbosity (int): 0 prints only the final results, 1 adds a summary every second.
+
+    Returns:
+        None
+
+    ==============================================================
+
+    TX                     RX
+    +---+                  +-----------------------------------------+
+    |   | [acme at 5.9GHz] | +-----+ (mk6_addr, mk6_port) +--------+ |
+    |   |----------------->| | MK6 |--------------------->| worker | |
+    |   | pkt_tot pkts     | +-----+  SO_REUSEPORT    x N +--------+ |
+    |   | as bytes         |  bytes          merged by parent process |
+    +---+                  +-----------------------------------------+
+
+    1. Retrieve receiver coordinates from [log.txt], the distance is taken from the transmitter's packet headers.
+    2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
+    3. Provide user with MK6 acme command to receive data.
+    4. Start [workers] processes, each binding its own UDP socket to the port with SO_REUSEPORT.
+    5. Each worker decodes, times, and logs the packets the kernel hands it into its own delay log shard.
+    6. Print the load on every worker each second so [workers] can be sized.
+    7. Merge the shards into one delay log, then track sequence numbers over it for exact PDR, loss, and reordering.
+
+    The kernel picks the socket by hashing the sender address and port, so all packets from one transmitter land on
+    the same worker: the load only spreads when several transmitters (or source ports) send to the port.
+
+    ==============================================================
+    """
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('SO_REUSEPORT is not available on this platform')
+
+    rx_coord = ut.GetCoords()
+    rx_latitude = rx_coord[0]
+    rx_longitude = rx_coord[1]
+
+    print('\nRx Latitude: ' + str(rx_latitude) + '\n')
+    print('Rx Longitude: ' + str(rx_longitude))
+
+    # Returns the averaged time difference between the GNSS (MK6) time and the current PC time
+    rx_cal_time = ut.CalibrationDialogue(cal_runs)
+
+    # Keep refining the offset (and drift) from the MK6 log in the background, the workers read the fit through shared memory
+    calibrator = ut.ClockCalibrator('log.txt', rx_cal_time)
+    if rx_cal_time != 0:
+        calibrator.start()
+
+    # Give user command to run on MK6
+    interface = 'eth0'
+    mk6_cmd = ("acme -R -P 111 -x " + interface + " -X " + mk6_addr + " -Y " + str(mk6_port) + " -d")
+    print("\nRun this MK6 Command to receive data:")
+    print(mk6_cmd)
+    input("\nPress Enter to continue... ")
+
+    workers = max(1, workers)
+
+    # Get the current time and convert it to a string for later file naming
+    now = datetime.datetime.now()
+    datestr = now.strftime("%Y_%m_%d_%H_%M_%S_%p")
+    path = './Logging/Delay/' + "delay_log_" + datestr + ".dlog"
+    shard_paths = ['./Logging/Delay/' + "delay_log_" + datestr + ".w" + str(i) + ".dlog" for i in range(workers)]
+
+    # State shared with the workers (fork keeps the workers' imports and sockets cheap)
+    ctx = multiprocessing.get_context('fork')
+    fit = ctx.Array('d', calibrator.fit)
+    counts = ctx.Array('q', workers, lock=False)
+    highest = ctx.Array('q', [-1] * workers, lock=False)
+    busy = ctx.Array('d', workers, lock=False)
+    stop = ctx.Event()
+    results = ctx.Queue()
+
+    procs = [ctx.Process(target=ReceiveWorker, args=(i, mk6_addr, mk6_port, batch, shard_paths[i], fit, counts, highest, busy, stop, results), daemon=True)
+             for i in range(workers)]
+    for proc in procs:
+        proc.start()
+
+    # Every socket must be bound before packets arrive or the early ones all go to the first workers
+    for _ in range(workers):
+        ut.GetResult(results, procs)
+
+    # Printing happens on a background thread so the terminal can not hold up the parent
+    console = co.Console(verbosity)
+
+    # Socket timeout, and the shorter one used to wait for stragglers once the last packet has arrived
+    rx_timeout = 10
+    drain_timeout = 1
+
+    print ('\nReceiving with ' + str(workers) + ' workers...\n')
+
+    last_cnt = 0
+    last_time = time.monotonic()
+    last_counts = [0] * workers
+    last_busy = [0.0] * workers
+
+    try:
+        while True:
+            time.sleep(0.1)
+
+            # Pass the latest clock fit on to the workers
+            with fit.get_lock():
+                fit[:] = calibrator.fit
+
+            total = sum(counts)
+            if (pkt_tot != -1) and (total >= pkt_tot):
+                break
+
+            if total != last_cnt:
+                last_cnt = total
+                last_time = time.monotonic()
+            timeout = drain_timeout if (pkt_tot != -1) and (max(highest) >= pkt_tot - 1) else rx_timeout
+            if time.monotonic() - last_time > timeout:
+                break
+
+            # Per-worker packet rate and busy fraction, to tell whether more workers would help
+            if console.Due():
+                load = []
+                for i in range(workers):
+                    load.append('w%d %.0f pkts/s %.0f%% busy' % (i, (counts[i] - last_counts[i]) / console.period, 100 * (busy[i] - last_busy[i]) / console.period))
+                    last_counts[i] = counts[i]
+                    last_busy[i] = busy[i]
+                console.Log(co.NORMAL, '[Rx] %d pkts | %s', total, ', '.join(load))
+
+    except KeyboardInterrupt:
+        # Stop receiving but still merge and write out what has been received (how an endless run is ended)
+        console.Log(co.QUIET, 'Interrupted')
+
+    stop.set()
+    done = {}
+    while len(done) < workers:
+        kind, result = ut.GetResult(results, procs)
+        if kind == 'done':
+            done[result['worker']] = result
+    for proc in procs:
+        proc.join()
+
+    # One delay log for the run, in arrival order
+    fields, records = dl.MergeRecords(shard_paths)
+
+    # Sequence tracking over the merged log is exact even if a transmitter's packets were split between workers
+    trackers = {}
+    for seq, source in zip(records['seq'].tolist(), records['source'].tolist()):
+        tracker = trackers.get(source)
+        if tracker is None:
+            tracker = st.SequenceTracker(base=0)
+            trackers[source] = tracker
+        tracker.Record(seq)
+
+    # The packet total is per transmitter, so it is only known when there was one
+    expected = pkt_tot if (pkt_tot != -1) and (len(trackers) <= 1) else None
+    loss = st.CombineLoss([tracker.Finalize(expected) for tracker in trackers.values()]) if trackers else st.SequenceTracker(base=0).Finalize(expected)
+
+    histogram = st.LatencyHistogram()
+    for result in done.values():
+        histogram.Merge(st.LatencyHistogram.FromDict(result['histogram']))
+    latency = histogram.Report(1e-3)
+
+    bad_cnt = sum(result['bad'] for result in done.values())
+    warmup_cnt = sum(result['warmup'] for result in done.values())
+
+    # Frames were put back together by whichever worker their transmitter hashed to, so the counts simply add up
+    # (without each worker's frame total the datagram delivery rate can not be recovered here)
+    fragments = None
+    for result in done.values():
+        if result['fragments'] is None:
+            continue
+        if fragments is None:
+            fragments = dict.fromkeys(('fragments', 'fragment_duplicates', 'frames', 'frames_expired', 'frames_evicted', 'frames_incomplete'), 0)
+        for key in fragments:
+            fragments[key] = fragments[key] + result['fragments'][key]
+
+    # Distance, packet rate, and calibration from the first packet any worker received
+    headers = [pk.PacketHeader(*result['first_header']) for result in done.values() if result['first_header'] is not None]
+    dist = 0
+    pkt_rate = 0
+    cal_time = rx_cal_time
+    if headers:
+        dist = geopy.distance.geodesic((rx_latitude, rx_longitude), (headers[0].tx_latitude, headers[0].tx_longitude)).m
+        pkt_rate = headers[0].pkt_rate
+        cal_time = calibrator.Offset(time.time_ns()) / 1e9 - headers[0].calibration
+
+    console.Log(co.QUIET, '\nTotal packets received: %d\n', loss['received'])
+
+    if(loss['lost'] > 0):
+        console.Log(co.QUIET, 'Packets Dropped: %d in %d bursts (longest %d)\n', loss['lost'], loss['bursts'], loss['burst_max'])
+
+    if(loss['reordered'] > 0):
+        console.Log(co.QUIET, 'Packets Reordered: %d (furthest %d packets)\n', loss['reordered'], loss['reorder_max'])
+
+    if(loss['duplicates'] + loss['late'] > 0):
+        console.Log(co.QUIET, 'Duplicate/Late Packets: %d/%d\n', loss['duplicates'], loss['late'])
+
+    if(bad_cnt > 0):
+        console.Log(co.QUIET, 'Bad Packets: %d\n', bad_cnt)
+
+    if(warmup_cnt > 0):
+        console.Log(co.QUIET, 'Warmup Packets: %d\n', warmup_cnt)
+
+    if fragments is not None:
+        console.Log(co.QUIET, 'Fragments: %d received (%d duplicate), frames expired/evicted/incomplete: %d/%d/%d\n',
+                    fragments['fragments'], fragments['fragment_duplicates'], fragments['frames_expired'], fragments['frames_evicted'],
+                    fragments['frames_incomplete'])
+
+    console.Log(co.QUIET, 'Latency: %s\n', histogram.Summary())
+
+    # How the work was spread, CPU time over wall time shows how close each worker came to a full core
+    for i in range(workers):
+        result = done[i]
+        share = 100 * result['received'] / len(records) if len(records) else 0
+        console.Log(co.QUIET, 'Worker %d: %d pkts (%.1f%%), CPU %.0f%%, busy %.0f%%', i, result['received'], share,
+                    100 * result['cpu'] / result['wall'], 100 * result['busy'] / result['wall'])
+
+    if (workers > 1) and (len(trackers) == 1) and len(records):
+        console.Log(co.QUIET, '\nOne transmitter always hashes to one worker, more workers only help with several transmitters\n')
+
+    log = dl.DelayLogWriter(path, {'start_time': now.isoformat(), 'rx_latitude': rx_latitude, 'rx_longitude': rx_longitude, 'workers': workers}, fields)
+    log.WriteRecords(records)
+    log.Close(rx.LogMeta(loss, latency, pkt_rate, cal_time, dist, fragments=fragments))
+
+    # The shards are all in the merged log now
+    del records
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+
+    if rx_cal_time != 0:
+        calibrator.Stop()
+        console.Log(co.QUIET, calibrator.Summary() + '\n')
+
+    console.Close()
+
+# String for help command
+mrx_str = ("""
+====================
+  ReceiveSharded()
+====================
+
+Receive [pkt_tot] UDP packets from IPv4 IP [mk6_addr] on port [mk6_port] with [cal_runs] calibration runs, spread
+over [workers] processes that each bind the port with SO_REUSEPORT.
+
+Args:
+    mk6_addr (str): The IP address of the MK6 radio.
+    mk6_port (int): The port of the MK6 radio.
+    pkt_tot  (int): The number of packets to receive. -1 receives until the socket times out or Ctrl+C.
+    cal_runs (int): The number of calibration runs to undergo
+    workers  (int): The number of receiver processes.
+    batch    (int): The most datagrams drained from the socket with a single recvmmsg() call.
+    verbosity (int): 0 prints only the final results, 1 adds a summary every second.
+
+Returns:
+    None
+
+==============================================================
+
+TX                     RX
++---+                  +-----------------------------------------+
+|   | [acme at 5.9GHz] | +-----+ (mk6_addr, mk6_port) +--------+ |
+|   |----------------->| | MK6 |--------------------->| worker | |
+|   | pkt_tot pkts     | +-----+  SO_REUSEPORT    x N +--------+ |
+|   | as bytes         |  bytes          merged by parent process |
++---+                  +-----------------------------------------+
+
+1. Retrieve receiver coordinates from [log.txt], the distance is taken from the transmitter's packet headers.
+2. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
+3. Provide user with MK6 acme command to receive data.
+4. Start [workers] processes, each binding its own UDP socket to the port with SO_REUSEPORT.
+5. Each worker decodes, times, and logs the packets the kernel hands it into its own delay log shard.
+6. Print the load on every worker each second so [workers] can be sized.
+7. Merge the shards into one delay log, then track sequence numbers over it for exact PDR, loss, and reordering.
+
+The kernel picks the socket by hashing the sender address and port, so all packets from one transmitter land on
+the same worker: the load only spreads when several transmitters (or source ports) send to the port.
+
+==============================================================
+""")
@@ -0,0 +1,404 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Socket Tools
+'''
+import sys
+import time
+import struct
+import socket
+import select
+import errno
+import ctypes
+import ctypes.util
+from operator import*
+
+# Flag for recvmmsg/sendmmsg to return instead of blocking
+MSG_DONTWAIT = 0x40
+
+# Socket option (and control message type) for kernel receive times as a timespec, not exported by every Python build
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+
+# Socket option (and control message type) for the count of datagrams the socket has dropped, Linux only
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+
+# struct cmsghdr {size_t len; int level; int type;} and struct timespec {long sec; long nsec;} in native layout
+CMSG_HEADER = struct.Struct('@Nii')
+TIMESPEC = struct.Struct('@ll')
+CMSG_SIZE = socket.CMSG_SPACE(TIMESPEC.size)
+
+# The drop count is a __u32
+OVFL = struct.Struct('@I')
+OVFL_SIZE = socket.CMSG_SPACE(OVFL.size)
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_uint8 * 8)]
+
+def LoadLibc():
+    """
+    Loads libc with sendmmsg/recvmmsg if this is Linux and they are there.
+
+    Args:
+        None
+
+    Returns:
+        libc (ctypes.CDLL): libc, or None if batched syscalls are unavailable.
+    """
+
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+# None when sendmmsg/recvmmsg cannot be used, in which case the send/recv loops below are used instead
+libc = LoadLibc()
+
+def MakeIovecs(bufs: list, mmsgs, iovs) -> list:
+    """
+    Points one iovec per message at each preallocated buffer.
+
+    Args:
+        bufs (list): The bytearray buffers.
+        mmsgs (ctypes array): The mmsghdr array to fill in.
+        iovs (ctypes array): The iovec array to fill in.
+
+    Returns:
+        keep (list): ctypes views of the buffers, which must be kept alive as long as the iovecs are used.
+    """
+
+    keep = []
+    for i, buf in enumerate(bufs):
+        cbuf = (ctypes.c_char * len(buf)).from_buffer(buf)
+        keep.append(cbuf)
+        iovs[i].iov_base = ctypes.addressof(cbuf)
+        iovs[i].iov_len = len(buf)
+        mmsgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        mmsgs[i].msg_hdr.msg_iovlen = 1
+    return keep
+
+class BatchSender:
+    """
+    Sends several preallocated packets to [dest] with one sendmmsg() call, or a sendto() loop where that is unavailable.
+
+    Args:
+        sock (socket.socket): The UDP socket to send on.
+        dest (tuple): The (address, port) to send to.
+        bufs (list): The bytearray buffers the packets are written into (must not be resized).
+    """
+
+    def __init__(self, sock: socket.socket, dest: tuple, bufs: list) -> None:
+        self.sock = sock
+        self.dest = dest
+        self.bufs = bufs
+        self.views = [memoryview(buf) for buf in bufs]
+        self.length = 0
+        self.pkts = []
+        self.batched = libc is not None
+
+        if self.batched:
+            # Destination address is the same for every message, resolve it once
+            self.addr = sockaddr_in()
+            self.addr.sin_family = socket.AF_INET
+            self.addr.sin_port = socket.htons(dest[1])
+            self.addr.sin_addr[:] = socket.inet_aton(socket.gethostbyname(dest[0]))
+
+            self.mmsgs = (mmsghdr * len(bufs))()
+            self.iovs = (iovec * len(bufs))()
+            self.keep = MakeIovecs(bufs, self.mmsgs, self.iovs)
+            for mmsg in self.mmsgs:
+                mmsg.msg_hdr.msg_name = ctypes.addressof(self.addr)
+                mmsg.msg_hdr.msg_namelen = ctypes.sizeof(self.addr)
+
+    def SetLength(self, length: int) -> None:
+        """
+        Sets the length of the packets in the buffers (they all hold the same labels).
+
+        Args:
+            length (int): The packet length in bytes.
+
+        Returns:
+            None
+        """
+
+        self.length = length
+        self.SetLengths([length] * len(self.views))
+
+    def SetLengths(self, lengths: list) -> None:
+        """
+        Sets the length of the packet in each buffer (e.g. fragments of a frame, where the last one is shorter).
+
+        Args:
+            lengths (list): The packet length in bytes for each buffer.
+
+        Returns:
+            None
+        """
+
+        self.pkts = [view[:length] for view, length in zip(self.views, lengths)]
+        if self.batched:
+            for iov, length in zip(self.iovs, lengths):
+                iov.iov_len = length
+
+    def Send(self, n: int) -> None:
+        """
+        Sends the first [n] buffers.
+
+        Args:
+            n (int): The number of packets to send.
+
+        Returns:
+            None
+        """
+
+        if not self.batched:
+            for i in range(n):
+                self.sock.sendto(self.pkts[i], self.dest)
+            return
+
+        fd = self.sock.fileno()
+        done = 0
+        while done < n:
+            ret = libc.sendmmsg(fd, ctypes.addressof(self.mmsgs) + done * ctypes.sizeof(mmsghdr), n - done, 0)
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # Send buffer is full, wait for room like sendto() would
+                    select.select([], [self.sock], [], self.sock.gettimeout())
+                    continue
+                raise OSError(err, 'sendmmsg: ' + errno.errorcode.get(err, str(err)))
+            done = done + ret
+
+class BatchReceiver:
+    """
+    Drains [sock] in bulk into [batch] preallocated buffers with one recvmmsg() call, or a recvfrom_into() loop where
+    that is unavailable. The socket is switched to non-blocking; Recv() does its own waiting.
+
+    With [timestamps] (Linux) the kernel stamps every datagram as it arrives (SO_TIMESTAMPNS), so the receive time
+    does not include waiting to be scheduled, Python, or decoding.
+
+    With [overflow] (Linux) the kernel also passes along how many datagrams it has dropped on this socket so far
+    (SO_RXQ_OVFL), e.g. because the receive buffer was full. The count is cumulative, so only the newest is kept.
+
+    Args:
+        sock (socket.socket): The bound UDP socket to receive on.
+        batch (int): The most datagrams returned by one Recv().
+        bufsize (int): The size of each receive buffer.
+        timestamps (bool): Ask the kernel for the arrival time of every datagram.
+        overflow (bool): Ask the kernel for its count of datagrams dropped on this socket.
+
+    Attributes:
+        pkts (list): After Recv() returns n, pkts[:n] are memoryviews of the received datagrams.
+        stamps (list): With [timestamps], stamps[:n] are the kernel arrival times (PC clock, ns since the epoch), 0 if missing.
+        dropped (int): With [overflow], the datagrams dropped on this socket as of the last one received.
+    """
+
+    def __init__(self, sock: socket.socket, batch: int = 1, bufsize: int = 1024, timestamps: bool = False, overflow: bool = False) -> None:
+        self.sock = sock
+        self.batch = max(1, batch)
+        self.bufs = [bytearray(bufsize) for _ in range(self.batch)]
+        self.views = [memoryview(buf) for buf in self.bufs]
+        self.pkts = [None] * self.batch
+        self.addrs = [None] * self.batch
+        self.stamps = [0] * self.batch
+        self.batched = (libc is not None) and (self.batch > 1)
+
+        # Kernel receive times come back as a control message next to each datagram
+        self.timestamps = timestamps and sys.platform.startswith('linux')
+        if self.timestamps:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+        # The drop count comes the same way (only once something has been dropped)
+        self.overflow = overflow and sys.platform.startswith('linux')
+        self.dropped = 0
+        if self.overflow:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        self.control_size = (CMSG_SIZE if self.timestamps else 0) + (OVFL_SIZE if self.overflow else 0)
+
+        self.sock.setblocking(False)
+        self.poller = select.poll()
+        self.poller.register(sock, select.POLLIN)
+
+        if self.batched:
+            self.mmsgs = (mmsghdr * self.batch)()
+            self.iovs = (iovec * self.batch)()
+            self.names = (sockaddr_in * self.batch)()
+            self.keep = MakeIovecs(self.bufs, self.mmsgs, self.iovs)
+            for i in range(self.batch):
+                self.mmsgs[i].msg_hdr.msg_name = ctypes.addressof(self.names[i])
+
+            # One control buffer per message for its timestamp and drop count
+            if self.control_size:
+                self.controls = ctypes.create_string_buffer(self.control_size * self.batch)
+                for i in range(self.batch):
+                    self.mmsgs[i].msg_hdr.msg_control = ctypes.addressof(self.controls) + i * self.control_size
+
+    def Recv(self, timeout: float) -> int:
+        """
+        Waits up to [timeout] seconds for data, then receives everything available up to the batch size.
+
+        Args:
+            timeout (float): The longest time to wait for the first datagram.
+
+        Returns:
+            n (int): The number of datagrams received, 0 on timeout.
+        """
+
+        # A wakeup can still find nothing to read (EINTR, or a datagram dropped for a bad checksum), so keep
+        # polling for whatever is left of [timeout] instead of reporting a timeout early
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if not self.poller.poll(max(0, remaining) * 1000):
+                return 0
+            n = self.RecvReady()
+            if n or (remaining <= 0):
+                return n
+
+    def RecvReady(self) -> int:
+        """
+        Receives everything already waiting on the socket, up to the batch size, without blocking.
+
+        Args:
+            None
+
+        Returns:
+            n (int): The number of datagrams received, 0 if none were waiting.
+        """
+
+        if self.batched:
+            for mmsg in self.mmsgs:
+                mmsg.msg_hdr.msg_namelen = ctypes.sizeof(sockaddr_in)
+                if self.control_size:
+                    mmsg.msg_hdr.msg_controllen = self.control_size
+            n = libc.recvmmsg(self.sock.fileno(), ctypes.addressof(self.mmsgs), self.batch, MSG_DONTWAIT, None)
+            if n < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return 0
+                raise OSError(err, 'recvmmsg: ' + errno.errorcode.get(err, str(err)))
+            for i in range(n):
+                self.pkts[i] = self.views[i][:self.mmsgs[i].msg_len]
+                self.addrs[i] = None
+            if self.timestamps:
+                self.ParseStamps(n)
+            if self.overflow and n:
+                self.ParseOverflow(n - 1)
+            return n
+
+        if self.control_size:
+            return self.RecvStamped()
+
+        n = 0
+        while n < self.batch:
+            try:
+                nbytes, self.addrs[n] = self.sock.recvfrom_into(self.bufs[n])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.pkts[n] = self.views[n][:nbytes]
+            n = n + 1
+        return n
+
+    def ParseStamps(self, n: int) -> None:
+        """
+        Reads the kernel timestamps out of the control buffers filled in by the last recvmmsg() call.
+
+        Args:
+            n (int): The number of datagrams received.
+
+        Returns:
+            None
+        """
+
+        for i in range(n):
+            self.stamps[i] = 0
+            if self.mmsgs[i].msg_hdr.msg_controllen < CMSG_HEADER.size + TIMESPEC.size:
+                continue
+            # The kernel puts the timestamp ahead of the drop count
+            _, level, kind = CMSG_HEADER.unpack_from(self.controls, i * self.control_size)
+            if (level == socket.SOL_SOCKET) and (kind == SO_TIMESTAMPNS):
+                sec, nsec = TIMESPEC.unpack_from(self.controls, i * self.control_size + CMSG_HEADER.size)
+                self.stamps[i] = sec * 1_000_000_000 + nsec
+
+    def ParseOverflow(self, i: int) -> None:
+        """
+        Reads the drop count out of the control buffer of message [i] from the last recvmmsg() call, if it has one.
+
+        Args:
+            i (int): The index of the message (the last one has the newest count).
+
+        Returns:
+            None
+        """
+
+        offset = i * self.control_size
+        end = offset + self.mmsgs[i].msg_hdr.msg_controllen
+        while offset + CMSG_HEADER.size <= end:
+            length, level, kind = CMSG_HEADER.unpack_from(self.controls, offset)
+            if length < CMSG_HEADER.size:
+                break
+            if (level == socket.SOL_SOCKET) and (kind == SO_RXQ_OVFL):
+                self.dropped = OVFL.unpack_from(self.controls, offset + CMSG_HEADER.size)[0]
+            offset = offset + socket.CMSG_SPACE(length - CMSG_HEADER.size)
+
+    def RecvStamped(self) -> int:
+        """
+        Receives everything available up to the batch size with recvmsg_into(), keeping the kernel timestamps and
+        drop count.
+
+        Args:
+            None
+
+        Returns:
+            n (int): The number of datagrams received.
+        """
+
+        n = 0
+        while n < self.batch:
+            try:
+                nbytes, ancdata, _, self.addrs[n] = self.sock.recvmsg_into([self.bufs[n]], self.control_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.pkts[n] = self.views[n][:nbytes]
+            self.stamps[n] = 0
+            for level, kind, data in ancdata:
+                if (level == socket.SOL_SOCKET) and (kind == SO_TIMESTAMPNS):
+                    sec, nsec = TIMESPEC.unpack_from(data)
+                    self.stamps[n] = sec * 1_000_000_000 + nsec
+                elif (level == socket.SOL_SOCKET) and (kind == SO_RXQ_OVFL):
+                    self.dropped = OVFL.unpack_from(data)[0]
+            n = n + 1
+        return n
+
+    def Address(self, i: int) -> tuple:
+        """
+        Gives the sender of datagram [i] from the last Recv(), only decoded when asked for.
+
+        Args:
+            i (int): The index of the datagram.
+
+        Returns:
+            address (tuple): The sender (address, port).
+        """
+
+        if not self.batched:
+            return self.addrs[i]
+        name = self.names[i]
+        return (socket.inet_ntoa(bytes(name.sin_addr)), socket.ntohs(name.sin_port))
@@ -0,0 +1,551 @@
+'''
+Jonah Duncan, 04/11/24 - 05/30/24, CV2X Statistics Tools
+'''
+import time
+from operator import*
+
+# Results of SequenceTracker.Record()
+NEW = 0
+REORDERED = 1
+DUPLICATE = 2
+LATE = 3
+
+class SequenceTracker:
+    """
+    Tracks packet sequence numbers over a sliding window to count loss, loss bursts, reordering, and duplicates.
+
+    Memory is one byte per slot of [window] no matter how long the run is. A sequence number is only declared lost once
+    it has fallen out of the window, so packets reordered by less than [window] are never miscounted.
+
+    Args:
+        window (int): The number of most recent sequence numbers remembered.
+        base (int): The first sequence number expected (None starts from the first packet received).
+    """
+
+    def __init__(self, window: int = 65536, base: int = 0) -> None:
+        self.window = window
+        self.seen = bytearray(window)
+        self.base = base
+        self.highest = None
+
+        # Packet counters
+        self.received = 0
+        self.duplicates = 0
+        self.late = 0
+        self.lost = 0
+
+        # Reordering (distance is how far behind the highest sequence number a packet arrived)
+        self.reordered = 0
+        self.reorder_sum = 0
+        self.reorder_max = 0
+
+        # Loss bursts (runs of consecutive lost sequence numbers)
+        self.bursts = 0
+        self.burst_max = 0
+        self.burst_hist = {}
+        self.run = 0
+
+    def Unwrap(self, seq: int) -> int:
+        """
+        Extends a 32 bit sequence number from the packet header to the full count, using the closest value to the
+        highest sequence number seen so far.
+
+        Args:
+            seq (int): The sequence number from the packet header.
+
+        Returns:
+            seq (int): The unwrapped sequence number.
+        """
+
+        if self.highest is None:
+            return seq
+        return self.highest + ((seq - self.highest + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+    def Record(self, seq: int) -> int:
+        """
+        Records the arrival of sequence number [seq].
+
+        Args:
+            seq (int): The sequence number from the packet header.
+
+        Returns:
+            result (int): NEW, REORDERED, DUPLICATE, or LATE (older than the window, already counted as lost).
+        """
+
+        seq = self.Unwrap(seq)
+
+        if self.highest is None:
+            if self.base is None:
+                self.base = seq
+            self.highest = self.base - 1
+
+        if seq > self.highest:
+            self.Advance(seq)
+            self.seen[seq % self.window] = 1
+            self.received = self.received + 1
+            return NEW
+
+        if (seq <= self.highest - self.window) or (seq < self.base):
+            self.late = self.late + 1
+            return LATE
+
+        idx = seq % self.window
+        if self.seen[idx]:
+            self.duplicates = self.duplicates + 1
+            return DUPLICATE
+
+        self.seen[idx] = 1
+        self.received = self.received + 1
+
+        distance = self.highest - seq
+        self.reordered = self.reordered + 1
+        self.reorder_sum = self.reorder_sum + distance
+        if distance > self.reorder_max:
+            self.reorder_max = distance
+        return REORDERED
+
+    def Advance(self, highest: int) -> None:
+        """
+        Slides the window up to [highest], counting every sequence number that leaves the window unseen as lost.
+
+        Args:
+            highest (int): The new highest sequence number.
+
+        Returns:
+            None
+        """
+
+        # Sequence numbers up to [leaving] fall out of the window
+        leaving = highest - self.window
+        first = max(self.highest - self.window + 1, self.base)
+
+        for s in range(first, min(leaving, self.highest) + 1):
+            idx = s % self.window
+            if self.seen[idx]:
+                self.seen[idx] = 0
+                self.EndBurst()
+            else:
+                self.run = self.run + 1
+
+        # A jump of more than the window skips sequence numbers that were never in it, they are all lost
+        if leaving > self.highest:
+            self.run = self.run + leaving - max(self.highest + 1, first) + 1
+
+        self.highest = highest
+
+    def EndBurst(self) -> None:
+        """
+        Closes the current run of lost sequence numbers, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        if self.run == 0:
+            return
+
+        self.lost = self.lost + self.run
+        self.bursts = self.bursts + 1
+        self.burst_hist[self.run] = self.burst_hist.get(self.run, 0) + 1
+        if self.run > self.burst_max:
+            self.burst_max = self.run
+        self.run = 0
+
+    def Finalize(self, expected: int = None) -> dict:
+        """
+        Declares everything still in the window (and anything after it up to [expected] packets) lost and reports.
+
+        Args:
+            expected (int): The number of packets sent, None if unknown (then the highest sequence number received is
+                            taken as the last one sent).
+
+        Returns:
+            report (dict): Expected, received, lost, PDR (%), duplicates, late, reordering, and loss burst statistics.
+        """
+
+        if self.highest is None:
+            self.highest = (self.base or 0) - 1
+
+        # Everything from the base up to the last expected sequence number is flushed through the window
+        last = self.highest if expected is None else max(self.highest, (self.base or 0) + expected - 1)
+        self.Advance(last + self.window)
+        self.EndBurst()
+        self.highest = last
+
+        expected = last - (self.base or 0) + 1
+        return {
+            'expected': expected,
+            'received': self.received,
+            'lost': self.lost,
+            'pdr': 100 * self.received / expected if expected > 0 else 0,
+            'duplicates': self.duplicates,
+            'late': self.late,
+            'reordered': self.reordered,
+            'reorder_max': self.reorder_max,
+            'reorder_mean': self.reorder_sum / self.reordered if self.reordered else 0,
+            'bursts': self.bursts,
+            'burst_max': self.burst_max,
+            'burst_mean': self.lost / self.bursts if self.bursts else 0,
+        }
+
+def CombineLoss(reports: list) -> dict:
+    """
+    Adds up SequenceTracker.Finalize() reports from several sources (or shards) into one.
+
+    Args:
+        reports (list): The reports to combine.
+
+    Returns:
+        report (dict): The combined report, with the same keys as Finalize().
+    """
+
+    total = {key: sum(report[key] for report in reports) for key in ('expected', 'received', 'lost', 'duplicates', 'late', 'reordered', 'bursts')}
+    total['reorder_max'] = max((report['reorder_max'] for report in reports), default=0)
+    total['burst_max'] = max((report['burst_max'] for report in reports), default=0)
+
+    # Means are weighted by what they are the mean of
+    total['reorder_mean'] = sum(report['reorder_mean'] * report['reordered'] for report in reports) / total['reordered'] if total['reordered'] else 0
+    total['burst_mean'] = total['lost'] / total['bursts'] if total['bursts'] else 0
+    total['pdr'] = 100 * total['received'] / total['expected'] if total['expected'] > 0 else 0
+    return total
+
+class LatencyHistogram:
+    """
+    Log-bucketed (HDR style) histogram of non-negative integer values with running mean, min, max, and variance.
+
+    Values below 2^[sub_bits] are counted exactly, above that each power of two is split into 2^[sub_bits] buckets, so
+    percentiles are within 1/2^[sub_bits] of the true value (under 1% for the default) in a fixed amount of memory.
+
+    Args:
+        sub_bits (int): The number of bits of precision kept for each value.
+    """
+
+    def __init__(self, sub_bits: int = 7) -> None:
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.counts = [0] * (self.sub_count * (64 - sub_bits))
+
+        # Running statistics (Welford's algorithm for the variance)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = 0
+        self.max = 0
+
+    def Index(self, value: int) -> int:
+        """
+        Gives the bucket that [value] is counted in.
+
+        Args:
+            value (int): The value to bucket.
+
+        Returns:
+            index (int): The bucket index.
+        """
+
+        if value < self.sub_count:
+            return value
+
+        # Keep the top sub_bits + 1 bits of the value, the shift picks the power of two
+        shift = value.bit_length() - self.sub_bits - 1
+        return self.sub_count * shift + (value >> shift)
+
+    def Value(self, index: int) -> float:
+        """
+        Gives the value a bucket stands for (the middle of the bucket).
+
+        Args:
+            index (int): The bucket index.
+
+        Returns:
+            value (float): The middle of the bucket.
+        """
+
+        if index < 2 * self.sub_count:
+            return float(index)
+
+        shift = index // self.sub_count - 1
+        low = (index - self.sub_count * shift) << shift
+        return low + ((1 << shift) - 1) / 2
+
+    def Record(self, value: int) -> None:
+        """
+        Adds [value] to the histogram.
+
+        Args:
+            value (int): The value to record (negative values are counted as 0).
+
+        Returns:
+            None
+        """
+
+        if value < 0:
+            value = 0
+
+        self.counts[self.Index(value)] += 1
+
+        self.count = self.count + 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (value - self.mean)
+
+        if (self.count == 1) or (value < self.min):
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def Merge(self, other: 'LatencyHistogram') -> None:
+        """
+        Adds the counts of [other] (e.g. another run, or another worker) into this histogram.
+
+        Args:
+            other (LatencyHistogram): A histogram with the same sub_bits.
+
+        Returns:
+            None
+        """
+
+        if other.sub_bits != self.sub_bits:
+            raise ValueError('Cannot merge histograms with different precision')
+        if other.count == 0:
+            return
+
+        for i, c in enumerate(other.counts):
+            if c:
+                self.counts[i] += c
+
+        # Combine the running statistics (Chan et al. parallel variance)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 = self.m2 + other.m2 + delta * delta * self.count * other.count / count
+        self.mean = self.mean + delta * other.count / count
+
+        self.min = other.min if self.count == 0 else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count = count
+
+    def Percentile(self, p: float) -> float:
+        """
+        Gives the [p]th percentile of the recorded values.
+
+        Args:
+            p (float): The percentile, 0 to 100.
+
+        Returns:
+            value (float): The value at that percentile (0 if nothing has been recorded).
+        """
+
+        if self.count == 0:
+            return 0.0
+
+        # Rank of the value wanted, at least the first value
+        rank = max(1, -(-p * self.count // 100))
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c:
+                seen = seen + c
+                if seen >= rank:
+                    return min(max(self.Value(i), self.min), self.max)
+        return float(self.max)
+
+    def Std(self) -> float:
+        """
+        Gives the standard deviation of the recorded values.
+
+        Args:
+            None
+
+        Returns:
+            std (float): The sample standard deviation (0 for fewer than two values).
+        """
+
+        if self.count < 2:
+            return 0.0
+        return (self.m2 / (self.count - 1)) ** 0.5
+
+    def Report(self, scale: float = 1.0) -> dict:
+        """
+        Summarizes the histogram.
+
+        Args:
+            scale (float): Factor applied to every value (e.g. 1e-3 to turn us into ms).
+
+        Returns:
+            report (dict): count, mean, std, min, p50, p90, p99, p99.9, and max.
+        """
+
+        return {
+            'count': self.count,
+            'mean': self.mean * scale,
+            'std': self.Std() * scale,
+            'min': self.min * scale,
+            'p50': self.Percentile(50) * scale,
+            'p90': self.Percentile(90) * scale,
+            'p99': self.Percentile(99) * scale,
+            'p99.9': self.Percentile(99.9) * scale,
+            'max': self.max * scale,
+        }
+
+    def Summary(self, scale: float = 1e-3, unit: str = 'ms') -> str:
+        """
+        Formats Report() on one line for printing.
+
+        Args:
+            scale (float): Factor applied to every value (default turns us into ms).
+            unit (str): The unit printed after the values.
+
+        Returns:
+            summary (str): The mean and percentiles.
+        """
+
+        r = self.Report(scale)
+        return ('mean %.3f, p50 %.3f, p90 %.3f, p99 %.3f, p99.9 %.3f, max %.3f %s'
+                % (r['mean'], r['p50'], r['p90'], r['p99'], r['p99.9'], r['max'], unit))
+
+    def ToDict(self) -> dict:
+        """
+        Packs the histogram into a dictionary (non-zero buckets only) so it can be saved or sent between processes.
+
+        Args:
+            None
+
+        Returns:
+            hist (dict): The histogram.
+        """
+
+        return {
+            'sub_bits': self.sub_bits,
+            'counts': {i: c for i, c in enumerate(self.counts) if c},
+            'count': self.count,
+            'mean': self.mean,
+            'm2': self.m2,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @staticmethod
+    def FromDict(hist: dict) -> 'LatencyHistogram':
+        """
+        Rebuilds a histogram from ToDict().
+
+        Args:
+            hist (dict): The packed histogram.
+
+        Returns:
+            histogram (LatencyHistogram): The histogram.
+        """
+
+        histogram = LatencyHistogram(hist['sub_bits'])
+        for i, c in hist['counts'].items():
+            histogram.counts[int(i)] = c
+        histogram.count = hist['count']
+        histogram.mean = hist['mean']
+        histogram.m2 = hist['m2']
+        histogram.min = hist['min']
+        histogram.max = hist['max']
+        return histogram
+
+class StageTimer:
+    """
+    Splits the CPU time of a loop between its stages: each Lap() charges the CPU time since the previous Lap() (or
+    Reset()) to a stage. Thread CPU time is used, so time blocked in poll()/sleep() is never counted.
+
+    Args:
+        clock (callable): The clock to read in ns.
+        histograms (bool): Also keep a LatencyHistogram (ns) of the laps of every stage, e.g. for the metrics endpoint.
+    """
+
+    def __init__(self, clock=time.thread_time_ns, histograms: bool = False) -> None:
+        self.clock = clock
+        self.totals = {}
+        self.histograms = {} if histograms else None
+
+        # Reading the clock is not free, so the cost of one read is taken off every lap
+        samples = []
+        for _ in range(5):
+            start = clock()
+            for _ in range(100):
+                clock()
+            samples.append((clock() - start) / 101)
+        self.overhead = min(samples)
+
+        self.last = clock()
+
+    def Reset(self) -> None:
+        """
+        Starts the next lap now without charging the time since the last one to any stage (e.g. after waiting).
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.last = self.clock()
+
+    def Lap(self, stage: str) -> None:
+        """
+        Charges the CPU time since the last lap to [stage].
+
+        Args:
+            stage (str): The name of the stage that just finished.
+
+        Returns:
+            None
+        """
+
+        now = self.clock()
+        lap = max(0, now - self.last - self.overhead)
+        self.totals[stage] = self.totals.get(stage, 0) + lap
+        self.last = now
+
+        if self.histograms is not None:
+            if stage not in self.histograms:
+                self.histograms[stage] = LatencyHistogram()
+            self.histograms[stage].Record(round(lap))
+
+    def Report(self, packets: int) -> dict:
+        """
+        Gives the CPU cost of every stage per packet.
+
+        Args:
+            packets (int): The number of packets the loop handled.
+
+        Returns:
+            report (dict): CPU us per packet for every stage, plus 'total'.
+        """
+
+        report = {stage: total / 1000 / packets if packets else 0.0 for stage, total in self.totals.items()}
+        report['total'] = sum(report.values())
+        return report
+
+    def Summary(self, packets: int) -> str:
+        """
+        Formats Report() on one line for printing.
+
+        Args:
+            packets (int): The number of packets the loop handled.
+
+        Returns:
+            summary (str): The CPU us per packet of every stage.
+        """
+
+        return ', '.join('%s %.2f' % (stage, cost) for stage, cost in self.Report(packets).items()) + ' us/pkt'
+
+class NullTimer:
+    """
+    Stands in for a StageTimer when a loop is not being profiled, so the loop does not have to check.
+    """
+
+    def Reset(self) -> None:
+        pass
+
+    def Lap(self, stage: str) -> None:
+        pass
+
+# Shared by every loop that is not given a timer
+NULL_TIMER = NullTimer()
@@ -1,16 +1,155 @@
 '''
 Jonah Duncan, 04/11/24 - 05/30/24, CV2X Transmission Tools
 '''
-import time
 import socket
 import sys
-import pickle
 from operator import*
 
 # Ignore warnings here -- importing self-made packages
 import utilities as ut
+import packet as pk
+import pacing as pc
+import sockio as so
+import console as co
+import stats as st
+import control as ct
+import metrics as mt
+
+def SendPackets(txsock: socket.socket, dest: tuple, pkt_rate: int, pkt_tot: int, labels, calibrator: ut.ClockCalibrator, tx_cal_time: float, tx_coord: list,
+                pacer: pc.Pacer, console: co.Console, batch: int = 1, source: int = None, timer: st.StageTimer = None, flags: int = 0,
+                mtu: int = None, controller: ct.RateController = None, point: int = 0) -> int:
+    """
+    Sends [pkt_tot] packets to [dest] at [pkt_rate] pkts/s (the send loop of TransmitPackets() without any prompts).
+
+    Args:
+        txsock (socket.socket): The UDP socket to send from.
+        dest (tuple): The (address, port) to send to.
+        pkt_rate (int): The packet rate written into every header.
+        pkt_tot (int): The number of packets to send. -1 sends packets forever.
+        labels (LabelSource): Gives the labels to send (Get()) and a version that changes with them.
+        calibrator (ClockCalibrator): Corrects send times onto the GNSS clock.
+        tx_cal_time (float): The calibration time written into every header.
+        tx_coord (list): The transmitter [latitude, longitude].
+        pacer (Pacer): The rate control.
+        console (Console): Where progress is printed.
+        batch (int): The most packets due in one pacing slot sent with a single sendmmsg() call.
+        source (int): The source id sent in every header, defaults to one derived from the host name.
+        timer (StageTimer): Charges the CPU time of each stage of the loop, if given.
+        flags (int): The flags sent in every header (pk.FLAG_WARMUP for packets receivers should not count).
+        mtu (int): Split every packet into fragments of at most this many bytes (see pk.FrameBuffer), None to send whole.
+        controller (RateController): Changes the packet rate from receiver feedback, if given.
+        point (int): The sweep point sent in every header, so the receiver can tell points apart (0 outside a sweep).
 
-def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, cal_runs: int) -> None:
+    Returns:
+        pkt_cnt (int): The number of packets sent.
+    """
+
+    # Id of this transmitter so receivers can separate several vehicles (or several transmitters on one PC)
+    if source is None:
+        source = pk.SourceId()
+
+    # Preallocated packet buffers (one per packet in a batch), serialized only when the labels change
+    # With an [mtu] each buffer holds a frame split into fragments, which go out together
+    batch = max(1, batch)
+    if mtu is None:
+        pktbufs = [pk.PacketBuffer() for _ in range(batch)]
+    else:
+        pktbufs = [pk.FrameBuffer(mtu) for _ in range(batch)]
+    pktbuf_version = -1
+    frag_n = 1
+
+    # Packets due in the same pacing slot go out in one sendmmsg() call (a sendto() loop if that is unavailable)
+    if mtu is None:
+        sender = so.BatchSender(txsock, dest, [pktbuf.buf for pktbuf in pktbufs])
+
+    # Initialise other variables
+    pkt_cnt = 0
+    pkt_due = 0
+    last_report_cnt = 0
+
+    # CPU time per stage is only measured when benchmarking
+    timer = timer or st.NULL_TIMER
+
+    while (pkt_cnt < pkt_tot) or (pkt_tot == -1):
+
+        # Take up a new rate from the feedback controller between packets (only this thread touches the pacer)
+        if controller is not None:
+            new_rate = controller.Poll()
+            if new_rate is not None:
+                pkt_rate = new_rate
+                pacer.SetRate(pkt_rate)
+                console.Log(co.NORMAL, '[Tx] rate %d pkts/s', pkt_rate)
+
+                # Reload the buffers so the headers carry the new rate
+                pktbuf_version = -1
+
+        # Get the in-memory labels (the file is only re-read when it changes)
+        predicted_labels = labels.Get()
+
+        # Encode the labels behind a header holding the calibration time, packet rate, and transmitter
+        # coordinates, but only when a new set of labels has been swapped in
+        if labels.version != pktbuf_version:
+            for pktbuf in pktbufs:
+                pktbuf.Load(predicted_labels, tx_cal_time, pkt_rate, tx_coord[0], tx_coord[1], source, flags, point)
+            pktbuf_version = labels.version
+
+            if mtu is None:
+                sender.SetLength(len(pktbufs[0].pkt))
+
+                # Print the value of the packet each time it changes
+                console.Log(co.VERBOSE, '%s', bytes(pktbufs[0].pkt))
+            else:
+                # The number of fragments changes with the labels, so the sender is set up again over the new buffers
+                frag_bufs = [buf for pktbuf in pktbufs for buf in pktbuf.bufs]
+                sender = so.BatchSender(txsock, dest, frag_bufs)
+                sender.SetLengths([len(buf) for buf in frag_bufs])
+                frag_n = len(pktbufs[0].bufs)
+
+                console.Log(co.VERBOSE, '%s (%d fragments)', predicted_labels, frag_n)
+
+        timer.Lap('label load')
+
+        # Block (with the packet already prepared) until the pacer says the next packet(s) are due
+        pkt_due = pacer.Wait()
+        if pkt_tot != -1:
+            pkt_due = min(pkt_due, pkt_tot - pkt_cnt)
+
+        # Waiting for the slot is not a cost of the packets
+        timer.Reset()
+
+        while pkt_due > 0:
+            pkt_batch = min(pkt_due, batch)
+
+            # Patch the sequence number and current drift-corrected time (ns) into each packet in place
+            for i in range(pkt_batch):
+                pktbufs[i].Stamp(pkt_cnt + i, calibrator.Now())
+            timer.Lap('serialize')
+
+            # Transmit the packets to the MK6 via the socket straight from the buffers
+            sender.Send(pkt_batch * frag_n)
+            timer.Lap('send')
+
+            # Record the actual departure times for the packet rate report
+            for i in range(pkt_batch):
+                pacer.Sent()
+
+            # Increment packet numbers
+            pkt_cnt = pkt_cnt + pkt_batch
+            pkt_due = pkt_due - pkt_batch
+
+            console.Log(co.VERBOSE, '\nTotal packets transmitted: %d\n', pkt_cnt)
+
+        # Print a rolling summary at most once a period
+        if console.Due():
+            console.Log(co.NORMAL, '[Tx] %d pkts (%.0f pkts/s)', pkt_cnt, (pkt_cnt - last_report_cnt) / console.period)
+            last_report_cnt = pkt_cnt
+
+        timer.Lap('other')
+
+    return pkt_cnt
+
+def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, cal_runs: int, pacer: str = 'hybrid', burst: int = 1, batch: int = 1, verbosity: int = co.NORMAL, source: int = None, mtu: int = None,
+                    feedback_port: int = None, target_pdr: float = 99.0, target_p99: float = None, max_rate: int = 100000, metrics: int = None) -> None:
     """
     Send [pkt_tot] UDP packets at [pkt_rate] pkts/s to IPv4 IP [mk6_addr] on port [mk6_port] with [cal_runs] calibration runs.
 
@@ -20,6 +159,17 @@ def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, c
         pkt_rate (int): The number of packets per second to send to the MK6 radio.
         pkt_tot  (int): The number of packets to send. -1 sends packets forever.
         cal_runs (int): The number of calibration runs to undergo
+        pacer    (str): The rate control to use: 'hybrid' (sleep then spin), 'sleep', 'token' (token bucket), or 'burst'.
+        burst    (int): The bucket size for 'token' or the packets per burst for 'burst'.
+        batch    (int): The most packets due in one pacing slot sent with a single sendmmsg() call.
+        verbosity (int): 0 prints only the final results, 1 adds a summary every second, 2 adds every packet.
+        source   (int): The source id sent in every header, defaults to one derived from the host name.
+        mtu      (int): Split packets into fragments of at most this many bytes (the receiver buffer is 1024), None to send whole.
+        feedback_port (int): Adapt the rate to receiver feedback arriving on this UDP port (AIMD, see control.py), None for a fixed rate.
+        target_pdr (float): The lowest PDR in % over a feedback window that counts as sustained.
+        target_p99 (float): The highest p99 latency in ms over a feedback window that counts as sustained, None to ignore latency.
+        max_rate (int): The highest rate the controller tries.
+        metrics (int): Serve Prometheus metrics on this local TCP port, None for no endpoint.
 
     Returns:
         None
@@ -34,14 +184,18 @@ def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, c
     |  dict                        bytes  | as bytes         |   |
     +-------------------------------------+                  +---+
 
-    1. Set initial packet rate to [pkt_rate]
+    1. Set up the [pacer] for [pkt_rate]
     2. Retrieve transmitter coordinates from [log.txt].
-    3. Perform calibration [cal_runs] times to get average time difference between MK6 and PC.
+    3. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
     4. Provide user with MK6 acme command to transmit data.
     5. Create a UDP socket, bind, and set broadcast option.
-    6. Pull dictionary data from [predicted_labels.txt] in [./Results/].
-    7. Convert dictionary data into a byte array, pickle it.
-    8. Send [pkt_tot] packets to [mk6_addr] at [mk6_port] with packet rate adjustment.
+    6. Pull dictionary data from [predicted_labels.txt] in [./Results/], reloading only when the file changes.
+    7. Encode dictionary data behind a binary header into a preallocated buffer when it changes (see packet.py).
+    8. Send [pkt_tot] packets to [mk6_addr] at [mk6_port] paced by [pacer] in batches of up to [batch], patching seq/time in place.
+    9. Print a rolling summary every second (every packet at [verbosity] 2) from a background thread.
+    10. With [mtu], split each packet into fragments that each carry the header and are sent together (see packet.py).
+    11. With [feedback_port], raise the rate while the receiver reports [target_pdr]/[target_p99] and cut it when not, logging every window.
+    12. With [metrics], serve packets sent, pacing error, stage and GC pause histograms, and kernel socket counters at http://127.0.0.1:[metrics]/metrics.
 
     ==============================================================
     """
@@ -53,16 +207,17 @@ def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, c
     print('\nTx Latitude: ' + str(tx_latitude) + '\n')
     print('Tx Longitude: ' + str(tx_longitude))
 
-    # Period of packet generation, where a packet is what carries the perception data
-    # Converts int to float
-    PktPeriod = 1.0/pkt_rate
-
-    # Time to sleep between packets
-    sleeptime = PktPeriod
+    # Rate control on a monotonic clock, packets are scheduled at multiples of 1/pkt_rate from the first send
+    pacer = pc.MakePacer(pacer, pkt_rate, burst)
 
     # Returns the averaged time difference between the GNSS (MK6) time and the current PC time
     tx_cal_time = ut.CalibrationDialogue(cal_runs)
 
+    # Keep refining the offset (and drift) from the MK6 log in the background while sending, if calibration was run
+    calibrator = ut.ClockCalibrator('log.txt', tx_cal_time)
+    if tx_cal_time != 0:
+        calibrator.start()
+
     # Give user command to run on MK6
     interface = 'eth0'
     mk6_cmd = ("acme -L " + str(mk6_port) + " -E -P 111 -x " + interface + " -d")
@@ -74,7 +229,11 @@ def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, c
     txsock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
     # Bind to whatever port we can get our hands on (direct binding doesn't work here in my tests)
-    txsock.bind(('', 50000)) 
+    # If another transmitter on this PC already has it, take any free port instead
+    try:
+        txsock.bind(('', 50000))
+    except OSError:
+        txsock.bind(('', 0))
 
     # Set just this socket level to broadcast
     txsock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
@@ -83,91 +242,53 @@ def TransmitPackets(mk6_addr: str, mk6_port: int, pkt_rate: int, pkt_tot: int, c
     txsock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 3_000_000)
     txsock.settimeout(0.050)
 
-    # Get time and set period to prime packet rate variables
-    primed_time = time.time()
-    primed_period = 1.0
+    # Parse the labels once up front, they are reloaded only when [predicted_labels.txt] changes
+    labels = ut.LabelSource('./Results/predicted_labels.txt')
 
-    # Prime variables to time packets for limiting packet rate
-    new_time = primed_time
-    start_time = primed_time
-    last_update_time = primed_time
-    start_time = primed_time
-    update_period = primed_period
-    pkt_rate_period = primed_period
+    # Printing happens on a background thread so the terminal can not hold up the pacing
+    console = co.Console(verbosity)
 
-    # Initialise other variables
-    start_pkt_cnt = 0
-    pkt_cnt = 0
-    sleep_time_arr = []
-    sleep_time_avg = 0
+    # The rate follows the receiver's loss and latency reports when asked to, logged to ./Logging/Rate/
+    controller = None
+    if feedback_port is not None:
+        controller = ct.RateController(feedback_port, pkt_rate, target_pdr, target_p99, max_rate=max_rate)
+        controller.start()
+
+    # Counters and histograms (pacing error, CPU time of every stage of the loop) for a scraper, see metrics.py
+    exporter = None
+    timer = None
+    if metrics is not None:
+        timer = st.StageTimer(histograms=True)
+        pacer.errors = st.LatencyHistogram()
+        exporter = mt.MetricsServer(metrics)
+        exporter.Add(mt.TransmitterMetrics(pacer, txsock, timer))
+        exporter.Start()
 
     try:
-        while (pkt_cnt < pkt_tot) or (pkt_tot == -1):
-                        
-            # This generates an empty byte array to be appended
-            pktbuf = bytearray()
-
-            # Converts Text file to dictionary
-            predicted_labels = {}
-            with open('./Results/predicted_labels.txt') as f:
-                # Remove trailing whitespace with restrip
-                # Split line into two parts using first occurance of whitespace as delimiter
-                # First occurance of whitespace is key
-                predicted_labels = dict(x.rstrip().split(None, 1) for x in f)
-
-            # Add current PC time, calibration time, and packet rate to predicted_labels perception packet
-            predicted_labels.update({"time": time.time(), "calibration": tx_cal_time, "pkt_rate": pkt_rate})
-
-            # Convert dictionary to bytes using pickle.dumps()
-            pktbuf = pickle.dumps(predicted_labels)
-            
-            # Print the type and value of the bytes object
-            print(pktbuf)
-
-            # The +1 here is to account for internal iteration
-            print ('\nTotal packets transmitted: %d\n' % (pkt_cnt+1))
-
-            # Transmit the packet to the MK6 via the socket
-            txsock.sendto(pktbuf, (mk6_addr, mk6_port))
+        pkt_cnt = SendPackets(txsock, (mk6_addr, mk6_port), pkt_rate, pkt_tot, labels, calibrator, tx_cal_time, tx_coord, pacer, console, batch, source, timer=timer,
+                              mtu=mtu, controller=controller)
 
-            # Increment packet numbers
-            pkt_cnt = pkt_cnt + 1
-            
-            # Check if the time difference between the current and last update time is greater than the update period
-            if (new_time - last_update_time > update_period):
-                last_update_time = new_time
-
-            # Keep adjusting sleep time to keep our rate to desired level, averaged over pkt_rate_period intervals
-            # New time is updated here for above logic in next iteration
-            new_time = time.time()
-            error_time = (PktPeriod*(pkt_cnt - start_pkt_cnt) - (new_time - start_time))
-            sleep_time = PktPeriod + error_time
-
-            # If pkt_rate_period is exceeded reset start_pkt_cnt and start_time
-            if (new_time - start_time > pkt_rate_period):
-                start_time = new_time
-                start_pkt_cnt = pkt_cnt
-            
-            # We can only sleep non-negative times so we force sleep_time to zero
-            if sleep_time < 0:
-                sleep_time = 0
-
-            # Debugging to see packet rate adjustment
-            sleep_time_arr.append(sleep_time)
-
-            # Sleep between packets to keep to packet rate
-            time.sleep(sleep_time)
-
-        # Debugging to see packet rate adjustment
-        if(len(sleep_time_arr) != 0):
-            sleep_time_avg = abs(sum(sleep_time_arr) / len(sleep_time_arr))
-        else:
-            sleep_time_avg = 1.0
-        print('Average Packet Rate: '+ str((1.0/sleep_time_avg)) + '\n')
+        console.Log(co.QUIET, '\nTotal packets transmitted: %d\n', pkt_cnt)
+
+        # Packet rate and inter-departure times measured from the actual send times
+        console.Log(co.QUIET, pacer.Summary() + '\n')
+
+        if controller is not None:
+            controller.Stop()
+            console.Log(co.QUIET, controller.Summary() + '\n')
+
+        if exporter is not None:
+            exporter.Stop()
+
+        if tx_cal_time != 0:
+            calibrator.Stop()
+            console.Log(co.QUIET, calibrator.Summary() + '\n')
 
+        console.Close()
         txsock.close()
 
     except KeyboardInterrupt:
+        console.Close()
         print('Interrupted')
         sys.exit(1)
     except Exception as e:
@@ -188,6 +309,17 @@ Args:
     pkt_rate (int): The number of packets per second to send to the MK6 radio.
     pkt_tot  (int): The number of packets to send. -1 sends packets forever.
     cal_runs (int): The number of calibration runs to undergo
+    pacer    (str): The rate control to use: 'hybrid' (sleep then spin), 'sleep', 'token' (token bucket), or 'burst'.
+    burst    (int): The bucket size for 'token' or the packets per burst for 'burst'.
+    batch    (int): The most packets due in one pacing slot sent with a single sendmmsg() call.
+    verbosity (int): 0 prints only the final results, 1 adds a summary every second, 2 adds every packet.
+    source   (int): The source id sent in every header, defaults to one derived from the host name.
+    mtu      (int): Split packets into fragments of at most this many bytes (the receiver buffer is 1024), None to send whole.
+    feedback_port (int): Adapt the rate to receiver feedback arriving on this UDP port (AIMD, see control.py), None for a fixed rate.
+    target_pdr (float): The lowest PDR in % over a feedback window that counts as sustained.
+    target_p99 (float): The highest p99 latency in ms over a feedback window that counts as sustained, None to ignore latency.
+    max_rate (int): The highest rate the controller tries.
+    metrics (int): Serve Prometheus metrics on this local TCP port, None for no endpoint.
 
 Returns:
     None
@@ -202,14 +334,18 @@ TX                                                       RX
 |  dict                        bytes  | as bytes         |   |
 +-------------------------------------+                  +---+
 
-1. Set initial packet rate to [pkt_rate]
+1. Set up the [pacer] for [pkt_rate]
 2. Retrieve transmitter coordinates from [log.txt].
-3. Perform calibration [cal_runs] times to get average time difference between MK6 and PC.
+3. Perform calibration [cal_runs] times to get average time difference between MK6 and PC, then keep tracking it.
 4. Provide user with MK6 acme command to transmit data.
 5. Create a UDP socket, bind, and set broadcast option.
-6. Pull dictionary data from [predicted_labels.txt] in [./Results/].
-7. Convert dictionary data into a byte array, pickle it.
-8. Send [pkt_tot] packets to [mk6_addr] at [mk6_port] with packet rate adjustment.
+6. Pull dictionary data from [predicted_labels.txt] in [./Results/], reloading only when the file changes.
+7. Encode dictionary data behind a binary header into a preallocated buffer when it changes (see packet.py).
+8. Send [pkt_tot] packets to [mk6_addr] at [mk6_port] paced by [pacer] in batches of up to [batch], patching seq/time in place.
+9. Print a rolling summary every second (every packet at [verbosity] 2) from a background thread.
+10. With [mtu], split each packet into fragments that each carry the header and are sent together (see packet.py).
+11. With [feedback_port], raise the rate while the receiver reports [target_pdr]/[target_p99] and cut it when not, logging every window.
+12. With [metrics], serve packets sent, pacing error, stage and GC pause histograms, and kernel socket counters at http://127.0.0.1:[metrics]/metrics.
 
 ==============================================================
 """)
\ No newline at end of file
@@ -7,8 +7,221 @@ import timeit
 import matplotlib.pyplot as plt
 import sys
 import re
+import mmap
+import queue
+import threading
+import collections
 from operator import*
 
+class LabelSource:
+    """
+    Keeps the parsed perception labels from [path] in memory and reloads them only when the file changes.
+
+    Args:
+        path (str): The path of the predicted labels text file.
+        check_period (float): The minimum time in seconds between checks of the file for changes.
+
+    Attributes:
+        labels (dict): The most recent complete set of labels.
+        version (int): Incremented every time a new set of labels is swapped in.
+    """
+
+    def __init__(self, path: str = './Results/predicted_labels.txt', check_period: float = 0.05) -> None:
+        self.path = path
+        self.check_period = check_period
+        self.labels = {}
+        self.version = 0
+
+        # (mtime, size) of the file the current labels were parsed from
+        self._stamp = None
+
+        # (mtime, size) of a change that has been seen but not yet settled
+        self._pending = None
+
+        # Earliest monotonic time at which the file is looked at again
+        self._next_check = 0.0
+
+        # Load the labels once so the first packet is never sent empty
+        self.Reload()
+
+    def Get(self) -> dict:
+        """
+        Returns the current labels, reloading them first if the file has changed since the last check.
+
+        Args:
+            None
+
+        Returns:
+            labels (dict): The most recent complete set of labels.
+        """
+
+        # Only stat the file every check_period so the send loop is not slowed down
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_period
+            self.Reload()
+
+        return self.labels
+
+    def Reload(self) -> bool:
+        """
+        Parses the labels file if its mtime or size has changed and settled and swaps in the new labels.
+
+        Args:
+            None
+
+        Returns:
+            changed (bool): True if a new set of labels was swapped in.
+        """
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp == self._stamp:
+            return False
+
+        # A file still being written keeps changing, so only parse it once it has been stable for a check period
+        # (the very first load is taken straight away so there is something to send)
+        if (stamp != self._pending) and (self._stamp is not None):
+            self._pending = stamp
+            return False
+
+        try:
+            with open(self.path) as f:
+                # Remove trailing whitespace with restrip
+                # Split line into two parts using first occurance of whitespace as delimiter
+                # First occurance of whitespace is key
+                labels = dict(x.rstrip().split(None, 1) for x in f if x.strip())
+
+            # If the file was written to while it was being read, keep the old labels and try again next check
+            st = os.stat(self.path)
+        except (OSError, ValueError):
+            return False
+
+        if (st.st_mtime_ns, st.st_size) != stamp:
+            return False
+
+        # An empty file is a perception pipeline that has truncated but not yet written the file
+        if not labels:
+            return False
+
+        # Swap the new labels in with a single assignment so readers never see a partial dict
+        self.labels = labels
+        self._stamp = stamp
+        self.version = self.version + 1
+        return True
+
+def LastLines(mm, end: int, count: int, block: int = 4096) -> list:
+    """
+    Finds the last [count] complete lines before [end] in a memory-mapped file, scanning backwards a block at a time.
+
+    Args:
+        mm (mmap.mmap): The memory-mapped file.
+        end (int): The size of the file to consider.
+        count (int): The number of lines wanted.
+        block (int): The number of bytes searched per step.
+
+    Returns:
+        lines (list): Up to [count] lines that end in a newline (without the line endings), oldest first.
+    """
+
+    # A line still being written has no newline yet, so the last complete line ends at the last newline
+    lines = []
+    stop = -1
+    pos = end
+    while (pos > 0) and (len(lines) < count):
+        start = max(0, pos - block)
+        found = mm.rfind(b'\n', start, pos)
+        if found == -1:
+            pos = start
+            continue
+
+        # Skip blank lines (e.g. '\r\n\r\n') so every line returned has something on it
+        if stop != -1:
+            line = mm[found + 1:stop].strip()
+            if line:
+                lines.append(line)
+        stop = found
+        pos = found
+
+    # The first line of the file has no newline in front of it
+    if (pos == 0) and (stop != -1) and (len(lines) < count):
+        line = mm[0:stop].strip()
+        if line:
+            lines.append(line)
+
+    lines.reverse()
+    return lines
+
+def LastLine(mm, end: int, block: int = 4096) -> bytes:
+    """
+    Finds the last complete line before [end] in a memory-mapped file (see LastLines()).
+
+    Args:
+        mm (mmap.mmap): The memory-mapped file.
+        end (int): The size of the file to consider.
+        block (int): The number of bytes searched per step.
+
+    Returns:
+        line (bytes): The last line that ends in a newline (without the line ending), b'' if there is none.
+    """
+
+    lines = LastLines(mm, end, 1, block)
+    return lines[0] if lines else b''
+
+def ReadLastLine(path: str) -> bytes:
+    """
+    Reads the last complete line of the file at [path] without reading the rest of the file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        line (bytes): The last complete line, b'' if the file is empty or has no complete line.
+    """
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return b''
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            return LastLine(mm, size)
+
+def GetResult(results, procs: list, timeout: float = None, poll: float = 1.0):
+    """
+    Waits for the next result from worker processes, checking every [poll] seconds that none of them has died (a
+    worker that dies before sending would otherwise leave the parent blocked forever).
+
+    Args:
+        results (multiprocessing.Queue): The queue the workers send to.
+        procs (list): The worker processes.
+        timeout (float): The longest wait in seconds, None to wait as long as the workers are alive.
+        poll (float): Seconds between checks on the workers.
+
+    Returns:
+        result: The next item sent to [results].
+    """
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        # Checked before waiting, so anything a worker sent before it exited is already in the queue
+        exitcodes = [proc.exitcode for proc in procs]
+        try:
+            return results.get(timeout=poll)
+        except queue.Empty:
+            pass
+
+        for i, exitcode in enumerate(exitcodes):
+            if exitcode:
+                raise RuntimeError('Worker ' + str(i) + ' (pid ' + str(procs[i].pid) + ') exited with code ' + str(exitcode))
+        if None not in exitcodes:
+            raise RuntimeError('Every worker exited without sending a result')
+        if (deadline is not None) and (time.monotonic() > deadline):
+            raise TimeoutError('No result from the workers after ' + str(timeout) + ' s')
+
 def CalibrateTime(runs: int) -> float:
     """
     Yields difference between GNSS time on MK6 and local time on PC.
@@ -17,7 +230,7 @@ def CalibrateTime(runs: int) -> float:
         runs (int): The number of calibrations to run.
     
     Returns:
-        cal_avg (float): The average calibration time after runs
+        cal_avg (float): The average calibration time (PC - GNSS) after runs
     """
 
     # Create empty array to hold calibration times (differences between MK6 and PC times)
@@ -32,60 +245,43 @@ def CalibrateTime(runs: int) -> float:
         # Save time prior to reading MK6 time
         pre_fetch_time = timeit.default_timer()
 
-        # Open "dummy" file holding MK6-SSH (Putty) log times in binary mode
-        with open('log.txt', 'rb') as log:
-            
-            # Find the last line in the file
-            try:
-                # Seek to the second-to-last character
-                log.seek(-2, os.SEEK_END)
-
-                # Read characters backwards until newline is found
-                while log.read(1) != b'\n':
-
-                    # Seek to the second-to-last character again (Note: Nested in another while loop)
-                    log.seek(-2, os.SEEK_CUR)
-
-            except OSError:
-                # Seek the beginning of the log file
-                log.seek(0)
-            except KeyboardInterrupt:
-                print('Interrupted:')
-                break
-
-            # Decode last line once it is found
-            gnss_time = log.readline().decode()
-
-            try:
-                # Record GNSS time and account for the delay in printing time on the MK6
-                gnss_time = float(gnss_time) - mk6_print_delay
-            except:
-                # Reset cal_time_arr for setting to error
-                cal_time_arr = []
-
-                # Ensure that gnss_time is a float for calculations below
-                gnss_time = float("1000")
-
-                # Tell user to run MK6 calibration command on MK6
-                print('\nRun this MK6 Command to Calibrate Times:')
-                print('while [ 1 ] ; do echo $EPOCHREALTIME ; sleep 0.001; done\n')
-
-                # Set cal_time_arr to 0 to signify error
-                cal_time_arr = [0]
-                break
-            
-            # Save time after reading MK6 time
-            post_fetch_time = timeit.default_timer()
-
-            # Store current PC time and remove time taken to fetch GNSS
-            pc_time = time.time() - (post_fetch_time - pre_fetch_time)
-
-            # Calculate the difference between PC time and GNSS time
-            cal_time = pc_time - gnss_time
-            cal_time_arr.append(abs(cal_time))
+        # Find the last line in the "dummy" file holding MK6-SSH (Putty) log times
+        try:
+            gnss_time = ReadLastLine('log.txt').decode()
+        except KeyboardInterrupt:
+            print('Interrupted:')
+            break
+
+        try:
+            # Record GNSS time and account for the delay in printing time on the MK6
+            gnss_time = float(gnss_time) - mk6_print_delay
+        except:
+            # Reset cal_time_arr for setting to error
+            cal_time_arr = []
+
+            # Ensure that gnss_time is a float for calculations below
+            gnss_time = float("1000")
+
+            # Tell user to run MK6 calibration command on MK6
+            print('\nRun this MK6 Command to Calibrate Times:')
+            print('while [ 1 ] ; do echo $EPOCHREALTIME ; sleep 0.001; done\n')
+
+            # Set cal_time_arr to 0 to signify error
+            cal_time_arr = [0]
+            break
+
+        # Save time after reading MK6 time
+        post_fetch_time = timeit.default_timer()
+
+        # Store current PC time and remove time taken to fetch GNSS
+        pc_time = time.time() - (post_fetch_time - pre_fetch_time)
+
+        # Calculate the difference between PC time and GNSS time (signed: positive means the PC clock is ahead)
+        cal_time = pc_time - gnss_time
+        cal_time_arr.append(cal_time)
 
     if(runs != 0):
-        cal_avg = abs(sum(cal_time_arr) / len(cal_time_arr))
+        cal_avg = sum(cal_time_arr) / len(cal_time_arr)
     else:
         cal_avg = 0
     return cal_avg
@@ -116,6 +312,338 @@ def CalibrationDialogue(cal_runs: int) -> float:
 
     return cal_time
 
+class ClockCalibrator(threading.Thread):
+    """
+    Background thread that keeps estimating the PC - GNSS clock offset and drift from the MK6 log while a run is going.
+
+    The MK6 calibration command appends its GNSS time to [path] every millisecond. Each poll takes the last complete line
+    from a memory map of the log, pairs it with the PC time, and a linear regression over the last [window] samples
+    gives offset(t) = offset + skew * (t - t0). Now() returns the PC time corrected onto the GNSS clock.
+
+    Args:
+        path (str): The PuTTY log of the MK6 session.
+        offset (float): The starting offset in seconds (e.g. from CalibrationDialogue()).
+        window (int): The number of most recent samples the regression is fitted over.
+        poll_period (float): The time in seconds between polls of the log.
+    """
+
+    def __init__(self, path: str = 'log.txt', offset: float = 0.0, window: int = 1000, poll_period: float = 0.01) -> None:
+        super().__init__(daemon=True)
+        self.path = path
+        self.poll_period = poll_period
+
+        # Variable to account for the delay in printing time on the MK6
+        self.mk6_print_delay = 0.001
+
+        # Current fit as one tuple (t0 ns, offset ns, skew ns/ns), replaced in one assignment so readers never see half
+        # of an update
+        self.fit = (time.time_ns(), offset * 1e9, 0.0)
+
+        # Samples of (PC time, offset) in seconds relative to the first sample, with running sums for the regression
+        self.samples = collections.deque(maxlen=window)
+        self.t_ref = None
+        self.sums = [0.0, 0.0, 0.0, 0.0]
+        self.sample_cnt = 0
+
+        self.last_size = -1
+        self.stop = threading.Event()
+
+    def Offset(self, pc_time: int) -> float:
+        """
+        Gives the estimated PC - GNSS offset at [pc_time].
+
+        Args:
+            pc_time (int): The PC time in ns since the epoch.
+
+        Returns:
+            offset (float): The offset in ns.
+        """
+
+        t0, offset, skew = self.fit
+        return offset + skew * (pc_time - t0)
+
+    def Correct(self, pc_time: int) -> int:
+        """
+        Moves a PC timestamp onto the GNSS clock.
+
+        Args:
+            pc_time (int): The PC time in ns since the epoch.
+
+        Returns:
+            gnss_time (int): The corrected time in ns since the epoch.
+        """
+
+        t0, offset, skew = self.fit
+        return pc_time - int(offset + skew * (pc_time - t0))
+
+    def Now(self) -> int:
+        """
+        Gives the current drift-corrected time.
+
+        Args:
+            None
+
+        Returns:
+            gnss_time (int): The PC time corrected onto the GNSS clock, in ns since the epoch.
+        """
+
+        return self.Correct(time.time_ns())
+
+    def Sample(self) -> tuple:
+        """
+        Reads the newest GNSS time from the log, if the log has grown since the last poll.
+
+        Args:
+            None
+
+        Returns:
+            sample (tuple): (PC time, GNSS time) in seconds, or None if there is no new valid line.
+        """
+
+        try:
+            with open(self.path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if (size == 0) or (size == self.last_size):
+                    return None
+                self.last_size = size
+
+                # Stamp the PC time before reading so the fetch time is not counted as offset
+                pc_time = time.time()
+                with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                    line = LastLine(mm, size)
+        except (OSError, ValueError):
+            return None
+
+        # Kinematics output and other commands end up in the same log, only plain times are used
+        try:
+            gnss_time = float(line) - self.mk6_print_delay
+        except ValueError:
+            return None
+
+        return pc_time, gnss_time
+
+    def Add(self, pc_time: float, gnss_time: float) -> None:
+        """
+        Adds a (PC time, GNSS time) sample and refits the offset and skew over the window.
+
+        Args:
+            pc_time (float): The PC time in seconds since the epoch.
+            gnss_time (float): The GNSS time in seconds since the epoch.
+
+        Returns:
+            None
+        """
+
+        if self.t_ref is None:
+            self.t_ref = pc_time
+
+        x = pc_time - self.t_ref
+        y = pc_time - gnss_time
+
+        # Drop the oldest sample from the sums once the window is full
+        if len(self.samples) == self.samples.maxlen:
+            ox, oy = self.samples[0]
+            self.sums[0] -= ox
+            self.sums[1] -= oy
+            self.sums[2] -= ox * ox
+            self.sums[3] -= ox * oy
+        self.samples.append((x, y))
+        self.sums[0] += x
+        self.sums[1] += y
+        self.sums[2] += x * x
+        self.sums[3] += x * y
+        self.sample_cnt = self.sample_cnt + 1
+
+        # Recompute the sums from scratch now and then so rounding from the subtractions cannot build up
+        if self.sample_cnt % self.samples.maxlen == 0:
+            self.sums = [sum(s[0] for s in self.samples), sum(s[1] for s in self.samples),
+                         sum(s[0] * s[0] for s in self.samples), sum(s[0] * s[1] for s in self.samples)]
+
+        n = len(self.samples)
+        sx, sy, sxx, sxy = self.sums
+        denom = n * sxx - sx * sx
+
+        # Until the samples span some time only the mean offset can be trusted
+        if (n < 2) or (denom <= 1e-12):
+            skew = 0.0
+        else:
+            skew = (n * sxy - sx * sy) / denom
+        offset = (sy - skew * sx) / n
+
+        self.fit = (round(self.t_ref * 1e9), offset * 1e9, skew)
+
+    def run(self) -> None:
+        while not self.stop.is_set():
+            sample = self.Sample()
+            if sample is not None:
+                self.Add(*sample)
+            self.stop.wait(self.poll_period)
+
+    def Stop(self) -> None:
+        """
+        Stops the background thread.
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+
+        self.stop.set()
+
+    def Summary(self) -> str:
+        """
+        Formats the current estimate for printing.
+
+        Args:
+            None
+
+        Returns:
+            summary (str): The offset (ms), skew (ppm), and number of samples.
+        """
+
+        return ('Clock Offset (PC - GNSS): %.3f ms, Drift: %.3f ppm over %d samples'
+                % (self.Offset(time.time_ns()) / 1e6, self.fit[2] * 1e6, self.sample_cnt))
+
+class LogTail:
+    """
+    Follows a growing log (e.g. a PuTTY session log) from a remembered byte offset, so each read only costs the bytes
+    written since the last one.
+
+    Args:
+        path (str): The path of the log.
+        block (int): The number of bytes searched per step when scanning backwards from the end.
+    """
+
+    def __init__(self, path: str, block: int = 4096) -> None:
+        self.path = path
+        self.block = block
+
+        # Byte offset just past the last complete line handed out (None until the first Tail() or ReadNew())
+        self.offset = None
+
+    def Tail(self, lines: int) -> list:
+        """
+        Reads the last [lines] complete lines by scanning backwards from the end of the log (see LastLines()), and
+        moves the offset to the end of them.
+
+        Args:
+            lines (int): The number of lines wanted.
+
+        Returns:
+            tail (list): Up to [lines] decoded lines (blank lines skipped), oldest first.
+        """
+
+        with open(self.path, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+            if end == 0:
+                self.offset = 0
+                return []
+            with mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as mm:
+                # A line still being written is left for the next ReadNew()
+                self.offset = mm.rfind(b'\n', 0, end) + 1
+                tail = LastLines(mm, end, lines, self.block)
+
+        return [line.decode(errors='replace') for line in tail]
+
+    def ReadNew(self) -> list:
+        """
+        Reads the complete lines written since the last call.
+
+        Args:
+            None
+
+        Returns:
+            lines (list): The new decoded lines, oldest first.
+        """
+
+        with open(self.path, 'rb') as f:
+            end = os.fstat(f.fileno()).st_size
+
+            # Start from the beginning the first time, or if the log was truncated/replaced
+            if (self.offset is None) or (end < self.offset):
+                self.offset = 0
+
+            f.seek(self.offset)
+            data = f.read(end - self.offset)
+
+        complete = data.rfind(b'\n') + 1
+        self.offset = self.offset + complete
+        return data[:complete].decode(errors='replace').splitlines()
+
+class KinematicsParser:
+    """
+    Picks the position fix out of 'kinematics-sample-client' output fed to it a few lines at a time.
+
+    Attributes:
+        fix (dict): The latest fix with latitude and longitude (and altitude, heading, and speed when printed), or None.
+    """
+
+    # Lines look like 'latitude - 43.0731' with any amount of space around the dash
+    FIELD = re.compile(r'\b(latitude|longitude|altitude|heading|speed)\s*-\s*([-0-9.]+)')
+
+    def __init__(self) -> None:
+        self.current = {}
+        self.fix = None
+
+    def Feed(self, lines: list) -> None:
+        """
+        Parses more lines of log output.
+
+        Args:
+            lines (list): The lines to parse.
+
+        Returns:
+            None
+        """
+
+        for line in lines:
+            for match in self.FIELD.finditer(line):
+                key = match.group(1)
+                try:
+                    value = float(match.group(2))
+                except ValueError:
+                    continue
+
+                # Latitude starts a new block of output
+                if key == 'latitude':
+                    self.current = {}
+                self.current[key] = value
+
+                # Once latitude and longitude are in the block is a usable fix, later fields are added as they come
+                if ('latitude' in self.current) and ('longitude' in self.current):
+                    self.fix = dict(self.current)
+
+# Reader and parser for 'log.txt', kept between calls so repeated lookups only read what was logged since
+kinematics_tail = None
+kinematics_parser = None
+
+def GetKinematics(path: str = 'log.txt') -> dict:
+    """
+    Gets the latest kinematics fix of an MK6 from the putty log file of the connected PC, without prompting.
+
+    Args:
+        path (str): The PuTTY log of the MK6 session.
+
+    Returns:
+        fix (dict): latitude and longitude, plus altitude, heading, and speed when logged, or None if there is no fix.
+    """
+
+    global kinematics_tail, kinematics_parser
+
+    # An average of 30 lines from the log of running MK6 command is enough
+    gps_data_line_len = 30
+
+    if (kinematics_tail is None) or (kinematics_tail.path != path):
+        kinematics_tail = LogTail(path)
+        kinematics_parser = KinematicsParser()
+        kinematics_parser.Feed(kinematics_tail.Tail(gps_data_line_len))
+    else:
+        kinematics_parser.Feed(kinematics_tail.ReadNew())
+
+    return kinematics_parser.fix
+
 def GetCoords() -> list:
     """
     Gets the coordinates of an MK6 from putty log files of connected PC. 
@@ -129,39 +657,11 @@ def GetCoords() -> list:
 
     input("\nRun the following MK6 command to get its coordinates: \nkinematics-sample-client -a -n 1\n\nPress Enter after running MK6 command to store coordinates")
 
-    # Create empty list for storing log lines
-    coords = []
-
-    # An average of 30 lines from the log of running MK6 command is enough
-    gps_data_line_len = 30
-
     try:
-        with open('log.txt') as file:
-            
-            # Loop to read iterate 
-            # Last n lines and print it
-            for line in (file.readlines() [-gps_data_line_len:]):
-                coords.append(line)
-        
-        # Convert coords list into string
-        coords = ' '.join([str(elem) for elem in coords])
-
-        # Remove newlines characters -- make string one line
-        coords = ''.join(coords.split('\n'))
-
-        # Truncate string to only string between 'latitude' and 'altitude'
-        coords = str(re.findall('latitude.+?altitude', coords))
-
-        # Search for latitude and longitude numbers in coords string
-        lat_match = re.search(r'latitude\s*-\s*([-0-9.]+)', coords)
-        lon_match = re.search(r'longitude\s*-\s*([-0-9.]+)', coords)
-
-        # Store latitude and longitude numbers
-        latitude = float(lat_match.group(1))
-        longitude = float(lon_match.group(1))
+        fix = GetKinematics('log.txt')
 
         # Pack latitude and longitude numbers into list for export
-        coords = [latitude, longitude]
+        coords = [fix['latitude'], fix['longitude']]
     except:
         coords = [0, 0]
 